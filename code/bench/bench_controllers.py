@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+benchmark Enhancer / EnhancerDualInput one_cycle against an in-memory CASU
+(fake_casu), sweeping
+- the number of bee-casu neighbours in the nbg graph
+- the number of fish sources in FISH_INPUT_NETWORK (dual controller only)
+- the history length (HIST_LEN, AVG_HIST_LEN and FISH_HIST_LEN together)
+- the message rate (messages per source per cycle; may be fractional or >1)
+
+Every point runs in a fresh subprocess, so peak RSS is per point.  The CASU
+under test is the only controller; its neighbours are simulated by
+injecting messages in the format they would send.  For each point we
+report cycles/s, p50/p90/p99/max cycle latency and peak RSS, and the whole
+run is written as JSON along with the git commit, so runs from different
+commits can be compared:
+
+    $ python code/bench/bench_controllers.py -o bench-HEAD.json
+    $ python code/bench/bench_controllers.py -o bench-new.json --compare bench-HEAD.json
+
+(needs numpy and yaml, as the controllers do; not assisipy)
+'''
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROBOTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots')
+
+CASU = 'casu-001'
+BEE_MSG_PREFIX = "bee-casu-avg|" # as EnhancerDualInput.MSG_PREFIX_BEECASU
+
+#{{{ setup of one benchmark point
+def write_nbg(fn, n_neigh):
+    '''
+    star graph: CASU receives from (and sends to) n_neigh bee casus, and
+    sends to the fish side.
+    '''
+    lines = ['digraph "bench" {', '    subgraph "bee-arena" {']
+    for i in xrange(n_neigh):
+        nb = "casu-{:04d}".format(100 + i)
+        lines.append('        "bee-arena/{0}" -> "bee-arena/{1}" [label = "casu"; weight={2:.3f}]'.format(
+            nb, CASU, -1.0 / n_neigh))
+        lines.append('        "bee-arena/{0}" -> "bee-arena/{1}" [label = "{1}"]'.format(CASU, nb))
+    lines.append('        "bee-arena/{0}" -> "fish-tank/cats" [label = "cats"]'.format(CASU))
+    lines += ['    }', '    subgraph "fish-tank" {',
+              '        "fish-tank/cats" -> "bee-arena/{0}" [label = "{0}"]'.format(CASU),
+              '    }', '}']
+    with open(fn, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+def write_conf(fn, pt):
+    import yaml
+    conf = {
+        'VERB': 0, 'DEV_VERB': 0, 'SYNCFLASH': False,
+        'MAIN_LOOP_INTERVAL': pt['interval'],
+        'HIST_LEN': pt['hist_len'], 'AVG_HIST_LEN': pt['hist_len'],
+        'FISH_HIST_LEN': pt['hist_len'],
+        'SCHED_REPORT_INTERVAL': 1e9,
+        'FISH_INPUT_NETWORK': dict(
+            ("fish{}".format(i), 1.0) for i in xrange(pt['fish'])),
+        'FISH_OUTPUT_NETWORK': {'cats': True},
+    }
+    with open(fn, 'w') as f:
+        yaml.safe_dump(conf, f, default_flow_style=False)
+#}}}
+
+#{{{ run one point (in the subprocess)
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return float('nan')
+    k = min(len(sorted_vals) - 1, int(round(p / 100.0 * (len(sorted_vals) - 1))))
+    return sorted_vals[k]
+
+def run_point(pt):
+    sys.path.insert(0, ROBOTS_DIR)
+    import fake_casu
+    import libcas
+    if pt['ctrl'] == 'dual':
+        from multi_input import EnhancerDualInput as Ctrl
+        bee_fmt = BEE_MSG_PREFIX + " {:.3f}"
+    else:
+        from mini_enh import Enhancer as Ctrl
+        bee_fmt = "{:.3f}"
+
+    wd = tempfile.mkdtemp(prefix='bench-')
+    cwd = os.getcwd()
+    try:
+        os.chdir(wd) # calibration writes into the cwd
+        write_nbg('bench.nbg', pt['neighbours'])
+        write_conf('bench.conf', pt)
+
+        be = fake_casu.FakeBackend(
+            nbg_file='bench.nbg', default_ir=fake_casu.occupancy_ir(
+                fake_casu.sine_wave(60.0, delay=10.0)))
+        c = Ctrl(CASU, logpath=wd, conf_file='bench.conf',
+                 nbg_file='bench.nbg', backend=be)
+
+        net, clock = be.network, be.clock
+        neighbours = ["casu-{:04d}".format(100 + i) for i in xrange(pt['neighbours'])]
+        fish = ["fish{}".format(i) for i in xrange(pt['fish'])] if pt['ctrl'] == 'dual' else []
+        owed = 0.0
+        durs = []
+        for cyc in xrange(pt['warmup'] + pt['cycles']):
+            # simulated neighbours: `msg_rate` messages per source per cycle
+            owed += pt['msg_rate']
+            n_msgs, owed = int(owed), owed - int(owed)
+            for k in xrange(n_msgs):
+                v = (cyc % 10) / 10.0
+                for nb in neighbours:
+                    net.inject(CASU, nb, bee_fmt.format(v))
+                for fi in fish:
+                    net.inject(CASU, 'cats', "{}:{}".format(fi, 'CW' if cyc % 2 else 'CCW'))
+            t0 = libcas.monotonic()
+            c.one_cycle()
+            t1 = libcas.monotonic()
+            if cyc >= pt['warmup']:
+                durs.append(t1 - t0)
+            clock.sleep(c.MAIN_LOOP_INTERVAL)
+        c.stop()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(wd, ignore_errors=True)
+
+    total = sum(durs)
+    durs.sort()
+    return {
+        'cycles'        : len(durs),
+        'cycles_per_s'  : len(durs) / total if total > 0 else float('inf'),
+        'mean_ms'       : 1e3 * total / max(len(durs), 1),
+        'p50_ms'        : 1e3 * percentile(durs, 50),
+        'p90_ms'        : 1e3 * percentile(durs, 90),
+        'p99_ms'        : 1e3 * percentile(durs, 99),
+        'max_ms'        : 1e3 * durs[-1] if durs else float('nan'),
+        'peak_rss_kb'   : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'fits_interval' : percentile(durs, 99) < pt['interval'],
+    }
+#}}}
+
+#{{{ sweep (in the parent)
+def git_info():
+    def git(*a):
+        try:
+            return subprocess.check_output(
+                ['git'] + list(a), cwd=ROBOTS_DIR, stderr=open(os.devnull, 'w')).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {'commit': git('rev-parse', 'HEAD'),
+            'describe': git('describe', '--always', '--dirty'),
+            'dirty': bool(status) if status is not None else None}
+
+def sweep_points(args):
+    pts = []
+    for ctrl, nn, nf, hl, rate in itertools.product(
+            args.ctrl, args.neighbours, args.fish, args.hist_len, args.msg_rate):
+        if ctrl == 'enh' and nf != args.fish[0]:
+            continue # no fish inputs in the bee-only controller
+        pts.append({'ctrl': ctrl, 'neighbours': nn,
+                    'fish': nf if ctrl == 'dual' else 0,
+                    'hist_len': hl, 'msg_rate': rate, 'interval': args.interval,
+                    'cycles': args.cycles, 'warmup': args.warmup})
+    return pts
+
+def run_in_subprocess(pt):
+    fd, res_fn = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '--point', json.dumps(pt), '--result-file', res_fn]
+        with open(os.devnull, 'w') as devnull: # controller chatter
+            rc = subprocess.call(cmd, stdout=devnull)
+        if rc != 0:
+            return {'error': 'exit status {}'.format(rc)}
+        with open(res_fn) as f:
+            return json.load(f)
+    finally:
+        os.remove(res_fn)
+
+def point_key(pt):
+    return tuple(pt[k] for k in ('ctrl', 'neighbours', 'fish', 'hist_len', 'msg_rate'))
+
+def compare(results, old_fn):
+    with open(old_fn) as f:
+        old = json.load(f)
+    old_pts = dict((point_key(p['point']), p['result']) for p in old['points'])
+    print "\ncompared with {} ({})".format(old_fn, old['meta'].get('git', {}).get('describe'))
+    print "{:5} {:>6} {:>4} {:>6} {:>5} | {:>10} {:>8} | {:>9} {:>8}".format(
+        'ctrl', 'neigh', 'fish', 'hist', 'rate', 'cycles/s', 'change', 'p99 ms', 'change')
+    for p in results:
+        o = old_pts.get(point_key(p['point']))
+        r = p['result']
+        if o is None or 'error' in o or 'error' in r:
+            continue
+        print "{ctrl:5} {neighbours:6} {fish:4} {hist_len:6} {msg_rate:5} | ".format(**p['point']) + \
+              "{:10.0f} {:+7.1f}% | {:9.3f} {:+7.1f}%".format(
+                  r['cycles_per_s'], 100.0 * (r['cycles_per_s'] / o['cycles_per_s'] - 1),
+                  r['p99_ms'], 100.0 * (r['p99_ms'] / o['p99_ms'] - 1))
+#}}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ctrl', nargs='+', choices=['enh', 'dual'], default=['enh', 'dual'])
+    parser.add_argument('--neighbours', nargs='+', type=int, default=[1, 10, 100, 1000])
+    parser.add_argument('--fish', nargs='+', type=int, default=[0, 2, 8])
+    parser.add_argument('--hist-len', nargs='+', type=int, default=[60, 600])
+    parser.add_argument('--msg-rate', nargs='+', type=float, default=[1.0])
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help="MAIN_LOOP_INTERVAL (virtual), and the cycle budget")
+    parser.add_argument('--cycles', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('-o', '--output', type=str, default='bench_controllers.json')
+    parser.add_argument('--compare', type=str, default=None,
+                        help="earlier results file to compare against")
+    parser.add_argument('--point', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.point is not None:
+        # child: run a single point
+        res = run_point(json.loads(args.point))
+        with open(args.result_file, 'w') as f:
+            json.dump(res, f)
+        sys.exit(0)
+
+    meta = {
+        'date'     : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'host'     : socket.gethostname(),
+        'platform' : platform.platform(),
+        'python'   : platform.python_version(),
+        'git'      : git_info(),
+        'args'     : dict((k, v) for k, v in vars(args).items()
+                          if k not in ('point', 'result_file')),
+    }
+    results = []
+    pts = sweep_points(args)
+    print "{:5} {:>6} {:>4} {:>6} {:>5} | {:>10} {:>8} {:>8} {:>8} {:>9}".format(
+        'ctrl', 'neigh', 'fish', 'hist', 'rate', 'cycles/s', 'p50 ms', 'p99 ms', 'max ms', 'rss kB')
+    for pt in pts:
+        r = run_in_subprocess(pt)
+        results.append({'point': pt, 'result': r})
+        prefix = "{ctrl:5} {neighbours:6} {fish:4} {hist_len:6} {msg_rate:5} | ".format(**pt)
+        if 'error' in r:
+            print prefix + "[W] failed ({})".format(r['error'])
+        else:
+            print prefix + "{cycles_per_s:10.0f} {p50_ms:8.3f} {p99_ms:8.3f} {max_ms:8.3f} {peak_rss_kb:9d}{flag}".format(
+                flag='' if r['fits_interval'] else '  [W] p99 over interval', **r)
+        # keep what we have so far, in case the sweep is interrupted
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'points': results}, f, indent=1, sort_keys=True)
+
+    print "[I] results written to {}".format(args.output)
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+relay between the bee arena (CASUs, "local") and the fish side (CATS,
+"internet").
+
+Everything that differs between setups is in a relay.yaml next to the .dep
+file: the addresses, and the routing tables
+
+    routes:   fish-side name -> arena CASU(s) that get its messages
+    renames:  arena CASU -> name it has on the fish side
+
+`renames` defaults to the inverse of `routes`; a CASU not in it keeps its
+name. Messages from CATS for a name not in `routes` are dropped (and
+counted).  Both tables are plain dicts built once at startup.
+
+Both directions are served by one loop on a zmq.Poller (see Relay.run);
+Ctrl-C or SIGTERM stop it within `poll_ms`.
+
+Counts and directions are state, not events, so the relay conflates: of the
+messages waiting on a socket, only the newest per (name, sender) is
+forwarded.  Queues are bounded by `sndhwm`/`rcvhwm`.  With `max_age`,
+messages that carry a send time (msgcodec binary counts, and batches) and
+arrive more than that later than is usual for their sender are dropped; see
+SendAge for how the sender's clock offset is allowed for.  The drops are
+counted (DROP_REASONS) and written to the log every
+`stats_interval`, and printed at the end.
+
+With `wan_batch`, everything for pub_internet within `wan_window` is sent as
+one (zlib compressed) two-part message [BATCH_TOPIC, batch] instead of one
+4-part message each.  Batches arriving on sub_internet are always accepted,
+so the relay at the other site only needs `wan_batch` set to send them.
+A batch is aged by the send time in its header, as one sender.
+
+usage:
+    $ python relay.py -c relay.yaml [-q]
+
+Deploy with relay.yaml, relaylog.py and code/robots/{logwriter,msgcodec}.py.
+'''
+
+import zmq
+import signal
+import collections
+import struct
+import zlib
+import time
+import argparse
+import yaml
+
+import relaylog
+import msgcodec
+
+#{{{ configuration
+DEFAULTS = {
+    'sub_internet'       : None,   # {'connect': addr(s)} or {'bind': addr(s)}
+    'pub_internet'       : None,
+    'pub_local'          : None,   # optional: no local publishing if absent
+    'sub_local'          : None,
+    'subscribe_internet' : ['casu-'],
+    'subscribe_local'    : ['cats'],
+    'routes'             : {},
+    'renames'            : None,
+    'poll_ms'            : 250,    # how often the loop checks for stop
+    'max_batch'          : 100,    # msgs read from one socket before the other
+    'sndhwm'             : 100,    # zmq queue limits (msgs) on every socket
+    'rcvhwm'             : 100,
+    'max_age'            : None,   # s later than usual for the sender: dropped (None: never)
+    'age_window'         : 300.0,  # s over which the usual delay is taken (see SendAge)
+    'stats_interval'     : 60.0,   # s between drop counts in the log
+    'wan_batch'          : False,  # send to pub_internet in batches (see pack_batch)
+    'wan_window'         : 0.05,   # s; msgs from the arena collected per batch
+    'wan_zlevel'         : 1,      # zlib level (0: never compress)
+    'logfile'            : relaylog.RelayLog.FILENAME,
+}
+
+def read_conf(conf_file):
+    with open(conf_file) as f:
+        conf = yaml.safe_load(f) or {}
+    unknown = set(conf) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("unknown relay settings: {}".format(", ".join(sorted(unknown))))
+    out = dict(DEFAULTS)
+    out.update(conf)
+    for k in ('sub_internet', 'pub_internet', 'sub_local'):
+        if not out[k]:
+            raise ValueError("relay conf {} needs '{}'".format(conf_file, k))
+    return out
+
+def build_tables(routes, renames=None):
+    '''
+    (routes, renames) as dicts of str: fish-side name -> tuple of CASU names,
+    and CASU name -> fish-side name (the inverse of routes if not given)
+    '''
+    r = {}
+    for fish_name, casus in (routes or {}).items():
+        if isinstance(casus, basestring):
+            casus = [casus]
+        r[str(fish_name)] = tuple(str(c) for c in casus)
+    if renames is None:
+        renames = {}
+        for fish_name, casus in r.items():
+            for c in casus:
+                if c in renames and renames[c] != fish_name:
+                    raise ValueError("{} is routed from both {} and {}; give `renames`".format(
+                        c, renames[c], fish_name))
+                renames[c] = fish_name
+    return r, dict((str(k), str(v)) for k, v in renames.items())
+
+def _as_list(x):
+    return [x] if isinstance(x, basestring) else list(x)
+#}}}
+
+#{{{ WAN batches
+BATCH_TOPIC = 'relay-batch'
+BATCH_MAGIC = 'RB'
+BATCH_VERSION = 1
+BATCH_ZLIB = 0x01   # flag: body is compressed
+
+_BATCH_HDR = struct.Struct('<2sBBdI')   # magic, version, flags, sent, n msgs
+_PART_LEN = struct.Struct('<I')
+
+def pack_batch(msgs, sent, zlevel=1):
+    '''
+    one frame holding `msgs` (lists of 4 strings): a header, then each part
+    as length + bytes.  The body is compressed if that makes it shorter;
+    for the short messages here, level 1 does about as well as 9.
+    '''
+    body = ''.join(_PART_LEN.pack(len(p)) + p for m in msgs for p in m)
+    flags = 0
+    if zlevel:
+        z = zlib.compress(body, zlevel)
+        if len(z) < len(body):
+            body, flags = z, BATCH_ZLIB
+    return _BATCH_HDR.pack(BATCH_MAGIC, BATCH_VERSION, flags, sent, len(msgs)) + body
+
+def unpack_batch(buf):
+    ''' (sent, [[name, msg, sender, data], ...]); ValueError if malformed '''
+    if len(buf) < _BATCH_HDR.size:
+        raise ValueError("short batch")
+    magic, version, flags, sent, n = _BATCH_HDR.unpack_from(buf)
+    if magic != BATCH_MAGIC:
+        raise ValueError("not a batch")
+    body = buf[_BATCH_HDR.size:]
+    if flags & BATCH_ZLIB:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as e:
+            raise ValueError(str(e))
+    msgs, pos = [], 0
+    for i in xrange(n):
+        parts = []
+        for j in xrange(4):
+            if pos + _PART_LEN.size > len(body):
+                raise ValueError("truncated batch")
+            (ln,) = _PART_LEN.unpack_from(body, pos)
+            pos += _PART_LEN.size
+            if pos + ln > len(body):
+                raise ValueError("truncated batch")
+            parts.append(body[pos:pos + ln])
+            pos += ln
+        msgs.append(parts)
+    return sent, msgs
+#}}}
+
+#{{{ SendAge
+class SendAge(object):
+    '''
+    decides whether a message is too old from a send time stamped by another
+    host, without trusting that host's clock.
+
+    Per sender, the smallest (receive time - send time) seen lately stands
+    for the link's fixed delay plus the offset between the two clocks.  A
+    message's age is how much later than that it arrived, e.g. after waiting
+    in a queue during a WAN stall; the offset cancels out.  The minimum is
+    kept over the current and the previous `window` s, so a slow drift of
+    either clock is followed.
+
+    If a sender's messages have all been too old for more than `max_age`
+    (local time), which a drained backlog never is, its clock must have
+    stepped back: the estimate is started afresh rather than dropping
+    everything it sends.
+    '''
+    def __init__(self, max_age, window=300.0):
+        self.max_age = float(max_age)
+        self.window = float(window)
+        self._est = {}   # key -> [min delay, previous window's min, window start, old since]
+
+    def too_old(self, key, sent, now):
+        d = now - sent
+        e = self._est.get(key)
+        if e is None:
+            e = self._est[key] = [d, d, now, None]
+        elif now - e[2] >= self.window:
+            e[1], e[0], e[2] = e[0], d, now
+        elif d < e[0]:
+            e[0] = d
+        if d - min(e[0], e[1]) <= self.max_age:
+            e[3] = None
+            return False
+        if e[3] is None:
+            e[3] = now
+        elif now - e[3] > self.max_age:
+            e[:] = [d, d, now, None]
+            return False
+        return True
+#}}}
+
+#{{{ Relay
+DROP_REASONS = ['superseded', 'too_old', 'unrouted', 'malformed']
+
+class Relay(object):
+    '''
+    one thread, one zmq.Poller over both SUB sockets.  Frames are received
+    and sent with copy=False; only the name and sender frames (needed for
+    routing) and, for the log, msg and data are read out as strings.
+    '''
+
+    def __init__(self, conf, quiet=False):
+        ''' Create and connect sockets '''
+        self.conf = conf
+        self.routes, self.renames = build_tables(conf['routes'], conf['renames'])
+        self.drops = dict((r, 0) for r in DROP_REASONS)
+        self.ages = None
+        if conf['max_age'] is not None:
+            self.ages = SendAge(conf['max_age'], conf['age_window'])
+        self._unrouted_seen = set()
+        self.context = zmq.Context(1)
+
+        # messages from CATS (for the arena)
+        self.sub_internet = self._socket(zmq.SUB, conf['sub_internet'], 'Internet subscriber')
+        for topic in conf['subscribe_internet'] + [BATCH_TOPIC]:
+            self.sub_internet.setsockopt(zmq.SUBSCRIBE, str(topic))
+
+        # to CATS
+        self.pub_internet = self._socket(zmq.PUB, conf['pub_internet'], 'Internet publisher')
+
+        self.pub_local = None
+        if conf['pub_local']:
+            self.pub_local = self._socket(zmq.PUB, conf['pub_local'], 'Local publisher')
+
+        # messages from the CASUs (for CATS)
+        self.sub_local = self._socket(zmq.SUB, conf['sub_local'], 'Local subscriber')
+        for topic in conf['subscribe_local']:
+            self.sub_local.setsockopt(zmq.SUBSCRIBE, str(topic))
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.sub_internet, zmq.POLLIN)
+        self.poller.register(self.sub_local, zmq.POLLIN)
+        self.handlers = {
+            self.sub_internet : self.from_internet,
+            self.sub_local    : self.from_local,
+        }
+        # SUB filtering, for the messages inside batches
+        self.topics = {
+            self.sub_internet : tuple(str(t) for t in conf['subscribe_internet']),
+            self.sub_local    : tuple(str(t) for t in conf['subscribe_local']),
+        }
+        # messages for pub_internet waiting to go out as a batch
+        self.wan_batch = conf['wan_batch']
+        self._out = collections.OrderedDict()
+        self._out_since = None
+        self.n_batches = 0
+        self.n_batch_bytes = 0
+
+        self.stop = False
+        self.logfile_name = conf['logfile']
+        self.start_time = time.time()
+        # one buffered log for both directions (see relaylog.py)
+        self.log = relaylog.RelayLog(self.logfile_name, quiet=quiet)
+
+    def _socket(self, kind, spec, label):
+        sock = self.context.socket(kind)
+        sock.setsockopt(zmq.LINGER, 0)   # don't hold up stopping on unsent msgs
+        # limits only apply to connections made after they are set
+        sock.setsockopt(zmq.SNDHWM, self.conf['sndhwm'])
+        sock.setsockopt(zmq.RCVHWM, self.conf['rcvhwm'])
+        for how in ('bind', 'connect'):
+            for addr in _as_list(spec.get(how, [])):
+                getattr(sock, how)(addr)
+                print('{} {}: {}'.format(label, how, addr))
+        return sock
+
+    def run(self):
+        '''
+        forward messages until `stop` is set (checked every poll_ms) or
+        interrupted.  Each ready socket is read until empty, or max_batch
+        messages, so neither direction can hold up the other; of those, the
+        newest per (name, sender) is forwarded.
+        '''
+        poll_ms = self.conf['poll_ms']
+        window = self.conf['wan_window']
+        stats_interval = self.conf['stats_interval']
+        next_stats = time.time() + stats_interval
+        while not self.stop:
+            timeout = poll_ms
+            if self._out_since is not None:
+                # wake up in time to send the batch
+                left = self._out_since + window - time.time()
+                timeout = max(0, min(poll_ms, int(left * 1000.0) + 1))
+            for sock, ev in self.poller.poll(timeout):
+                handler = self.handlers[sock]
+                for frames, now in self.read_latest(sock):
+                    handler(frames, now)
+            if self._out_since is not None and time.time() - self._out_since >= window:
+                self.send_batch()
+            if time.time() >= next_stats:
+                self.log.comment(self.drop_summary())
+                next_stats += stats_interval
+
+    def read_latest(self, sock):
+        '''
+        the waiting messages on `sock` (at most max_batch), conflated to the
+        newest per (name, sender), in order of arrival: [(frames, when)].
+        With max_age, stamped messages that are too old are dropped.
+        '''
+        latest = collections.OrderedDict()
+        ages = self.ages
+        for i in xrange(self.conf['max_batch']):
+            try:
+                frames = sock.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            now = time.time()
+            if len(frames) == 2 and frames[0].bytes == BATCH_TOPIC:
+                try:
+                    sent, msgs = unpack_batch(frames[1].bytes)
+                except ValueError:
+                    self.drops['malformed'] += 1
+                    continue
+                if ages is not None and ages.too_old(BATCH_TOPIC, sent, now):
+                    self.drops['too_old'] += len(msgs)
+                    continue
+                topics = self.topics[sock]
+                for parts in msgs:
+                    if parts[0].startswith(topics):
+                        self._keep_latest(latest, [zmq.Frame(p) for p in parts], now)
+                continue
+            if len(frames) != 4:
+                self.drops['malformed'] += 1
+                continue
+            if ages is not None:
+                m = msgcodec.unpack(frames[3].bytes)
+                if m is not None and ages.too_old(frames[2].bytes, m[2], now):
+                    self.drops['too_old'] += 1
+                    continue
+            self._keep_latest(latest, frames, now)
+        return latest.values()
+
+    def _keep_latest(self, latest, frames, now):
+        key = (frames[0].bytes, frames[2].bytes)
+        if key in latest:
+            del latest[key]   # so the order is that of the newest
+            self.drops['superseded'] += 1
+        latest[key] = (frames, now)
+
+    def drop_summary(self):
+        return "relay drops: " + ", ".join(
+            "{}={}".format(r, self.drops[r]) for r in DROP_REASONS)
+
+    def from_internet(self, frames, now):
+        name_f, msg_f, sender_f, data_f = frames
+        name = name_f.bytes
+        names = self.routes.get(name)
+        if names is None:
+            self.drops['unrouted'] += 1
+            if name not in self._unrouted_seen:
+                self._unrouted_seen.add(name)
+                print "[W] no route for messages to {} (dropping them)".format(name)
+            return
+        msg, sender, data = msg_f.bytes, sender_f.bytes, data_f.bytes
+        for name in names:
+            if self.pub_local is not None:
+                self.pub_local.send_multipart([name, msg_f, sender_f, data_f], copy=False)
+            self.log.received('cats', name, msg, sender, data, now)
+
+    def from_local(self, frames, now):
+        name_f, msg_f, sender_f, data_f = frames
+        sender = sender_f.bytes
+        if sender in self.renames:
+            sender_f = sender = self.renames[sender]
+        name, msg, data = name_f.bytes, msg_f.bytes, data_f.bytes
+        if self.wan_batch:
+            key = (name, sender)
+            if key in self._out:
+                del self._out[key]
+                self.drops['superseded'] += 1
+            self._out[key] = [name, msg, sender, data]
+            if self._out_since is None:
+                self._out_since = now
+        else:
+            self.pub_internet.send_multipart([name_f, msg_f, sender_f, data_f], copy=False)
+        self.log.received('arena', name, msg, sender, data, now)
+
+    def send_batch(self):
+        ''' send what waits for pub_internet as one batch '''
+        if self._out:
+            batch = pack_batch(self._out.values(), time.time(), self.conf['wan_zlevel'])
+            self.pub_internet.send_multipart([BATCH_TOPIC, batch], copy=False)
+            self.n_batches += 1
+            self.n_batch_bytes += len(batch)
+        self._out.clear()
+        self._out_since = None
+
+    def close(self):
+        self.send_batch()
+        for sock in (self.sub_internet, self.pub_internet, self.pub_local, self.sub_local):
+            if sock is not None:
+                sock.close()
+        self.context.term()
+        self.log.close()
+#}}}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="relay messages between the bee arena and CATS")
+    parser.add_argument('-c', '--conf', type=str, default='relay.yaml')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="don't print every message (a summary every 10s instead)")
+    args = parser.parse_args()
+
+    relay = Relay(read_conf(args.conf), quiet=args.quiet)
+
+    def _on_term(signum, frame):
+        relay.stop = True
+    signal.signal(signal.SIGTERM, _on_term)
+
+    try:
+        relay.run()
+    except KeyboardInterrupt:
+        print "done. bye"
+
+    relay.log.comment(relay.drop_summary())
+    relay.close()
+    print "[I] " + relay.drop_summary()
+    if relay.n_batches:
+        print "[I] sent {} batches, {:.0f} bytes each on average".format(
+            relay.n_batches, relay.n_batch_bytes / float(relay.n_batches))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+message log for the relays between the bee arena and the fish side (CATS).
+
+Both relay directions share one RelayLog: lines go to a single long-lived
+logwriter.BufferedLogWriter, which writes and flushes in batches from its own
+thread and rotates the file when it gets large.  The line format is as the
+relays always wrote it:
+
+    <time>; Received from cats: <name>;<msg>;<sender>;<data>
+    <time>; Received from arena: <name>;<msg>;<sender>;<data>
+
+Echoing every message to stdout is optional; in quiet mode a count per
+direction is printed every `summary_interval` seconds instead.
+
+Deploy alongside logwriter.py (code/robots).
+'''
+
+import threading
+import time
+
+import logwriter
+
+class RelayLog(object):
+    FILENAME         = "relay_msgs.log"
+    ROTATE_BYTES     = 64 << 20   # start a new file beyond this (64MB)
+    BACKUPS          = 5
+    FLUSH_INTERVAL   = 1.0        # seconds
+    MAX_QUEUE_BYTES  = 16 << 20   # lines beyond this are dropped (and counted)
+    SUMMARY_INTERVAL = 10.0       # seconds, in quiet mode
+
+    def __init__(self, filename=FILENAME, quiet=False, rotate_bytes=ROTATE_BYTES,
+                 backups=BACKUPS, flush_interval=FLUSH_INTERVAL,
+                 summary_interval=SUMMARY_INTERVAL, max_queue_bytes=MAX_QUEUE_BYTES):
+        self.quiet = quiet
+        self.summary_interval = summary_interval
+        self._w = logwriter.BufferedLogWriter(
+            filename, 'w', flush_interval=flush_interval, max_bytes=max_queue_bytes,
+            rotate_bytes=rotate_bytes, backups=backups,
+            drop_marker="# relay log queue full, dropped {} lines\n")
+        self._w.write("# Started at {}\n".format(time.time()))
+
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._last_summary = time.time()
+
+    def received(self, origin, name, msg, sender, data, now=None):
+        '''
+        log one message, `origin` being 'cats' or 'arena'. (Messages
+        logged after close() are ignored, e.g. from a thread still
+        finishing.)
+        '''
+        if now is None:
+            now = time.time()
+        m = 'Received from ' + origin + ': ' + name + ';' + msg + ';' + sender + ';' + data
+        if not self.quiet:
+            print m
+        try:
+            self._w.write("{}; {}\n".format(now, m))
+        except ValueError:
+            return
+        except IOError as e:
+            # the log is failing (e.g. disk full); keep relaying regardless
+            print "[W] {}".format(e)
+            return
+
+        with self._lock:
+            self._counts[origin] = self._counts.get(origin, 0) + 1
+            if self.quiet and now - self._last_summary >= self.summary_interval:
+                counts, self._counts = self._counts, {}
+                print "[I] relay {:.0f}s: {}".format(now - self._last_summary, ", ".join(
+                    "{} from {}".format(n, o) for o, n in sorted(counts.items())))
+                self._last_summary = now
+
+    def comment(self, text):
+        ''' a '#' line in the log, e.g. counters '''
+        try:
+            self._w.write("# {}; {}\n".format(time.time(), text))
+        except ValueError:
+            pass
+        except IOError as e:
+            print "[W] {}".format(e)
+
+    def close(self):
+        try:
+            self._w.close()
+        except IOError as e:
+            print "[W] {}".format(e)
+        if self._w.n_dropped:
+            print "[W] {} relay log lines dropped (queue full)".format(self._w.n_dropped)
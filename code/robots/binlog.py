@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+compact binary format for CASU controller logs, and a converter back to
+the usual semicolon-delimited text.
+
+A binary log is a short file header followed by records.  Every record
+starts with a one-byte type tag and a float64 timestamp; the body layout is
+fixed per type:
+
+    HEADER     casu name, and the table of state ids -> names
+    IR         6 x float64 raw IR readings
+    HEAT       4 x float64 temperatures (L, R, B, F), float64 setpoint, uint8 on/off
+    HEAT_CALCS uint16 count, count x float64
+    MODE       uint8 state id (names are in the header)
+    NH_TABLE   uint16 count, count x names; neighbour order for NH_DATA
+    NH_DATA    uint16 count, count x (weight, input, contrib) float64
+    TEXT       a text line, stored as-is (comments, and any line type
+               without a fixed layout)
+
+The neighbour table is written only when the set of neighbours changes
+(normally once), instead of repeating every name as a string each cycle.
+
+usage (conversion):
+    $ python binlog.py casu-031-10:00:00-UTC.blog [more.blog ...]
+writes casu-031-10:00:00-UTC.log next to each input (or use -o).
+
+'''
+
+import struct
+import argparse
+import os
+import sys
+import numpy as np
+
+MAGIC   = 'CASBLOG'
+VERSION = 1
+
+#{{{ record tags and layouts
+HEADER, IR, HEAT, HEAT_CALCS, MODE, NH_TABLE, NH_DATA, TEXT = range(8)
+
+_REC   = struct.Struct('<Bd')     # tag, timestamp
+_U8    = struct.Struct('<B')
+_U16   = struct.Struct('<H')
+_U32   = struct.Struct('<I')
+_IR    = struct.Struct('<6d')
+_HEAT  = struct.Struct('<5dB')
+
+N_IR = 6
+
+# labels as used by the text logs
+LABELS = {
+    IR         : 'ir_array',
+    HEAT       : 'temperatures',
+    HEAT_CALCS : 'heat_calcs',
+    MODE       : 'state',
+    NH_DATA    : 'nh_data',
+}
+#}}}
+
+#{{{ helpers
+def _pack_str(s):
+    s = str(s)
+    return _U16.pack(len(s)) + s
+
+def _unpack_str(buf, pos):
+    (n,) = _U16.unpack_from(buf, pos)
+    pos += _U16.size
+    return buf[pos:pos+n], pos + n
+
+def _fmt(v):
+    # as the text logs write every field (str(), see libcas.write_logline),
+    # so a converted log matches the text one line for line
+    return str(v)
+#}}}
+
+#{{{ encoder
+class BinaryLogEncoder(object):
+    '''
+    produces the bytes for each record; writing them is left to the caller
+    (e.g. a BufferedLogWriter).
+    '''
+    def __init__(self):
+        self._nh_names = None
+
+    def file_header(self, now, name, states):
+        body = _pack_str(name) + _U8.pack(len(states))
+        for sid, sname in sorted(states.items()):
+            body += _U8.pack(sid) + _pack_str(sname)
+        return MAGIC + _U8.pack(VERSION) + _REC.pack(HEADER, now) + body
+
+    def ir(self, now, levels):
+        levels = [float(v) for v in levels[0:N_IR]]
+        levels += [float('nan')] * (N_IR - len(levels))
+        return _REC.pack(IR, now) + _IR.pack(*levels)
+
+    def heat(self, now, temps, setpoint, onoff):
+        return _REC.pack(HEAT, now) + _HEAT.pack(
+            *(list(temps) + [setpoint, int(onoff)]))
+
+    def heat_calcs(self, now, values):
+        return (_REC.pack(HEAT_CALCS, now) + _U16.pack(len(values)) +
+                struct.pack('<{}d'.format(len(values)), *values))
+
+    def mode(self, now, state):
+        return _REC.pack(MODE, now) + _U8.pack(state)
+
+    def nh_data(self, now, names, weights, inputs, contribs):
+        s = ''
+        if names is not self._nh_names and names != self._nh_names:
+            s += _REC.pack(NH_TABLE, now) + _U16.pack(len(names))
+            s += ''.join(_pack_str(n) for n in names)
+            self._nh_names = names
+        n = len(names)
+        vals = []
+        for i in xrange(n):
+            vals += [weights[i], inputs[i], contribs[i]]
+        s += (_REC.pack(NH_DATA, now) + _U16.pack(n) +
+              struct.pack('<{}d'.format(3 * n), *vals))
+        return s
+
+    def text(self, now, line):
+        line = line.rstrip('\r\n')
+        return _REC.pack(TEXT, now) + _U32.pack(len(line)) + line
+#}}}
+
+#{{{ decoder
+def iter_records(buf):
+    '''
+    yield (tag, timestamp, data) for each record in the log contents `buf`.
+    A truncated final record (e.g. the controller was killed) is ignored.
+    '''
+    if not buf.startswith(MAGIC):
+        raise ValueError("not a binary CASU log")
+    pos = len(MAGIC)
+    (version,) = _U8.unpack_from(buf, pos)
+    pos += _U8.size
+    if version > VERSION:
+        raise ValueError("binary log version {} not supported".format(version))
+
+    try:
+        while pos < len(buf):
+            tag, now = _REC.unpack_from(buf, pos)
+            pos += _REC.size
+            if tag == HEADER:
+                name, pos = _unpack_str(buf, pos)
+                (n,) = _U8.unpack_from(buf, pos)
+                pos += _U8.size
+                states = {}
+                for _ in xrange(n):
+                    (sid,) = _U8.unpack_from(buf, pos)
+                    sname, pos = _unpack_str(buf, pos + _U8.size)
+                    states[sid] = sname
+                data = (name, states)
+            elif tag == IR:
+                data = _IR.unpack_from(buf, pos)
+                pos += _IR.size
+            elif tag == HEAT:
+                data = _HEAT.unpack_from(buf, pos)
+                pos += _HEAT.size
+            elif tag == HEAT_CALCS:
+                (n,) = _U16.unpack_from(buf, pos)
+                pos += _U16.size
+                data = struct.unpack_from('<{}d'.format(n), buf, pos)
+                pos += 8 * n
+            elif tag == MODE:
+                (data,) = _U8.unpack_from(buf, pos)
+                pos += _U8.size
+            elif tag == NH_TABLE:
+                (n,) = _U16.unpack_from(buf, pos)
+                pos += _U16.size
+                data = []
+                for _ in xrange(n):
+                    name, pos = _unpack_str(buf, pos)
+                    data.append(name)
+            elif tag == NH_DATA:
+                (n,) = _U16.unpack_from(buf, pos)
+                pos += _U16.size
+                data = struct.unpack_from('<{}d'.format(3 * n), buf, pos)
+                pos += 24 * n
+            elif tag == TEXT:
+                (n,) = _U32.unpack_from(buf, pos)
+                pos += _U32.size
+                data = buf[pos:pos+n]
+                if len(data) < n:
+                    return
+                pos += n
+            else:
+                raise ValueError("unknown record type {} at byte {}".format(tag, pos))
+            yield tag, now, data
+    except struct.error:
+        return
+
+def to_text_lines(buf, delimiter=';'):
+    '''
+    yield the lines of the equivalent text log (without line endings)
+    '''
+    states = {}
+    nh_names = []
+    for tag, now, data in iter_records(buf):
+        if tag == HEADER:
+            states = data[1]
+            continue
+        elif tag == NH_TABLE:
+            nh_names = data
+            continue
+        elif tag == TEXT:
+            yield data
+            continue
+
+        fields = [LABELS[tag], now]
+        if tag == IR or tag == HEAT_CALCS:
+            fields.extend(data)
+        elif tag == HEAT:
+            fields.extend(data[:5])
+            fields.append(int(data[5]))
+        elif tag == MODE:
+            fields += [data, states.get(data, '')]
+        elif tag == NH_DATA:
+            fields.append(len(nh_names))
+            for i, name in enumerate(nh_names):
+                # the text log has these as numpy floats (from the
+                # neighbourhood arrays), whose str() differs from float's
+                fields += [name] + [np.float64(v) for v in data[3*i:3*i+3]]
+
+        yield delimiter.join(_fmt(f) for f in fields)
+#}}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="convert binary CASU logs to semicolon-delimited text")
+    parser.add_argument('logs', nargs='+')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="output file ('-' for stdout); only with one input")
+    parser.add_argument('-d', '--delimiter', type=str, default=';')
+    args = parser.parse_args()
+
+    if args.output is not None and len(args.logs) > 1:
+        parser.error("-o can only be used with a single input log")
+
+    for fn in args.logs:
+        with open(fn, 'rb') as f:
+            buf = f.read()
+        if args.output == '-':
+            out = sys.stdout
+        else:
+            out_fn = args.output or os.path.splitext(fn)[0] + '.log'
+            out = open(out_fn, 'w')
+        for line in to_text_lines(buf, delimiter=args.delimiter):
+            out.write(line + os.linesep)
+        if out is not sys.stdout:
+            out.close()
+            print "[I] {} -> {}".format(fn, out_fn)
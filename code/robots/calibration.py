@@ -1,17 +1,214 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from assisipy import casu
+try:
+    from assisipy import casu
+    HAVE_ASSISIPY = True
+except ImportError:
+    # only the in-memory backend (fake_casu.py) can be used; it provides
+    # the same sensor/actuator constants.
+    import fake_casu as casu
+    HAVE_ASSISIPY = False
 import time, os
+import math
+import hashlib
+import numpy as np
 from numpy import array
 import argparse
 import yaml
 
 
+class AssisiBackend(object):
+    '''
+    the real thing: CASUs reached through assisipy (a bbg, or the playground
+    simulator), and the system clock. A backend provides `clock` (with
+    time() and sleep()) and make_casu(); see fake_casu.FakeBackend for the
+    in-memory equivalent.
+    '''
+    clock = time
+
+    def make_casu(self, rtc_file_name, log=True):
+        if not HAVE_ASSISIPY:
+            raise ImportError("assisipy is needed to connect to {} "
+                              "(or use a fake_casu.FakeBackend)".format(rtc_file_name))
+        return casu.Casu(rtc_file_name=rtc_file_name, log=log)
+
+
+#{{{ streaming statistics
+class RunningStats(object):
+    '''
+    element-wise running mean / variance (Welford) and max of equal-length
+    sample vectors, without keeping the samples.
+    '''
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+
+    def add(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.n == 0:
+            self.mean = np.zeros_like(x)
+            self._m2  = np.zeros_like(x)
+            self.max  = x.copy()
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self._m2 += d * (x - self.mean)
+        np.maximum(self.max, x, out=self.max)
+
+    @property
+    def var(self):
+        if self.n < 2:
+            return np.zeros_like(self.mean)
+        return self._m2 / (self.n - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+class P2Quantile(object):
+    '''
+    streaming estimate of the p-quantile of one variable, in constant memory
+    (the P-square algorithm, Jain & Chlamtac 1985). The first `n_exact`
+    samples are kept, and the quantile is exact until then; the five markers
+    are then placed from them, which makes the estimate much less sensitive
+    to an early outlier than starting from 5 samples. Calibration uses its
+    min_steps here, so that P-square takes over within calib_steps.
+    '''
+    def __init__(self, p, n_exact=32):
+        self.p = float(p)
+        self.n_exact = max(int(n_exact), 5)
+        self._buf = []
+        self.q = None                   # marker heights
+        self.dn = [0.0, self.p/2, self.p, (1 + self.p)/2, 1.0]
+
+    def _init_markers(self):
+        buf = sorted(self._buf)
+        last = len(buf) - 1
+        self.n, self.np = [], []
+        for i, f in enumerate(self.dn):
+            pos = int(round(f * last))
+            if self.n:
+                pos = max(pos, self.n[-1] + 1)
+            self.n.append(min(pos, last - (4 - i)))
+            self.np.append(f * last)
+        self.q = [buf[i] for i in self.n]
+        self._buf = None
+
+    def add(self, x):
+        x = float(x)
+        if self.q is None:
+            self._buf.append(x)
+            if len(self._buf) == self.n_exact:
+                self._init_markers()
+            return
+
+        q, n = self.q, self.n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k+1]:
+                k += 1
+        for i in xrange(k+1, 5):
+            n[i] += 1
+        for i in xrange(5):
+            self.np[i] += self.dn[i]
+
+        # adjust the middle markers towards their desired positions
+        for i in (1, 2, 3):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i+1] - n[i] > 1) or (d <= -1 and n[i-1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = q[i] + float(d) / (n[i+1] - n[i-1]) * (
+                    (n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i]) +
+                    (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+                if not q[i-1] < qp < q[i+1]:  # parabolic overshoots: linear
+                    qp = q[i] + d * (q[i+d] - q[i]) / (n[i+d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    def value(self):
+        if self.q is not None:
+            return self.q[2]
+        if not self._buf:
+            return float('nan')
+        buf = sorted(self._buf)
+        pos = self.p * (len(buf) - 1)
+        lo = int(pos)
+        hi = min(lo + 1, len(buf) - 1)
+        return buf[lo] + (pos - lo) * (buf[hi] - buf[lo])
+#}}}
+
+#{{{ IRBaselineTracker
+class IRBaselineTracker(object):
+    '''
+    follows slow drift of each IR channel's no-bee level during a run, and
+    moves the thresholds from a calibration (`calib_data`) by as much.
+
+    A channel's baseline is only updated from readings that look unoccupied:
+    in the lower `band` of the range between baseline and threshold, for at
+    least `settle` readings in a row. It is an exponential average with time
+    constant `tau` (s), and drift is bounded to +/- `max_drift` times the
+    calibrated threshold.  Constant memory and work per reading.
+    '''
+    def __init__(self, calib_data, gain=1.2, tau=600.0, settle=5, band=0.5,
+                 max_drift=0.5):
+        self.thresh0 = [float(v) for v in calib_data['IR']]
+        base = calib_data.get('IR_mean')
+        if not base or len(base) != len(self.thresh0):
+            base = [t / gain for t in self.thresh0]
+        self.base0 = [float(v) for v in base]
+        self.baseline = list(self.base0)
+        self.thresh = list(self.thresh0)
+        self.tau = float(tau)
+        self.settle = int(settle)
+        self.band = float(band)
+        self.max_drift = [abs(max_drift * t) for t in self.thresh0]
+        self._quiet = [0] * len(self.thresh0)
+        self._last = None
+        self.n_updates = 0
+
+    def update(self, levels, now):
+        ''' feed one set of readings; returns the current thresholds '''
+        dt = 0.0 if self._last is None else now - self._last
+        self._last = now
+        if dt <= 0:
+            return self.thresh
+        a = 1.0 - math.exp(-dt / self.tau)
+
+        for i in xrange(min(len(levels), len(self.thresh))):
+            v = levels[i]
+            b = self.baseline[i]
+            if v > b + self.band * (self.thresh[i] - b):
+                self._quiet[i] = 0
+                continue
+            self._quiet[i] += 1
+            if self._quiet[i] < self.settle:
+                continue
+            d = b + a * (v - b) - self.base0[i]
+            lim = self.max_drift[i]
+            d = lim if d > lim else (-lim if d < -lim else d)
+            self.baseline[i] = self.base0[i] + d
+            self.thresh[i] = self.thresh0[i] + d
+            self.n_updates += 1
+        return self.thresh
+
+    def drift(self):
+        return [b - b0 for b, b0 in zip(self.baseline, self.base0)]
+#}}}
+
+
 class CalibrateSensors(object):
     TSTR_FMT = "%Y/%m/%d-%H:%M:%S-%Z"
+    CACHE_EXT = ".calib_cache"
 
-    def __init__(self, casu_name, logname, conf_file=None, DO_LOG=True):
+    def __init__(self, casu_name, logname, conf_file=None, DO_LOG=True,
+                 backend=None):
 
         self._rtc_pth, self._rtc_fname = os.path.split(casu_name)
         if self._rtc_fname.endswith('.rtc'):
@@ -23,9 +220,12 @@ class CalibrateSensors(object):
 
         self.logname = logname
 
-        self._casu = casu.Casu(rtc_file_name=os.path.join(self._rtc_pth, self.name + ".rtc"), log=DO_LOG)
+        self.backend = AssisiBackend() if backend is None else backend
+        self.clock = self.backend.clock
+        self._casu = self.backend.make_casu(
+            rtc_file_name=os.path.join(self._rtc_pth, self.name + ".rtc"), log=DO_LOG)
         self.calib_data = {}
-        self.update_calib_time(time.time())
+        self.update_calib_time(self.clock.time())
         self.calib_data['IR'] = []
 
     def update_calib_time(self, now_time):
@@ -47,50 +247,208 @@ class CalibrateSensors(object):
         self.calib_gain   = _ir.get('calib_gain', 1.2)
         self.t_interval   = _ir.get('t_interval', 0.1)
         self.min_thresh   = _ir.get('min_thresh', 3.14)
+        # 'quantile': threshold from a high quantile of the readings plus a
+        # noise margin, stopping once it settles; 'max': the largest reading
+        # over all calib_steps (as before).
+        self.calib_method = _ir.get('method', 'quantile')
+        self.calib_quantile = float(_ir.get('quantile', 0.9))
+        self.calib_margin = float(_ir.get('margin', 1.0))
+        self.min_steps    = int(_ir.get('min_steps', 10))
+        self.stable_steps = int(_ir.get('stable_steps', 5))
+        self.stable_tol   = float(_ir.get('stable_tol', 0.02))
+        if self.calib_method not in ('quantile', 'max'):
+            raise ValueError("unknown IR calibration method {!r}".format(self.calib_method))
+        # reuse the last thresholds if younger than this (s); 0 to always calibrate
+        self.cache_max_age = float(self._conf.get('cache_max_age', 0.0))
+        # readings taken to check the sensors still match a cached calibration
+        self.cache_check_reads = int(self._conf.get('cache_check_reads', 3))
 
         if self.verb > 4: print "[I] read config from {}".format(conf_file)
 
 
 
-    def calibrate(self):
+    def calibrate(self, max_age=None):
         '''
         wrapper for all calibration procedures.
+
+        If this CASU was calibrated less than `max_age` seconds ago (default:
+        cache_max_age from the config) with the same settings, the cached
+        result is used instead of measuring again.  Fresh results are cached.
         '''
+        if max_age is None:
+            max_age = self.cache_max_age
+        if self.load_cache(max_age):
+            return
         self.calibrate_ir()
+        self.calib_data['source'] = 'measured'
+        self.save_cache()
 
+    #{{{ cache of the last calibration
+    def cache_filename(self):
+        return os.path.join(self._rtc_pth, self.name + self.CACHE_EXT)
 
-    def calibrate_ir(self):
+    def fingerprint(self):
         '''
-        read IR sensors several times, take the highest reading seen
-        as the threshold (with a multiplier)
-
+        identifies what a calibration is valid for: the CASU (name and the
+        contents of its .rtc file) and the calibration settings. This cannot
+        tell a swapped board or re-seated sensor; sensors_match() checks that.
+        '''
+        h = hashlib.sha1()
+        h.update(self.name)
+        try:
+            with open(os.path.join(self._rtc_pth, self.name + ".rtc"), 'rb') as f:
+                h.update(f.read())
+        except IOError:
+            pass
+        h.update(repr((self.calib_steps, float(self.calib_gain),
+                       float(self.t_interval), float(self.min_thresh))))
+        h.update(repr((self.calib_method, self.calib_quantile, self.calib_margin,
+                       self.min_steps, self.stable_steps, self.stable_tol)))
+        return h.hexdigest()
+
+    def save_cache(self):
+        data = dict(self.calib_data, fingerprint=self.fingerprint())
+        try:
+            with open(self.cache_filename(), 'w') as f:
+                yaml.safe_dump({self.name: data}, f, default_flow_style=False)
+        except (IOError, OSError) as e:
+            print "[W] could not cache calibration ({})".format(e)
+
+    def load_cache(self, max_age):
+        '''
+        use the cached calibration, if there is one for this CASU that is no
+        older than `max_age` seconds and has a matching fingerprint.
+        '''
+        if not max_age or max_age <= 0:
+            return False
+        try:
+            with open(self.cache_filename()) as f:
+                data = yaml.safe_load(f)[self.name]
+            thresholds = [float(v) for v in data['IR']]
+            age = self.clock.time() - float(data['date_raw'])
+            fp = data.get('fingerprint')
+        except (IOError, OSError, KeyError, TypeError, ValueError, yaml.YAMLError):
+            return False
+
+        if fp != self.fingerprint():
+            if self.verb > 0: print "[I] cached calibration of {} is for other settings".format(self.name)
+            return False
+        if age < 0 or age > max_age:
+            if self.verb > 0: print "[I] cached calibration of {} too old ({:.0f}s)".format(self.name, age)
+            return False
+        if not self.sensors_match(data.get('IR_mean'), thresholds):
+            return False
+
+        self.ir_thresholds = array(thresholds)
+        for k, v in data.items():
+            if k != 'fingerprint':
+                self.calib_data[k] = v
+        self.calib_data['IR'] = list(thresholds)
+        self.update_calib_time(float(data['date_raw']))
+        self.calib_data['source'] = 'cache'
+        print "[I] {} using calibration from {:.0f}s ago".format(self.name, age)
+        return True
+
+    def sensors_match(self, baseline, thresholds):
+        '''
+        a quick live check that the sensors read as the cached calibration
+        expects: the median of cache_check_reads readings must be within
+        (threshold - baseline) of the cached baseline on every sensor, i.e.
+        neither above the threshold nor as far below the baseline.  (A bee
+        sitting on a sensor also fails this; the CASU is then calibrated
+        afresh.)
+        '''
+        if not baseline or len(baseline) != len(thresholds):
+            print "[I] cached calibration of {} has no baseline to check against".format(self.name)
+            return False
+        reads = []
+        for i in xrange(max(1, self.cache_check_reads)):
+            if i:
+                self.clock.sleep(self.t_interval)
+            reads.append(self._casu.get_ir_raw_value(casu.ARRAY))
+        now = np.median(array(reads, dtype=float), axis=0)
+        for i, (v, b, t) in enumerate(zip(now, baseline, thresholds)):
+            tol = max(float(t) - float(b), self.min_thresh)
+            if abs(v - float(b)) > tol:
+                print "[I] {} IR sensor {} reads {:.1f}, cached baseline {:.1f} (+/-{:.1f}); recalibrating".format(
+                    self.name, i, v, float(b), tol)
+                return False
+        return True
+    #}}}
+
+
+    def ir_levels(self, stats, quants):
+        '''
+        level per sensor that a reading has to exceed to count as a bee:
+        with method 'max' the highest reading seen, otherwise the
+        `quantile` of the readings plus `margin` times its distance from the
+        median (a noise margin that, unlike the s.d., a few spikes do not
+        inflate). Never below min_thresh.
+        '''
+        if self.calib_method == 'max':
+            lvl = stats.max
+        else:
+            med = array([m.value() for m, q in quants])
+            hi = array([q.value() for m, q in quants])
+            lvl = hi + self.calib_margin * np.maximum(hi - med, 0.0)
+        return np.maximum(lvl, self.min_thresh)
+
+    def _settled(self, history):
+        ''' True once the levels changed by < stable_tol over stable_steps '''
+        if self.calib_method == 'max' or len(history) < max(self.min_steps, self.stable_steps + 1):
+            return False
+        now, before = history[-1], history[-1 - self.stable_steps]
+        return bool(np.all(np.abs(now - before) <= self.stable_tol * np.abs(now)))
 
+    def calibrate_ir(self):
+        '''
+        read IR sensors up to calib_steps times, keeping per-sensor streaming
+        statistics, and set thresholds from them (see ir_levels, with a
+        multiplier). Stops early when the levels have settled.
         '''
-        base_ir_thresholds = array([self.min_thresh] * 7) # default values
         if self.use_diag_led:
             self._casu.set_diagnostic_led_rgb(b=1, r=0, g=0)
 
+        stats = RunningStats()
+        quants = None
+        history = []
         # read sensors
         for stp in xrange(self.calib_steps):
             if self.verb > 4: print "calib step {}".format(stp)
-            for i, v in enumerate(self._casu.get_ir_raw_value(casu.ARRAY)):
-                if v > base_ir_thresholds[i]:
-                    base_ir_thresholds[i] = v
-
-            time.sleep(self.t_interval*0.9)
+            v = self._casu.get_ir_raw_value(casu.ARRAY)
+            stats.add(v)
+            if quants is None:
+                # exact up to min_steps, then P-square for the rest of the run
+                quants = [(P2Quantile(0.5, self.min_steps),
+                           P2Quantile(self.calib_quantile, self.min_steps)) for _ in v]
+            for (m, q), x in zip(quants, v):
+                m.add(x)
+                q.add(x)
+            history.append(self.ir_levels(stats, quants))
+            if self._settled(history):
+                if self.verb > 1: print "[I] {} calibration settled after {} steps".format(self.name, stats.n)
+                break
+
+            self.clock.sleep(self.t_interval*0.9)
             if self.use_diag_led:
                 self._casu.set_diagnostic_led_rgb(b=0, r=0.1, g=0.1)
-            time.sleep(self.t_interval*0.1)
+            self.clock.sleep(self.t_interval*0.1)
             if self.use_diag_led:
                 self._casu.set_diagnostic_led_rgb(b=1, r=0, g=0)
 
 
         # compute calibrate values
-        self.ir_thresholds = base_ir_thresholds * self.calib_gain
+        levels = history[-1] if history else array([self.min_thresh] * 7)
+        self.ir_thresholds = levels * self.calib_gain
         self.calib_data['IR'] = self.ir_thresholds.tolist()
+        if stats.n:
+            self.calib_data['IR_mean'] = stats.mean.tolist()
+            self.calib_data['IR_sd'] = stats.std.tolist()
+        self.calib_data['method'] = self.calib_method
+        self.calib_data['n_samples'] = stats.n
         if self.verb > 4: print "[I] will dump these values:", self.calib_data['IR']
 
-        self.update_calib_time(time.time())
+        self.update_calib_time(self.clock.time())
 
         # finish procedure
         if self.use_diag_led:
@@ -115,12 +473,14 @@ if __name__ == '__main__':
     parser.add_argument('name', )
     parser.add_argument('-c', '--conf', type=str, default=None)
     parser.add_argument('-o', '--output', type=str, default=None)
+    parser.add_argument('--max-age', type=float, default=None,
+                        help="reuse a cached calibration up to this old (s)")
     args = parser.parse_args()
 
     c = CalibrateSensors(args.name, logname=args.output, conf_file=args.conf)
     if c.verb > 0: print "Calibration - connected to {}".format(c.name)
     try:
-        c.calibrate()
+        c.calibrate(max_age=args.max_age)
         c.write_levels_to_file()
     except KeyboardInterrupt:
         c._casu.stop()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+an in-memory stand-in for a CASU, so the controllers can be run (profiled,
+benchmarked, debugged) without a bbg or the playground simulator.
+
+- FakeCasu implements the calls the controllers use: get_ir_raw_value,
+  get_temp, set_temp, temp_standby, get_peltier_setpoint, the diagnostic
+  LED calls, send_message/read_message and stop.
+- IR readings come from a scriptable trace, a function of (virtual) time;
+  see constant_ir, occupancy_ir and replay_ir.
+- temperatures follow a first-order model towards the setpoint (or ambient
+  when the peltier is off).
+- VirtualClock only moves when slept on, so a cycle costs only its compute
+  time: thousands of cycles run in seconds.
+- FakeNetwork passes messages between FakeCasus in the same process,
+  routed by the edge labels of an .nbg file as on the real system.
+
+A FakeBackend bundles these, and is passed to a controller in place of the
+default (assisipy) backend:
+
+    >>> be = FakeBackend(nbg_file='graz_setup.nbg')
+    >>> c = Enhancer('casu-031', logpath='/tmp', nbg_file='graz_setup.nbg',
+    ...              backend=be)
+
+or, from the command line, run controllers headless for a number of cycles:
+    $ python fake_casu.py casu-031 casu-032 --nbg graz_setup.nbg \
+        -c 2way_CATS_Left.conf -o /tmp/run --cycles 5000
+
+'''
+
+import argparse
+import bisect
+import collections
+import math
+import os
+import time
+
+#{{{ sensor/actuator constants (as assisipy.casu, which is used if present)
+try:
+    from assisipy.casu import (
+        IR_F, IR_FL, IR_BL, IR_B, IR_BR, IR_FR, TEMP_F, TEMP_L, TEMP_B, TEMP_R,
+        TEMP_TOP, TEMP_PCB, TEMP_RING, TEMP_WAX, TEMP_CASU, ARRAY)
+except ImportError:
+    IR_F, IR_FL, IR_BL, IR_B, IR_BR, IR_FR = range(6)
+    TEMP_F, TEMP_L, TEMP_B, TEMP_R, TEMP_TOP, TEMP_PCB, TEMP_RING, TEMP_WAX, \
+        TEMP_CASU = range(9)
+    ARRAY = -1
+
+N_IR = 7 # the array read includes one extra (unused) sensor
+#}}}
+
+#{{{ VirtualClock
+class VirtualClock(object):
+    '''
+    a clock that only advances when slept on.  Offers the same calls the
+    controllers use from the time module (time, sleep) plus monotonic, and
+    starts at the current wall time so log timestamps look normal.
+    '''
+    virtual = True
+
+    def __init__(self, start=None):
+        self.now = float(time.time() if start is None else start)
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        if secs > 0:
+            self.now += secs
+#}}}
+
+#{{{ FakeNetwork
+class FakeNetwork(object):
+    '''
+    delivers messages between FakeCasus in one process.
+
+    A CASU sends to an edge label (as written in the .nbg); `routes` maps
+    (sender, label) to the receiving CASU's name.  Labels without a route
+    are delivered to the CASU of that name, so with no routes at all the
+    label is simply the destination.  Receivers see the sender's name.
+
+    Each inbox keeps at most `max_queue` messages; the oldest are dropped
+    (and counted) beyond that, e.g. for a destination nobody reads.
+    '''
+    def __init__(self, routes=None, max_queue=1000):
+        self.routes = dict(routes or {})
+        self.max_queue = int(max_queue)
+        self.inboxes = {}
+        self.n_sent = 0
+        self.n_dropped = 0
+
+    @classmethod
+    def from_nbg(cls, nbg_file, **kwargs):
+        ''' routes as given by the edge labels of a (layered) .nbg file '''
+        import interactions
+        g_flat = interactions.load_flat_nbg(nbg_file)
+        routes = {}
+        for node in g_flat.nodes():
+            for dest, lbl in interactions.get_outmap(g_flat, str(node)).items():
+                routes[(str(node), lbl)] = dest
+        return cls(routes=routes, **kwargs)
+
+    def inbox(self, name):
+        if name not in self.inboxes:
+            self.inboxes[name] = collections.deque()
+        return self.inboxes[name]
+
+    def send(self, sender, label, data):
+        dest = self.routes.get((sender, label), label)
+        self.inject(dest, sender, data)
+        return True
+
+    def inject(self, dest, sender, data):
+        ''' deliver `data` to `dest` as if sent by `sender` '''
+        box = self.inbox(dest)
+        if len(box) >= self.max_queue:
+            box.popleft()
+            self.n_dropped += 1
+        box.append({'sender': sender, 'data': data})
+        self.n_sent += 1
+
+    def recv(self, name):
+        box = self.inboxes.get(name)
+        if box:
+            return box.popleft()
+        return None
+#}}}
+
+#{{{ IR traces -- functions of time returning the 7 raw readings
+def constant_ir(levels=100.0):
+    ''' the same readings at all times (a scalar or one value per sensor) '''
+    if not hasattr(levels, '__len__'):
+        levels = [levels] * N_IR
+    levels = [float(v) for v in levels]
+    return lambda t: levels
+
+def occupancy_ir(frac, baseline=100.0, occupied=5000.0, t0=None):
+    '''
+    `frac` (a number, or a function of the seconds since `t0`) of the six
+    used sensors see a bee; the rest read `baseline`.  Keep frac at 0 for
+    the first few seconds if the controller is to calibrate on this trace.
+    '''
+    state = {'t0': t0}
+    def trace(t):
+        if state['t0'] is None:
+            state['t0'] = t
+        f = frac(t - state['t0']) if callable(frac) else frac
+        n = int(round(min(max(f, 0.0), 1.0) * 6))
+        return [occupied] * n + [baseline] * (N_IR - n)
+    return trace
+
+def square_wave(period, lo=0.0, hi=1.0, delay=0.0):
+    ''' lo for the first `delay` seconds, then alternating hi/lo every period/2 '''
+    def f(t):
+        if t < delay:
+            return lo
+        return hi if ((t - delay) % period) < period / 2.0 else lo
+    return f
+
+def sine_wave(period, lo=0.0, hi=1.0, delay=0.0):
+    def f(t):
+        if t < delay:
+            return lo
+        return lo + (hi - lo) * 0.5 * (1 - math.cos(2 * math.pi * (t - delay) / period))
+    return f
+
+def replay_ir(logfile, delimiter=';', loop=True):
+    '''
+    replay the ir_array lines of a (text) controller log, aligned to the
+    first read.  Loops at the end of the log unless `loop` is False, in which
+    case the last readings are held.
+    '''
+    times, rows = [], []
+    with open(logfile) as f:
+        for line in f:
+            fields = line.strip().split(delimiter)
+            if fields[0] != 'ir_array':
+                continue
+            times.append(float(fields[1]))
+            rows.append([float(v) for v in fields[2:]] + [0.0] * (N_IR - len(fields[2:])))
+    if not rows:
+        raise ValueError("no ir_array lines in {}".format(logfile))
+    t_log0 = times[0]
+    times = [t - t_log0 for t in times]
+    span = times[-1] + (times[1] - times[0] if len(times) > 1 else 1.0)
+    state = {'t0': None}
+
+    def trace(t):
+        if state['t0'] is None:
+            state['t0'] = t
+        dt = t - state['t0']
+        if loop:
+            dt = dt % span
+        i = max(0, bisect.bisect_right(times, dt) - 1)
+        return rows[i]
+    return trace
+#}}}
+
+#{{{ FakeCasu
+class FakeCasu(object):
+    '''
+    in-memory CASU: the subset of assisipy.casu.Casu used by the controllers.
+    '''
+    AMBIENT   = 26.0   # degrees, when the peltier is off
+    TAU       = 30.0   # seconds, time constant of the temperature model
+
+    def __init__(self, name, clock=None, network=None, ir_trace=None,
+                 ambient=None, tau=None):
+        self.name = name
+        self.clock = VirtualClock() if clock is None else clock
+        self.network = FakeNetwork() if network is None else network
+        self.ir_trace = constant_ir() if ir_trace is None else ir_trace
+        self.ambient = float(self.AMBIENT if ambient is None else ambient)
+        self.tau = float(self.TAU if tau is None else tau)
+
+        self._temp = self.ambient
+        self._t_model = self.clock.time()
+        self._setpoint = self.ambient
+        self._peltier_on = False
+        self._led = [0.0, 0.0, 0.0]
+        self.stopped = False
+
+        # stats
+        self.n_ir_reads = 0
+        self.n_sent = 0
+        self.n_read = 0
+
+    #{{{ sensors
+    def get_ir_raw_value(self, sensor):
+        self.n_ir_reads += 1
+        levels = list(self.ir_trace(self.clock.time()))
+        if sensor == ARRAY:
+            return levels
+        return levels[sensor]
+
+    def _update_temp(self):
+        now = self.clock.time()
+        dt = now - self._t_model
+        if dt > 0:
+            target = self._setpoint if self._peltier_on else self.ambient
+            self._temp = target + (self._temp - target) * math.exp(-dt / self.tau)
+            self._t_model = now
+        return self._temp
+
+    def get_temp(self, sensor):
+        return self._update_temp()
+    #}}}
+
+    #{{{ actuators
+    def set_temp(self, temp):
+        self._update_temp()
+        self._setpoint = float(temp)
+        self._peltier_on = True
+
+    def temp_standby(self):
+        self._update_temp()
+        self._peltier_on = False
+
+    def get_peltier_setpoint(self):
+        return self._setpoint, self._peltier_on
+
+    def set_diagnostic_led_rgb(self, r=0, g=0, b=0):
+        self._led = [r, g, b]
+
+    def get_diagnostic_led_rgb(self):
+        return list(self._led)
+
+    def diagnostic_led_standby(self):
+        self._led = [0.0, 0.0, 0.0]
+    #}}}
+
+    #{{{ messages
+    def send_message(self, direction, msg):
+        self.n_sent += 1
+        return self.network.send(self.name, direction, msg)
+
+    def read_message(self):
+        msg = self.network.recv(self.name)
+        if msg is not None:
+            self.n_read += 1
+        return msg
+    #}}}
+
+    def stop(self):
+        self.stopped = True
+#}}}
+
+#{{{ FakeBackend
+class FakeBackend(object):
+    '''
+    creates FakeCasus that share one virtual clock and one network; pass as
+    `backend` to a controller (or CalibrateSensors).
+
+    `ir_traces` maps CASU names to IR traces; others get `default_ir`.
+    '''
+    def __init__(self, clock=None, network=None, nbg_file=None,
+                 ir_traces=None, default_ir=None, **casu_kw):
+        self.clock = VirtualClock() if clock is None else clock
+        if network is None:
+            if nbg_file is not None:
+                network = FakeNetwork.from_nbg(nbg_file)
+            else:
+                network = FakeNetwork()
+        self.network = network
+        self.ir_traces = dict(ir_traces or {})
+        self.default_ir = default_ir
+        self.casu_kw = casu_kw
+        self.casus = {}
+
+    def make_casu(self, rtc_file_name, log=False):
+        name = os.path.basename(rtc_file_name)
+        if name.endswith('.rtc'):
+            name = name[:-4]
+        if name not in self.casus:
+            self.casus[name] = FakeCasu(
+                name, clock=self.clock, network=self.network,
+                ir_trace=self.ir_traces.get(name, self.default_ir),
+                **self.casu_kw)
+        return self.casus[name]
+#}}}
+
+#{{{ run_headless
+def run_headless(ctrls, n_cycles, clock):
+    '''
+    run every controller in `ctrls` once per MAIN_LOOP_INTERVAL (of the
+    first) for `n_cycles`, on the virtual clock.  Returns the wall time taken.
+    '''
+    import libcas
+    sched = libcas.CycleScheduler(
+        ctrls[0].MAIN_LOOP_INTERVAL, clock=clock.monotonic, sleep=clock.sleep)
+    def step():
+        for c in ctrls:
+            c.one_cycle()
+    t0 = libcas.monotonic()
+    sched.run(step, n_cycles=n_cycles)
+    return libcas.monotonic() - t0
+#}}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="run CASU controllers against in-memory CASUs")
+    parser.add_argument('names', nargs='+')
+    parser.add_argument('-c', '--conf', type=str, default=None)
+    parser.add_argument('--calib-conf', type=str, default=None)
+    parser.add_argument('-o', '--output', type=str, default=None)
+    parser.add_argument('--nbg', type=str, default=None, required=True)
+    parser.add_argument('--ctrl', choices=['enh', 'dual'], default='dual')
+    parser.add_argument('--cycles', type=int, default=1000)
+    parser.add_argument('--occupancy-period', type=float, default=120.0,
+                        help="seconds per cycle of the (sine) bee occupancy")
+    parser.add_argument('--fast-restart', action='store_true')
+    args = parser.parse_args()
+
+    if args.ctrl == 'dual':
+        from multi_input import EnhancerDualInput as Ctrl
+    else:
+        from mini_enh import Enhancer as Ctrl
+
+    be = FakeBackend(nbg_file=args.nbg, default_ir=occupancy_ir(
+        sine_wave(args.occupancy_period, delay=10.0)))
+    ctrls = [Ctrl(name, logpath=args.output, conf_file=args.conf,
+                  calib_conf=args.calib_conf, nbg_file=args.nbg, backend=be,
+                  fast_restart=args.fast_restart or None)
+             for name in args.names]
+
+    try:
+        elapsed = run_headless(ctrls, args.cycles, be.clock)
+    finally:
+        for c in ctrls:
+            c.stop()
+    n = args.cycles * len(ctrls)
+    print "[I] {} controller cycles in {:.2f}s ({:.0f} cycles/s)".format(
+        n, elapsed, n / max(elapsed, 1e-9))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+run the controllers of several CASUs in one process, e.g. all CASUs that a
+.dep file places on one bbg.
+
+Compared with one interpreter per CASU, the imports (numpy, yaml...) and
+the parsed .nbg graph are shared, calibration of all CASUs runs
+concurrently, and one thread runs every controller's main loop
+(see libcas.SharedScheduler).  Each CASU keeps its own log, sync log and
+calibration log (<casu>_calib_log).
+
+The CASUs to run are the .dep entries whose hostname is this host (or
+--host), optionally narrowed with --casus; their `args` and `controller`
+are used as assisirun would.  Files named in the args are looked up next to
+the .dep file, and <casu>.rtc files in --rtc-dir.
+
+usage (on the bbg, in a directory with the deployed files):
+    $ python host_casus.py graz_setup.dep
+or to check which CASUs would be run, and how:
+    $ python host_casus.py ../../configs/2way/graz_setup.dep --host bbg-018 --list
+
+'''
+
+import argparse
+import os
+import shlex
+import socket
+import threading
+import yaml
+
+import libcas
+
+# controller script (as in the .dep file) -> module, class
+CONTROLLERS = {
+    'mini_enh.py'    : ('mini_enh', 'Enhancer'),
+    'multi_input.py' : ('multi_input', 'EnhancerDualInput'),
+}
+
+#{{{ read the deployment
+def read_dep(dep_file, host=None, casus=None):
+    '''
+    return (layer, casu name, spec) for the entries of `dep_file` placed on
+    `host` (all hosts if None), or named in `casus`.
+    '''
+    with open(dep_file) as f:
+        dep = yaml.safe_load(f)
+
+    found = []
+    for layer, entries in sorted(dep.items()):
+        for name, spec in sorted((entries or {}).items()):
+            if casus and name not in casus:
+                continue
+            if host is not None and not casus and spec.get('hostname') != host:
+                continue
+            ctrl = os.path.basename(str(spec.get('controller', '')))
+            if ctrl not in CONTROLLERS:
+                if casus:
+                    print "[W] {} uses {}, not a CASU controller; skipping".format(name, ctrl)
+                continue
+            found.append((layer, name, spec))
+    return found
+
+def parse_entry_args(spec, base_dir):
+    '''
+    the controller's command-line options from a .dep entry, with file names
+    resolved next to the .dep file (if they exist there)
+    '''
+    parser = argparse.ArgumentParser(prog=spec.get('controller'))
+    parser.add_argument('-c', '--conf', type=str, default=None)
+    parser.add_argument('-o', '--output', type=str, default=None)
+    parser.add_argument('--nbg', type=str, default=None)
+    argv = []
+    for a in spec.get('args', []) or []:
+        argv += shlex.split(str(a))
+    args = parser.parse_args(argv)
+    for k in ('conf', 'nbg'):
+        fn = getattr(args, k)
+        if fn is not None and not os.path.isabs(fn):
+            cand = os.path.join(base_dir, fn)
+            if os.path.exists(cand):
+                setattr(args, k, cand)
+    return args
+#}}}
+
+#{{{ CasuHost
+class CasuHost(object):
+    '''
+    creates a controller for each .dep entry, and runs them all together.
+    '''
+    def __init__(self, entries, base_dir, rtc_dir='.', logpath=None,
+                 backend=None, fast_restart=None, verb=1):
+        self.entries = entries
+        self.base_dir = base_dir
+        self.rtc_dir = rtc_dir
+        self.logpath = logpath
+        self.backend = backend
+        self.fast_restart = fast_restart
+        self.verb = verb
+        self.ctrls = []
+        self.failed = {}   # name -> exception, for CASUs stopped by an error
+
+    def _make(self, name, spec, results, errors):
+        try:
+            mod_name, cls_name = CONTROLLERS[os.path.basename(spec['controller'])]
+            cls = getattr(__import__(mod_name), cls_name)
+            args = parse_entry_args(spec, self.base_dir)
+            logpath = self.logpath if self.logpath is not None else args.output
+            results[name] = cls(
+                os.path.join(self.rtc_dir, name), logpath=logpath,
+                conf_file=args.conf, nbg_file=args.nbg, backend=self.backend,
+                calib_log="{}_calib_log".format(name), fast_restart=self.fast_restart)
+        except Exception as e:
+            errors[name] = e
+
+    def start(self):
+        '''
+        create (and so calibrate) all controllers, concurrently. If any fail,
+        the others are stopped again and the first error is raised.
+        '''
+        results, errors = {}, {}
+        threads = []
+        for layer, name, spec in self.entries:
+            th = threading.Thread(target=self._make, args=(name, spec, results, errors),
+                                  name="init-{}".format(name))
+            th.start()
+            threads.append(th)
+        for th in threads:
+            th.join()
+
+        self.ctrls = [results[name] for _, name, _ in self.entries if name in results]
+        self.failed.update(errors)
+        if errors:
+            for name, e in errors.items():
+                print "[F] {} failed to start: {}".format(name, e)
+            self.stop()
+            raise errors.values()[0]
+        if self.verb > 0:
+            print "[I] host {} running {}".format(
+                socket.gethostname(), ", ".join(c.name for c in self.ctrls))
+
+    def _task_failed(self, sched, e):
+        c = self._by_sched[sched]
+        print "[F] {} stopped after an error in its cycle: {!r}".format(c.name, e)
+        self.failed[c.name] = e
+        c.stop()
+
+    def run(self, n_cycles=None):
+        '''
+        every controller on its own deadlines, on one thread. A controller
+        whose cycle raises is stopped and the others carry on; those are
+        listed at the end (and in `failed`).
+        '''
+        scheds = [c.make_scheduler() for c in self.ctrls]
+        self._by_sched = dict(zip(scheds, self.ctrls))
+        for c, sched in zip(self.ctrls, scheds):
+            c.scheduler = sched
+        self.scheduler = libcas.SharedScheduler(scheds, on_error=self._task_failed)
+        try:
+            self.scheduler.run([c.one_cycle for c in self.ctrls], n_cycles=n_cycles)
+        finally:
+            self.report()
+
+    def report(self):
+        if self.failed:
+            print "[W] {} of {} CASUs stopped after errors: {}".format(
+                len(self.failed), len(self.entries), ", ".join(
+                    "{} ({!r})".format(n, e) for n, e in sorted(self.failed.items())))
+        elif self.verb > 0:
+            print "[I] all {} CASUs ran without errors".format(len(self.ctrls))
+
+    def stop(self):
+        for c in self.ctrls:
+            c.stop()
+#}}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="run the CASU controllers of one host in one process")
+    parser.add_argument('dep', help=".dep file describing the deployment")
+    parser.add_argument('--host', type=str, default=None,
+                        help="run the CASUs placed on this host (default: this machine)")
+    parser.add_argument('--casus', nargs='+', default=None,
+                        help="run these CASUs, whatever host they are placed on")
+    parser.add_argument('--rtc-dir', type=str, default='.')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help="log directory (default: as in the controller args)")
+    parser.add_argument('--list', action='store_true',
+                        help="only show which CASUs would be run")
+    parser.add_argument('--fast-restart', action='store_true',
+                        help="resume recent runs of these CASUs (see FAST_RESTART)")
+    args = parser.parse_args()
+
+    host = args.host or socket.gethostname()
+    entries = read_dep(args.dep, host=host, casus=args.casus)
+    base_dir = os.path.dirname(os.path.abspath(args.dep))
+    if not entries:
+        print "[W] no CASU controllers for host {} in {}".format(host, args.dep)
+    if args.list or not entries:
+        for layer, name, spec in entries:
+            print "{}/{}: {} {}".format(layer, name, spec.get('controller'),
+                                        " ".join(spec.get('args', []) or []))
+        raise SystemExit(0)
+
+    h = CasuHost(entries, base_dir, rtc_dir=args.rtc_dir, logpath=args.output,
+                 fast_restart=args.fast_restart or None)
+    h.start()
+    try:
+        h.run()
+    except KeyboardInterrupt:
+        print "shutting down casus on {}".format(host)
+    h.stop()
+    print "[I] host {} - done".format(host)
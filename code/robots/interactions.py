@@ -1,6 +1,366 @@
 
-import pygraphviz as pgv
 import os
+import re
+import threading
+import hashlib
+import argparse
+import yaml
+# .nbg files are read with the built-in parser below; pygraphviz is only
+# imported if asked for (parser='pgv'), e.g. to cross-check.
+
+#{{{ SimpleDigraph -- the part of the pygraphviz AGraph interface we use
+class _Edge(object):
+    __slots__ = ('attr', )
+    def __init__(self):
+        self.attr = {}
+
+class SimpleDigraph(object):
+    '''
+    a directed graph with string attributes on edges, offering the calls
+    used on pygraphviz AGraphs here: nodes, edges, in_edges, out_edges,
+    get_edge(s, d).attr, add_node, add_edge and `in`.  Nodes and edges keep
+    insertion order; adding an edge that exists returns the existing one.
+    '''
+    def __init__(self, name=None):
+        self.name = name
+        self._adj = {}     # node -> (out edges, in edges)
+        self._node_list = []
+        self._edges = {}   # (src, dest) -> _Edge
+        self._edge_list = []
+
+    def add_node(self, n):
+        if n not in self._adj:
+            self._adj[n] = ([], [])
+            self._node_list.append(n)
+
+    def add_edge(self, s, d):
+        key = (s, d)
+        e = self._edges.get(key)
+        if e is None:
+            adj = self._adj
+            if s not in adj:
+                adj[s] = ([], [])
+                self._node_list.append(s)
+            if d not in adj:
+                adj[d] = ([], [])
+                self._node_list.append(d)
+            e = self._edges[key] = _Edge()
+            self._edge_list.append(key)
+            adj[s][0].append(key)
+            adj[d][1].append(key)
+        return e
+
+    def get_edge(self, s, d):
+        return self._edges[(s, d)]
+
+    def nodes(self):
+        return list(self._node_list)
+
+    def edges(self):
+        return list(self._edge_list)
+
+    def out_edges(self, n):
+        return list(self._adj[n][0]) if n in self._adj else []
+
+    def in_edges(self, n):
+        return list(self._adj[n][1]) if n in self._adj else []
+
+    def __contains__(self, n):
+        return n in self._adj
+
+    def __len__(self):
+        return len(self._node_list)
+#}}}
+
+#{{{ read_nbg -- parser for the DOT subset used in .nbg files
+class NbgSyntaxError(ValueError):
+    pass
+
+_Q  = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+_ID = r'[A-Za-z_\x80-\xff][\w\x80-\xff]*|-?(?:\.[0-9]+|[0-9]+(?:\.[0-9]*)?)'
+# one token per match: skipped whitespace/comments (#, //, /* */), a quoted
+# id, a bare id or numeral, an operator/punctuation, a whole [attr list],
+# or an invalid character. Each alternative that is kept has its own group.
+_TOKEN_RE = re.compile(r"""
+      (?:\s+|\#[^\n]*|//[^\n]*|/\*.*?\*/)
+    | ({q})
+    | ({id})
+    | (->|--|[{{}}=;,])
+    | (\[[^\]"]*(?:{q}[^\]"]*)*\])
+    | (.)
+    """.format(q=_Q, id=_ID), re.X | re.S)
+_ATTR_RE = re.compile(r'\s*({q}|{id})\s*(?:=\s*({q}|{id}))?\s*[;,]?'.format(q=_Q, id=_ID), re.S)
+_ATTRS_OK_RE = re.compile(r'(?:\s*(?:{q}|{id})\s*(?:=\s*(?:{q}|{id}))?\s*[;,]?)*\s*\Z'.format(q=_Q, id=_ID), re.S)
+_KEYWORDS = frozenset(['strict', 'graph', 'digraph', 'subgraph', 'node', 'edge'])
+
+def _unquote(v):
+    if v[:1] == '"':
+        return v[1:-1].replace('\\"', '"')
+    return v
+
+def _tokenize(buf):
+    '''
+    two lists: token kinds ('id', a keyword, the operator/punctuation
+    itself, or 'attrs') and values (the id string, or the text inside [])
+    '''
+    kinds, vals = [], []
+    for quoted, word, punct, attrs, bad in _TOKEN_RE.findall(buf):
+        if quoted:
+            kinds.append('id')
+            vals.append(quoted[1:-1].replace('\\"', '"'))
+        elif word:
+            low = word.lower()
+            kinds.append(low if low in _KEYWORDS else 'id')
+            vals.append(word)
+        elif punct:
+            kinds.append(punct)
+            vals.append(punct)
+        elif attrs:
+            kinds.append('attrs')
+            vals.append(attrs[1:-1])
+        elif bad:
+            kinds.append('bad')
+            vals.append(bad)
+    return kinds, vals
+
+def _token_line(buf, i):
+    ''' line number of the i-th token (only used for error messages) '''
+    n = 0
+    for m in _TOKEN_RE.finditer(buf):
+        if m.lastindex is None:
+            continue
+        if n == i:
+            return buf.count('\n', 0, m.start()) + 1
+        n += 1
+    return buf.count('\n') + 1
+
+def parse_nbg(buf, flat=False):
+    '''
+    parse the text of an .nbg file into a (layered) SimpleDigraph, or with
+    `flat`, directly into the flattened graph (as flatten() would give).
+
+    Supports the DOT subset used for .nbg files: one (di)graph with nested
+    subgraphs, node and edge statements (including chains a -> b -> c),
+    attribute lists ([k=v; k=v] or [k=v, k=v]), graph attributes (k=v, not
+    kept), and node/edge attribute defaults, scoped per subgraph.  Node ids
+    are kept whole (e.g. "bee-arena/casu-031") unless `flat`.
+    '''
+    kinds, vals = _tokenize(buf)
+    if flat:
+        stripped = {}
+        for j, v in enumerate(vals):
+            if kinds[j] == 'id' and '/' in v:
+                w = stripped.get(v)
+                if w is None:
+                    w = stripped[v] = v.split('/')[-1]
+                vals[j] = w
+    n = len(kinds)
+    attr_memo = {}
+    state = {'i': 0}
+
+    def error(msg, i):
+        raise NbgSyntaxError("{} at line {}".format(msg, _token_line(buf, i)))
+
+    def attrs_at(i):
+        ''' parse consecutive [..] lists from token i; returns (pairs, next i) '''
+        pairs = []
+        while i < n and kinds[i] == 'attrs':
+            txt = vals[i]
+            p = attr_memo.get(txt)
+            if p is None:
+                if not _ATTRS_OK_RE.match(txt):
+                    error("bad attribute list [{}]".format(txt), i)
+                p = attr_memo[txt] = [(_unquote(k), _unquote(v) if v else 'true')
+                                      for k, v in _ATTR_RE.findall(txt) if k]
+            pairs += p
+            i += 1
+        return pairs, i
+
+    i = 0
+    if i < n and kinds[i] == 'strict':
+        i += 1
+    if i >= n or kinds[i] not in ('digraph', 'graph'):
+        error("expected 'digraph'", i)
+    i += 1
+    name = None
+    if i < n and kinds[i] == 'id':
+        name = vals[i]
+        i += 1
+    if i >= n or kinds[i] != '{':
+        error("expected '{'", i)
+    i += 1
+    g = SimpleDigraph(name)
+    add_edge = g.add_edge
+    # scopes of node/edge defaults, one per open brace
+    stack = [({}, {})]
+    while stack:
+        if i >= n:
+            error("unexpected end of file", i)
+        k = kinds[i]
+        if k == 'id':
+            first = vals[i]
+            i += 1
+            if i < n and kinds[i] == '=':     # graph attribute, not used
+                if i + 1 >= n or kinds[i + 1] != 'id':
+                    error("expected a value", i + 1)
+                i += 2
+                continue
+            chain = [first]
+            while i < n and (kinds[i] == '->' or kinds[i] == '--'):
+                if i + 1 >= n or kinds[i + 1] != 'id':
+                    error("only node ids are supported as edge operands", i + 1)
+                chain.append(vals[i + 1])
+                i += 2
+            pairs, i = attrs_at(i)
+            if len(chain) == 1:
+                g.add_node(first)
+                continue
+            edge_defaults = stack[-1][1]
+            for j in xrange(len(chain) - 1):
+                a = add_edge(chain[j], chain[j + 1]).attr
+                if edge_defaults:
+                    a.update(edge_defaults)
+                a.update(pairs)
+        elif k == ';' or k == ',':
+            i += 1
+        elif k == '}':
+            stack.pop()
+            i += 1
+        elif k == 'subgraph' or k == '{':
+            if k == 'subgraph':
+                i += 1
+                if i < n and kinds[i] == 'id':
+                    i += 1
+                if i >= n or kinds[i] != '{':
+                    error("expected '{'", i)
+            i += 1
+            stack.append((dict(stack[-1][0]), dict(stack[-1][1])))
+        elif k == 'node' or k == 'edge' or k == 'graph':
+            pairs, i = attrs_at(i + 1)
+            if k == 'node':
+                stack[-1][0].update(pairs)
+            elif k == 'edge':
+                stack[-1][1].update(pairs)
+        else:
+            error("unexpected {!r}".format(vals[i]), i)
+    if i != n:
+        error("trailing input", i)
+    return g
+
+def read_nbg(nbg_file, flat=False):
+    with open(nbg_file) as f:
+        return parse_nbg(f.read(), flat=flat)
+#}}}
+
+_flat_cache = {}
+_flat_cache_lock = threading.Lock()
+
+def load_flat_nbg(nbg_file, parser='builtin'):
+    '''
+    read and flatten the .nbg file; cached, so controllers sharing a process
+    (see host_casus.py) parse each graph only once.  The returned graph is
+    shared -- treat it as read-only.  `parser` 'pgv' uses pygraphviz instead
+    of the built-in parser.
+    '''
+    return _load_flat(nbg_file, parser)[0]
+
+def _load_flat(nbg_file, parser='builtin'):
+    '''
+    (flattened graph, sha1 of the content it was parsed from). The cache is
+    only used while the file content is unchanged.
+    '''
+    with open(nbg_file, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha1(data).hexdigest()
+    key = (os.path.abspath(nbg_file), parser)
+    with _flat_cache_lock:
+        hit = _flat_cache.get(key)
+        if hit is not None and hit[0] == digest:
+            return hit[1], digest
+        if parser == 'pgv':
+            import pygraphviz as pgv
+            g = flatten_AGraph(pgv.AGraph(string=data))
+        else:
+            g = parse_nbg(data, flat=True)
+        _flat_cache[key] = (digest, g)
+    return g, digest
+
+#{{{ compiled neighbourhoods
+# the in/out maps of one CASU, as computed from the .nbg, stored in a small
+# yaml file next to it (<nbg stem>.<casu>.nh) with the sha1 of the .nbg
+# content they came from.  Loading these needs no graph parsing.
+NH_EXT = '.nh'
+
+def nbg_digest(nbg_file):
+    with open(nbg_file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def nh_filename(nbg_file, casu, out_dir=None):
+    d, fn = os.path.split(nbg_file)
+    if out_dir is not None:
+        d = out_dir
+    return os.path.join(d, "{}.{}{}".format(os.path.splitext(fn)[0], casu, NH_EXT))
+
+def compile_neighbourhood(g_flat, casu, digest, nbg_file):
+    ''' the compiled form of `casu`'s neighbourhood, as a dict '''
+    in_map = get_inmap(g_flat, casu)
+    return {
+        'nbg_sha1' : digest,
+        'nbg_file' : os.path.basename(nbg_file),
+        'casu'     : casu,
+        'in_map'   : dict((str(k), {'w': float(v['w']), 'label': v['label']})
+                          for k, v in in_map.items()),
+        'out_map'  : dict((str(k), v) for k, v in get_outmap(g_flat, casu).items()),
+    }
+
+def write_neighbourhood(nh, fn):
+    with open(fn, 'w') as f:
+        yaml.safe_dump(nh, f, default_flow_style=False)
+
+def compile_nbg(nbg_file, casus=None, out_dir=None, verb=False):
+    '''
+    write the compiled neighbourhood of each node in `nbg_file` (or just
+    those in `casus`); returns the files written.
+    '''
+    g_flat, digest = _load_flat(nbg_file)
+    written = []
+    for node in g_flat.nodes():
+        casu = str(node)
+        if casus is not None and casu not in casus:
+            continue
+        fn = nh_filename(nbg_file, casu, out_dir)
+        write_neighbourhood(compile_neighbourhood(g_flat, casu, digest, nbg_file), fn)
+        if verb: print "[I] {} -> {}".format(casu, fn)
+        written.append(fn)
+    return written
+
+def load_neighbourhood(nbg_file, casu, verb=False):
+    '''
+    (in_map, out_map) for `casu`, as get_inmap/get_outmap would give from
+    the flattened `nbg_file`.  Uses the compiled file if it was made from the
+    same .nbg content; otherwise the .nbg is parsed and the compiled file
+    (re)written, if possible.
+    '''
+    digest = nbg_digest(nbg_file)
+    fn = nh_filename(nbg_file, casu)
+    try:
+        with open(fn) as f:
+            nh = yaml.safe_load(f)
+        if nh.get('nbg_sha1') == digest and nh.get('casu') == casu:
+            return nh['in_map'], nh['out_map']
+        if verb: print "[I] {} is stale, re-reading {}".format(fn, nbg_file)
+    except (IOError, OSError, AttributeError, KeyError, yaml.YAMLError):
+        pass
+
+    # the digest of what was parsed, in case the file changed meanwhile
+    g_flat, digest = _load_flat(nbg_file)
+    nh = compile_neighbourhood(g_flat, casu, digest, nbg_file)
+    try:
+        write_neighbourhood(nh, fn)
+    except (IOError, OSError) as e:
+        if verb: print "[W] could not write {} ({})".format(fn, e)
+    return nh['in_map'], nh['out_map']
+#}}}
 
 
 def get_outmap(fg, casu, verb=False):
@@ -69,7 +429,7 @@ def get_inmap(fg, casu, default_weight=None, verb=False):
 def show_inout(nbg):
     '''
     convenience function to display the comm network available to this casu
-    according to the nbg file. Accepts a pygraphviz graph.
+    according to the nbg file. Accepts a pygraphviz graph, or a SimpleDigraph.
     '''
 
     for casu in nbg.nodes():
@@ -101,6 +461,23 @@ def show_inout(nbg):
             my_recvfrom.append(src)
 
 
+def flatten(nbg):
+    '''
+    as flatten_AGraph, but returning a SimpleDigraph (and accepting either
+    kind of graph): layer prefixes are stripped from node names, and edge
+    attributes copied over.
+    '''
+    g = SimpleDigraph()
+    for _n in nbg.nodes():
+        g.add_node(str(_n).split('/')[-1])
+    for _src, _dest in nbg.edges():
+        s = str(_src).split('/')[-1]
+        d = str(_dest).split('/')[-1]
+        e = g.add_edge(s, d)
+        e.attr.update(dict(nbg.get_edge(_src, _dest).attr))
+    return g
+
+
 def flatten_AGraph(nbg):
     '''
     process a multi-layer CASU interaction graph file and return
@@ -108,6 +485,7 @@ def flatten_AGraph(nbg):
 
     Note: does not support node properties!
     '''
+    import pygraphviz as pgv
     g = pgv.AGraph(directed=True, strict=False) # allow self-loops.
 
     for _n in nbg.nodes():
@@ -145,26 +523,18 @@ def flatten_AGraph(nbg):
 
 
 if __name__ == "__main__":
-    ''' mini test script '''
-
-    # load test nbg file (including layers)
-    f_nbg = "graz_setup.nbg"
-    nbg = pgv.AGraph(os.path.join("../", "2way_virt", f_nbg))
-
-    # flatten /strip out layers
-    g2 = flatten_AGraph(nbg)
-    # pick an arbitrary casu and show info
-    casu = g2.nodes()[0]
-    imap = get_inmap(g2, casu)
-    omap = get_outmap(g2, casu)
-
-    print casu, imap, omap
-
-    # also show comparisons of layered vs flattened graphs
-    if 1:
-        print "=" * 60
-        show_inout(nbg)
-        print "\n\n"
-        print "=" * 60
-        show_inout(g2)
-
+    parser = argparse.ArgumentParser(
+        description="show or compile the CASU neighbourhoods of .nbg files")
+    parser.add_argument('nbg', nargs='+')
+    parser.add_argument('--compile', action='store_true',
+                        help="write <nbg stem>.<casu>.nh for each CASU")
+    parser.add_argument('--casus', nargs='+', default=None)
+    parser.add_argument('-o', '--out-dir', type=str, default=None)
+    args = parser.parse_args()
+
+    for fn in args.nbg:
+        if args.compile:
+            compile_nbg(fn, casus=args.casus, out_dir=args.out_dir, verb=True)
+        else:
+            # show the in/out connections of each casu, flattened
+            show_inout(load_flat_nbg(fn))
@@ -12,12 +12,19 @@ specific experimental regimes as required.
 
 '''
 
-from assisipy import casu
+try:
+    from assisipy import casu
+except ImportError:
+    import fake_casu as casu # constants only; see calibration.AssisiBackend
 import os
 import yaml
 import time, datetime
+import threading
 import numpy as np
 import calibration
+import logwriter
+import binlog
+import msgcodec
 
 #{{{ push_data_1d utility
 def push_data_1d(arr, new):
@@ -25,6 +32,9 @@ def push_data_1d(arr, new):
     shift elements along one, and push new data onto the front. In-place
     operation. (since np.roll does not operate in-place, wrap as a function)
 
+    This is O(len(arr)) per push; for histories updated every cycle, use
+    HistBuffer instead.
+
     '''
     # we can't seem to use roll because it requires knowing the variable name
     # ahead of time and thus is not flexible.  MAybe I missed a trick but even
@@ -37,6 +47,684 @@ def push_data_1d(arr, new):
 
 #}}}
 
+#{{{ HistBuffer -- ring buffer for histories
+class HistBuffer(object):
+    '''
+    fixed-length history of scalar samples, accessed newest-first.
+
+    Pushing is O(1): instead of shifting every element along one (as
+    push_data_1d does), a head index is moved backwards around the
+    underlying array.  `h[0]` is the newest sample and `h[i]` the one
+    pushed i steps ago; slicing returns an ordered copy, so `h[0:valid]`
+    behaves as it did on a plain shifted array.
+    '''
+    def __init__(self, length, fill=0.0):
+        self.length = int(length)
+        self._data = np.zeros(self.length,) + fill
+        self._head = 0
+        self.n_pushed = 0
+
+    def push(self, new):
+        self._head = (self._head - 1) % self.length
+        self._data[self._head] = new
+        self.n_pushed += 1
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.ordered()[key]
+        if key < 0:
+            key += self.length
+        if key < 0 or key >= self.length:
+            raise IndexError("history index out of range")
+        return self._data[(self._head + key) % self.length]
+
+    def ordered(self):
+        '''
+        return a newest-first copy of the whole history (e.g. for logging)
+        '''
+        return np.concatenate((self._data[self._head:], self._data[:self._head]))
+
+    def tolist(self):
+        return self.ordered().tolist()
+#}}}
+
+#{{{ WindowedHist -- ring buffer with running sums over several windows
+class WindowedHist(HistBuffer):
+    '''
+    HistBuffer that also keeps a running sum over each of several windows,
+    so a windowed mean costs O(1) per push instead of O(window).
+
+    `windows` maps a label to a window length in samples (each must fit in
+    the buffer).  The sums are recomputed from the buffer every `resync`
+    pushes, so rounding error cannot build up over long experiments.
+    '''
+    RESYNC_PUSHES = 1000
+
+    def __init__(self, length, windows, fill=0.0, resync=None):
+        HistBuffer.__init__(self, length, fill=fill)
+        self.windows = {}
+        self._sums = {}
+        for lbl, w in windows.items():
+            w = int(w)
+            if w < 1 or w > self.length:
+                raise ValueError("window {} of length {} does not fit in {} len buffer".format(
+                    lbl, w, self.length))
+            self.windows[lbl] = w
+            self._sums[lbl] = fill * w
+        self.resync = self.RESYNC_PUSHES if resync is None else int(resync)
+
+    def push(self, new):
+        # the sample at position w-1 falls out of each window on this push
+        for lbl, w in self.windows.iteritems():
+            self._sums[lbl] += new - self._data[(self._head + w - 1) % self.length]
+        HistBuffer.push(self, new)
+        if self.resync and (self.n_pushed % self.resync) == 0:
+            self.resync_sums()
+
+    def resync_sums(self):
+        for lbl, w in self.windows.iteritems():
+            idx = (self._head + np.arange(w)) % self.length
+            self._sums[lbl] = float(self._data[idx].sum())
+
+    def window_sum(self, lbl):
+        return self._sums[lbl]
+
+    def mean(self, lbl, valid=None):
+        '''
+        mean over the newest `valid` samples of window `lbl` (default: all
+        samples pushed so far, up to the window length).
+        '''
+        w = self.windows[lbl]
+        if valid is None:
+            valid = min(self.n_pushed, w)
+        valid = min(int(valid), w)
+        if valid < 1:
+            return 0.0
+        if valid < w and self.n_pushed > valid:
+            # the running sum covers more than was asked for; do it directly
+            idx = (self._head + np.arange(valid)) % self.length
+            return float(self._data[idx].sum()) / valid
+        return self._sums[lbl] / valid
+#}}}
+
+#{{{ NeighbourhoodStore -- all input histories in one matrix
+class NeighbourhoodStore(object):
+    '''
+    array-backed histories for every input source of a CASU (self, bee
+    neighbours, fish sources).
+
+    Each source is given a fixed row of one 2-D history matrix, with its own
+    head index (sources are not all pushed on the same cycles), weight and
+    averaging window.  Running sums are kept per window as in WindowedHist,
+    so smoothed values, contributions and the weighted sum over all inputs
+    are each a single vectorised operation.
+
+    usage: add_source() for every input, then build() once, then per cycle
+    push() new samples and update() with the cycle count.  At most one
+    sample per source may be pushed per cycle.
+    '''
+    def __init__(self, hist_len, extra_windows=None,
+                 resync=WindowedHist.RESYNC_PUSHES):
+        self.hist_len = int(hist_len)
+        self.extra_windows = dict(extra_windows or {})
+        self.resync = int(resync)
+        self.names = []
+        self.index = {}
+        self._src_w, self._src_avg, self._src_latest = [], [], []
+        self.built = False
+
+    def add_source(self, name, weight, avg_len, use_latest=False):
+        '''
+        register an input; its row is fixed from here on. If `use_latest`,
+        the newest sample (rather than the windowed mean) is weighted, e.g.
+        for inputs that are already smoothed by the sender.
+        '''
+        if self.built:
+            raise RuntimeError("cannot add source {} after build()".format(name))
+        if name in self.index:
+            raise ValueError("source {} already present in neighbourhood".format(name))
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self._src_w.append(float(weight))
+        self._src_avg.append(int(avg_len))
+        self._src_latest.append(bool(use_latest))
+        return self.index[name]
+
+    def build(self):
+        n = len(self.names)
+        self.labels = ['avg'] + sorted(self.extra_windows.keys())
+        win_len = [self._src_avg] + [
+            [int(self.extra_windows[lbl])] * n for lbl in self.labels[1:]]
+        self.win_len = np.array(win_len, dtype=int).reshape(len(self.labels), n)
+        if n and (self.win_len.max() > self.hist_len or self.win_len.min() < 1):
+            raise ValueError("averaging windows must fit in {} len buffers".format(self.hist_len))
+
+        self.hist      = np.zeros((n, self.hist_len))
+        self.heads     = np.zeros(n, dtype=int)
+        self.n_pushed  = np.zeros(n, dtype=int)
+        self.sums      = np.zeros((len(self.labels), n))
+        self.weights   = np.array(self._src_w, dtype=float)
+        self.use_latest = np.array(self._src_latest, dtype=bool)
+        self._all_rows = np.arange(n)
+        self._pushes   = 0
+
+        self.smoothed  = np.zeros(n)
+        self.latest    = np.zeros(n)
+        self.inputs    = np.zeros(n)
+        self.contribs  = np.zeros(n)
+        self.activation = 0.0
+        self.built = True
+
+    def rows(self, names):
+        return [self.index[name] for name in names]
+
+    def push(self, rows, values):
+        '''
+        push one new sample onto each of `rows` (no repeats within a call)
+        '''
+        if not len(rows):
+            return
+        rows = np.asarray(rows, dtype=int)
+        values = np.asarray(values, dtype=float)
+        L = self.hist_len
+        heads = self.heads[rows]
+        # the sample at position w-1 falls out of each window on this push
+        leaving = self.hist[rows[np.newaxis, :],
+                            (heads[np.newaxis, :] + self.win_len[:, rows] - 1) % L]
+        self.sums[:, rows] += values[np.newaxis, :] - leaving
+
+        heads = (heads - 1) % L
+        self.hist[rows, heads] = values
+        self.heads[rows] = heads
+        self.n_pushed[rows] += 1
+
+        self._pushes += 1
+        if self.resync and (self._pushes % self.resync) == 0:
+            self.resync_sums()
+
+    def resync_sums(self):
+        for k in xrange(len(self.labels)):
+            for r in self._all_rows:
+                idx = (self.heads[r] + np.arange(self.win_len[k, r])) % self.hist_len
+                self.sums[k, r] = self.hist[r, idx].sum()
+
+    def window_means(self, lbl, ts):
+        ''' mean of window `lbl` for every source, after `ts` cycles '''
+        k = self.labels.index(lbl)
+        valid = np.maximum(np.minimum(ts, self.win_len[k]), 1)
+        return self.sums[k] / valid
+
+    def update(self, ts):
+        '''
+        recompute smoothed values, the weighted inputs and their sum.
+        Returns the (unclipped) sum of contributions.
+        '''
+        self.smoothed = self.window_means('avg', ts)
+        self.latest = self.hist[self._all_rows, self.heads]
+        self.inputs = np.where(self.use_latest, self.latest, self.smoothed)
+        self.contribs = self.weights * self.inputs
+        self.activation = float(np.dot(self.weights, self.inputs))
+        return self.activation
+
+    def set_weight(self, name, w):
+        self.weights[self.index[name]] = float(w)
+
+    def view(self, attr, names=None):
+        return StoreView(self, attr, names)
+#}}}
+
+#{{{ StoreView -- dict-like access to one vector of a NeighbourhoodStore
+class StoreView(object):
+    '''
+    read-only, dict-like view by source name onto one of the vectors held by
+    a NeighbourhoodStore (e.g. 'smoothed'), optionally limited to some
+    sources.  Lets code keep using e.g. smoothed_bee_hist['self'].
+    '''
+    def __init__(self, store, attr, names=None):
+        self._store = store
+        self._attr = attr
+        self._names = list(store.names if names is None else names)
+
+    def __getitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        return getattr(self._store, self._attr)[self._store.index[name]]
+
+    def get(self, name, default=None):
+        if name in self._names:
+            return self[name]
+        return default
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def keys(self):
+        return list(self._names)
+
+    def items(self):
+        return [(name, self[name]) for name in self._names]
+#}}}
+
+#{{{ monotonic clock
+def _find_monotonic():
+    '''
+    time.monotonic is only in python3; otherwise use clock_gettime via
+    ctypes, and as a last resort fall back to wall-clock time.
+    '''
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes, ctypes.util
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        CLOCK_MONOTONIC = 1 # linux
+        for lib in [ctypes.util.find_library('rt'), ctypes.util.find_library('c')]:
+            if lib is None:
+                continue
+            clock_gettime = getattr(ctypes.CDLL(lib, use_errno=True), 'clock_gettime', None)
+            if clock_gettime is None:
+                continue
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+            def monotonic():
+                t = _timespec()
+                if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                    raise OSError(ctypes.get_errno(), "clock_gettime failed")
+                return t.tv_sec + t.tv_nsec * 1e-9
+            monotonic()
+            return monotonic
+    except (OSError, AttributeError, ImportError):
+        pass
+    print "[W] no monotonic clock available, using time.time"
+    return time.time
+
+monotonic = _find_monotonic()
+#}}}
+
+#{{{ CycleScheduler -- fixed-rate main loop
+class CycleScheduler(object):
+    '''
+    run a function on fixed-rate, absolute deadlines (t0 + k*interval) taken
+    from a monotonic clock, so the period does not stretch by however long
+    each cycle takes, and does not drift.
+
+    When a cycle runs past the next deadline (an overrun), `policy` decides:
+    - 'skip'    : missed deadlines are dropped, and the next cycle waits for
+                  the next deadline on the original grid
+    - 'catchup' : missed cycles are run back-to-back until back on schedule,
+                  but never more than `max_catchup` behind (the rest skipped)
+
+    Lateness (start time minus deadline), cycle durations, overruns and
+    skipped deadlines are accumulated and passed to `on_report` every
+    `report_interval` seconds (then reset).
+    '''
+    POLICIES = ('skip', 'catchup')
+
+    def __init__(self, interval, policy='skip', max_catchup=5,
+                 on_report=None, report_interval=10.0,
+                 clock=None, sleep=None):
+        if policy not in self.POLICIES:
+            raise ValueError("unknown overrun policy {}".format(policy))
+        self.interval = float(interval)
+        self.policy = policy
+        self.max_catchup = int(max_catchup)
+        self.on_report = on_report
+        self.report_interval = float(report_interval)
+        self.clock = monotonic if clock is None else clock
+        self.sleep = time.sleep if sleep is None else sleep
+        self.stopped = False
+        self.n_cycles = 0
+        self.n_overruns = 0
+        self.n_skipped = 0
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.stats = {'cycles': 0, 'overruns': 0, 'skipped': 0,
+                      'late_sum': 0.0, 'late_max': 0.0,
+                      'dur_sum': 0.0, 'dur_max': 0.0, }
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self, fn, n_cycles=None):
+        '''
+        call `fn` every interval until stop() (or `n_cycles` calls). The
+        first call is one interval after starting.
+        '''
+        self.start(fn)
+        while not self.stopped and (n_cycles is None or self.n_cycles < n_cycles):
+            now = self.clock()
+            if now < self.deadline:
+                self.sleep(self.deadline - now)
+            self.step()
+
+    def start(self, fn):
+        ''' set up to run `fn`, with the first deadline one interval away '''
+        self.fn = fn
+        self.deadline = self.clock() + self.interval
+        self._last_report = self.clock()
+
+    def step(self):
+        '''
+        run one (due) cycle, and work out the next deadline. For driving the
+        scheduler from outside, e.g. by a SharedScheduler.
+        '''
+        clock, st = self.clock, self.stats
+        now = clock()
+        self.fn()
+        end = clock()
+        self.n_cycles += 1
+        late, dur = now - self.deadline, end - now
+        st['cycles'] += 1
+        st['late_sum'] += late
+        st['dur_sum'] += dur
+        if late > st['late_max']: st['late_max'] = late
+        if dur > st['dur_max']: st['dur_max'] = dur
+
+        self.deadline += self.interval
+        if end > self.deadline:
+            st['overruns'] += 1
+            self.n_overruns += 1
+            behind = int((end - self.deadline) / self.interval) # whole slots missed
+            if self.policy == 'skip':
+                skip = behind + 1
+            else:
+                skip = max(0, behind - self.max_catchup)
+            self.deadline += skip * self.interval
+            st['skipped'] += skip
+            self.n_skipped += skip
+
+        if self.on_report is not None and end - self._last_report >= self.report_interval:
+            self.on_report(self.summary())
+            self._reset_stats()
+            self._last_report = end
+
+    def summary(self):
+        ''' stats since the last report, as a dict '''
+        st = self.stats
+        n = max(st['cycles'], 1)
+        return {
+            'cycles'   : st['cycles'],
+            'overruns' : st['overruns'],
+            'skipped'  : st['skipped'],
+            'late_mean': st['late_sum'] / n,
+            'late_max' : st['late_max'],
+            'dur_mean' : st['dur_sum'] / n,
+            'dur_max'  : st['dur_max'],
+        }
+#}}}
+
+#{{{ SharedScheduler -- several fixed-rate loops on one thread
+class SharedScheduler(object):
+    '''
+    runs several CycleSchedulers (e.g. one per controller, in one process)
+    from a single thread: sleep until the earliest deadline, run that
+    cycle, repeat.  Each keeps its own interval, overrun policy and stats.
+
+    If a task raises, `on_error(sched, exc)` is called and that task is
+    dropped, so the others keep running; without on_error it propagates.
+    The clock/sleep of the first scheduler are used.
+    '''
+    def __init__(self, scheds, on_error=None):
+        self.scheds = list(scheds)
+        self.on_error = on_error
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self, fns, n_cycles=None):
+        '''
+        `fns` are the cycle functions, one per scheduler; runs until stop(),
+        all tasks failed, or every task has done `n_cycles` cycles.
+        '''
+        for sched, fn in zip(self.scheds, fns):
+            sched.start(fn)
+        active = list(self.scheds)
+        if not active:
+            return
+        clock, sleep = active[0].clock, active[0].sleep
+        while not self.stopped and active:
+            sched = min(active, key=lambda sc: sc.deadline)
+            now = clock()
+            if now < sched.deadline:
+                sleep(sched.deadline - now)
+            try:
+                sched.step()
+            except Exception as e:
+                if self.on_error is None:
+                    raise
+                active.remove(sched)
+                self.on_error(sched, e)
+                continue
+            if n_cycles is not None and sched.n_cycles >= n_cycles:
+                active.remove(sched)
+#}}}
+
+#{{{ CycleProfiler -- opt-in timing of cycle phases
+class CycleProfiler(object):
+    '''
+    times each phase of a control cycle. Call begin() at the start of a
+    cycle, mark(phase) at the end of each phase (the time since the previous
+    mark is attributed to it) and end() at the end of the cycle.
+
+    The last `window` durations of every phase are kept in a HistBuffer, so
+    percentiles reflect recent behaviour; report() summarises them.  If
+    `trace` is set, phases are also recorded as Chrome/Perfetto trace events
+    (up to `max_events`) for write_trace().
+    '''
+    PERCENTILES = (50, 90, 99)
+    CYCLE = 'cycle'
+
+    def __init__(self, window=1000, trace=False, max_events=100000,
+                 track='casu', clock=None):
+        self.window = int(window)
+        self.trace = trace
+        self.max_events = int(max_events)
+        self.track = track
+        self.clock = monotonic if clock is None else clock
+        self.hists = {}
+        self.phases = []     # in order of first appearance
+        self.events = []
+        self.n_cycles = 0
+        self._t0 = self._last = self.clock()
+
+    def _record(self, phase, start, dur):
+        h = self.hists.get(phase)
+        if h is None:
+            h = self.hists[phase] = HistBuffer(self.window)
+            self.phases.append(phase)
+        h.push(dur)
+        if self.trace and len(self.events) < self.max_events:
+            self.events.append((phase, start, dur))
+
+    def begin(self):
+        self._t0 = self._last = self.clock()
+
+    def mark(self, phase):
+        now = self.clock()
+        self._record(phase, self._last, now - self._last)
+        self._last = now
+
+    def end(self):
+        now = self.clock()
+        self._record(self.CYCLE, self._t0, now - self._t0)
+        self.n_cycles += 1
+
+    def percentiles(self, phase):
+        h = self.hists[phase]
+        n = min(h.n_pushed, h.length)
+        return np.percentile(h.ordered()[0:n], self.PERCENTILES)
+
+    def report(self):
+        ''' one line per phase: samples, mean and percentiles, in ms '''
+        lines = ["# phase timings over last {} cycles (ms): n mean {}".format(
+            self.window, " ".join("p{}".format(q) for q in self.PERCENTILES))]
+        for phase in self.phases:
+            h = self.hists[phase]
+            n = min(h.n_pushed, h.length)
+            if not n:
+                continue
+            mean = h.ordered()[0:n].mean()
+            lines.append("{:14} {:6d} {:8.3f} ".format(phase, n, 1e3 * mean) +
+                         " ".join("{:8.3f}".format(1e3 * p) for p in self.percentiles(phase)))
+        return lines
+
+    def write_trace(self, filename):
+        '''
+        write recorded phases in Chrome trace-event JSON (chrome://tracing,
+        ui.perfetto.dev); one track per controller, cycles enclosing phases.
+        '''
+        import json
+        pid = os.getpid()
+        evs = [{'name': phase, 'ph': 'X', 'pid': pid, 'tid': self.track,
+                'ts': start * 1e6, 'dur': dur * 1e6}
+               for (phase, start, dur) in self.events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': evs, 'displayTimeUnit': 'ms'}, f)
+
+class NullProfiler(object):
+    ''' stands in for CycleProfiler when profiling is off '''
+    n_cycles = 0
+    def begin(self): pass
+    def mark(self, phase): pass
+    def end(self): pass
+#}}}
+
+#{{{ LedSequencer -- timed LED patterns off the control loop
+class LedSequencer(object):
+    '''
+    plays timed diagnostic-LED patterns (e.g. the sync flash) in a
+    background thread, so the control loop does not sleep through them.
+
+    The controller sets the LED through set(); the requested colour is
+    remembered, and while a pattern plays it is held back and then restored
+    at the end, so the main loop and the pattern never fight over the LED.
+    `lock` serialises commands to the CASU from both threads.
+
+    Edges are scheduled against the start of the pattern (not by stacking
+    sleeps), and each is reported to `on_edge(when, tag, label)` with the
+    time it was actually set.
+
+    With a virtual `clock` (see fake_casu.VirtualClock) time only moves
+    when the control loop sleeps, so patterns are applied at once and the
+    edges stamped with their scheduled times.
+    '''
+    def __init__(self, casu_dev, lock, on_edge=None, clock=None):
+        self._casu = casu_dev
+        self._lock = lock
+        self.on_edge = on_edge
+        self.clock = time if clock is None else clock
+        self.requested = tuple(casu_dev.get_diagnostic_led_rgb())
+        self.active = False
+        self._thread = None
+
+    def set(self, r=0.0, g=0.0, b=0.0):
+        with self._lock:
+            self.requested = (r, g, b)
+            if not self.active:
+                self._casu.set_diagnostic_led_rgb(r, g, b)
+
+    def play(self, pattern, dur_mult=1.0, tag=None, blocking=False):
+        '''
+        play `pattern`, a list of ((r, g, b), duration, label). Returns False
+        if a pattern is already playing.
+        '''
+        with self._lock:
+            if self.active:
+                return False
+            self.active = True
+        if getattr(self.clock, 'virtual', False):
+            self._play_virtual(pattern, dur_mult, tag)
+        elif blocking:
+            self._play(pattern, dur_mult, tag)
+        else:
+            self._thread = threading.Thread(
+                target=self._play, args=(pattern, dur_mult, tag))
+            self._thread.daemon = True
+            self._thread.start()
+        return True
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def _edge(self, rgb, tag, label):
+        with self._lock:
+            self._casu.set_diagnostic_led_rgb(*rgb)
+            when = self.clock.time()
+        if self.on_edge is not None:
+            self.on_edge(when, tag, label)
+
+    def _play(self, pattern, dur_mult, tag):
+        try:
+            due = monotonic()
+            for rgb, dur, label in pattern:
+                self._edge(rgb, tag, label)
+                due += dur * dur_mult
+                remain = due - monotonic()
+                if remain > 0:
+                    time.sleep(remain)
+        finally:
+            # put back whatever the controller asked for most recently
+            with self._lock:
+                self._casu.set_diagnostic_led_rgb(*self.requested)
+                self.active = False
+                when = self.clock.time()
+            if self.on_edge is not None:
+                self.on_edge(when, tag, "end")
+
+    def _play_virtual(self, pattern, dur_mult, tag):
+        when = self.clock.time()
+        with self._lock:
+            for rgb, dur, label in pattern:
+                self._casu.set_diagnostic_led_rgb(*rgb)
+                if self.on_edge is not None:
+                    self.on_edge(when, tag, label)
+                when += dur * dur_mult
+            self._casu.set_diagnostic_led_rgb(*self.requested)
+            self.active = False
+        if self.on_edge is not None:
+            self.on_edge(when, tag, "end")
+#}}}
+
+#{{{ SensorSnapshot -- all readings for one cycle
+class SensorSnapshot(object):
+    '''
+    the CASU readings used during one control cycle, taken together at the
+    start of the cycle and sharing one timestamp.  Consumers (IR counting,
+    logging, heat control, debug output) read from here instead of each
+    querying the CASU, so every value of a cycle refers to the same instant.
+    '''
+    RING_TEMPS = [casu.TEMP_L, casu.TEMP_R, casu.TEMP_B, casu.TEMP_F]
+
+    def __init__(self):
+        self.when = 0.0
+        self.ir_raw = []
+        self.temps = {}
+        self.setpoint = 0.0
+        self.peltier_on = False
+
+    def read(self, c, now=None):
+        self.when = time.time() if now is None else now
+        self.ir_raw = list(c.get_ir_raw_value(casu.ARRAY))
+        self.temps = dict((sensor, c.get_temp(sensor)) for sensor in self.RING_TEMPS)
+        self.setpoint, self.peltier_on = c.get_peltier_setpoint()
+        return self
+
+    def ring_temps(self):
+        return [self.temps[sensor] for sensor in self.RING_TEMPS]
+#}}}
+
 class BaseCASUCtrl(object):
     #{{{ class-level defaults for externally-set params
     MANUAL_CALIB_OVERRIDE = False # if leaving the bees in arena, while developing
@@ -48,6 +736,22 @@ class BaseCASUCtrl(object):
     AVG_HIST_LEN = 60
     HIST_LEN = 60
     MAX_MSG_AGE = 20
+    MSG_CODEC = 'text'        # 'text' or 'binary' for sent counts (see msgcodec.py)
+    MSG_PREFIX_BEECASU = ''   # text counts start with this
+    # counts to bee neighbours are only re-sent when they change by more than
+    # TX_DEADBAND, or TX_HEARTBEAT s passed; receivers hold the last value
+    # (up to MAX_MSG_AGE cycles). TX_HEARTBEAT 0 sends every cycle.
+    TX_DEADBAND  = 0.0
+    TX_HEARTBEAT = 0.0
+    # receivers re-use the last count from a neighbour each cycle until it is
+    # MAX_MSG_AGE cycles old (always so if TX_HEARTBEAT > 0); otherwise only
+    # cycles with a new message are counted, as the baseline did
+    RX_HOLD_LAST = False
+    TX_FISH_SUPPRESS = False  # also to the fish side (if it holds values too)
+    # per cycle, read at most this many messages / for this long (s); any
+    # others wait for the next cycle. Only the newest per sender is used.
+    RX_MAX_MSGS = 100
+    RX_MAX_TIME = 0.02
     MAX_SENSORS = 6.0
     SELF_WEIGHT = 1.0
     MIN_TEMP = 28.0
@@ -56,17 +760,33 @@ class BaseCASUCtrl(object):
     ENABLE_TEMP = True
     REF_DEVIATE = 0.5
     MAIN_LOOP_INTERVAL = 0.2
+    LOOP_OVERRUN_POLICY = 'skip'   # or 'catchup' (see CycleScheduler)
+    SCHED_REPORT_INTERVAL = 10.0   # seconds between SCHED log lines
     REF_UPDATE_INTERVAL = 10.0
     ENABLE_SUPPRESS_LOW = False
     EXOG_SIGNAL_WEAK_WEIGHT    = 1.5
     EXOG_SIGNAL_STRONG_WEIGHT  = 0.0
     EXOG_BONUS_START_MINS      = 10.0
-    EXP_CAMODEL_DELTATEMPS     = False  # Tref target relative(1) or absolute(0)
+    EXP_CAMODEL_DELTATEMPS     = False  # relative Tref targets: not supported
     EXOG_BIAS = 0.0
 
     SHOW_CALIB_LED_MINS = 0.5
+    CALIB_CACHE_MAX_AGE = None  # s; reuse a recent calibration (None: as calib conf)
+    FAST_RESTART    = False     # resume a recent run: cached calibration, same timeline
+    RESTART_MAX_AGE = 4 * 3600.0  # s; how recent a run/calibration can be resumed
+    # follow slow drift of the no-bee IR levels (calibration.IRBaselineTracker)
+    IR_BASELINE_TRACK  = False    # off unless enabled in the conf
+    IR_BASELINE_TAU    = 600.0    # s
+    IR_BASELINE_SETTLE = 5        # unoccupied readings in a row before updating
+    IR_BASELINE_BAND   = 0.5      # of baseline..threshold that counts as unoccupied
+    IR_DRIFT_MAX       = 0.5      # of the calibrated thresholds
+    IR_DRIFT_LOG_INTERVAL = 60.0  # s between IR_DRIFT log lines
     SYNCFLASH = True
     SYNC_INTERVAL = 20.0
+    # R/G/B flash: ((r, g, b), seconds, label for sync log)
+    SYNC_PATTERN = [((1.0, 0, 0), 0.05, "r_on"), ((0, 0, 0), 0.05, "r_off"),
+                    ((0, 1.0, 0), 0.10, "g_on"), ((0, 0, 0), 0.05, "g_off"),
+                    ((0, 0, 1.0), 0.15, "b_on"), ((0, 0, 0), 0.05, "b_off"), ]
     FREQ_RPT_INPUTS = 1
 
     INIT_NOHEAT_PERIOD_MINS  = 0.0
@@ -82,10 +802,21 @@ class BaseCASUCtrl(object):
     WEIGHT_INVERT_FACTOR     = -1.0
     WEIGHT_INVERT_ENABLE     = False
 
+    PROFILE_CYCLES   = False   # time each phase of one_cycle
+    PROFILE_WINDOW   = 1000    # cycles kept for percentiles
+    PROFILE_TRACE    = False   # also write a Chrome/Perfetto trace at stop
+    PROFILE_TRACE_MAX_EVENTS = 100000
+
     FISH_INPUT_NETWORK  = {}
     FISH_OUTPUT_NETWORK = {}
     FISH_HIST_LEN = 120
 
+    EXTRA_AVG_WINDOWS = {}   # label: seconds, averaged alongside AVG_HIST_LEN
+
+    LOG_FORMAT          = 'text'   # 'text' or 'binary' (see binlog.py)
+    LOG_FLUSH_INTERVAL  = 1.0      # seconds between flushes by the log writer
+    LOG_QUEUE_MAX_BYTES = 1 << 20  # lines beyond this are dropped, not blocked on
+
     #}}}
 
     #{{{ initialiser
@@ -109,11 +840,34 @@ class BaseCASUCtrl(object):
         # read all the configuration
         self.parse_conf(conf_file)
 
+        # settings the controllers do not implement; refuse to start rather
+        # than fail mid-experiment
+        if self.EXP_CAMODEL_DELTATEMPS:
+            raise ValueError("EXP_CAMODEL_DELTATEMPS (relative Tref targets) is not supported; "
+                             "remove it from {}".format(conf_file))
+
         # derived params/variables.
         self.T_RANGE  = self.MAX_TEMP - self.MIN_TEMP
         if self.AVG_HIST_LEN > self.HIST_LEN:
             print "[W] AVG_HIST_LEN of {} does not fit into {} len buffers, increasing".format(self.AVG_HIST_LEN, self.HIST_LEN)
             self.HIST_LEN = self.AVG_HIST_LEN
+        longest = max([0] + self.hist_windows(0).values())
+        if longest > self.HIST_LEN:
+            print "[W] EXTRA_AVG_WINDOWS need {} len buffers (HIST_LEN={}), increasing".format(longest, self.HIST_LEN)
+            self.HIST_LEN = longest
+
+    def hist_windows(self, avg_len):
+        '''
+        window lengths (in samples) to keep running averages over: the
+        main 'avg' window of `avg_len` plus any EXTRA_AVG_WINDOWS, which
+        are given in seconds and converted using MAIN_LOOP_INTERVAL.
+        '''
+        windows = {}
+        if avg_len:
+            windows['avg'] = int(avg_len)
+        for lbl, secs in self.EXTRA_AVG_WINDOWS.items():
+            windows[str(lbl)] = max(1, int(round(float(secs) / self.MAIN_LOOP_INTERVAL)))
+        return windows
 
     def _init_logging(self, logpath):
         # set up logging
@@ -122,8 +876,9 @@ class BaseCASUCtrl(object):
             self.logpath = "."
 
         self._logtime= time.strftime("%H:%M:%S-%Z", time.gmtime())
+        ext = "blog" if self.LOG_FORMAT == 'binary' else "log"
         self.logfile = os.path.join(
-            self.logpath, "{}-{}.log".format(self.name, self._logtime))
+            self.logpath, "{}-{}.{}".format(self.name, self._logtime, ext))
         self.setup_logger(append=False, delimiter=';')
 
     def _init_calibration(self, calib_conf, cal_logname="temp_calib_log"):
@@ -132,9 +887,13 @@ class BaseCASUCtrl(object):
         '''
         # run calibration procedure
         self.calibrator = calibration.CalibrateSensors(
-            casu_name=self.name, logname=cal_logname, conf_file=calib_conf)
+            casu_name=self.name, logname=cal_logname, conf_file=calib_conf,
+            backend=self.backend)
 
-        self.calibrator.calibrate()
+        max_age = self.CALIB_CACHE_MAX_AGE
+        if self.FAST_RESTART:
+            max_age = max(max_age or 0.0, self.RESTART_MAX_AGE)
+        self.calibrator.calibrate(max_age=max_age)
         self.calibrator.write_levels_to_file()
         self.calib_data = dict(self.calibrator.calib_data)
         if self.MANUAL_CALIB_OVERRIDE:
@@ -145,42 +904,134 @@ class BaseCASUCtrl(object):
             print "[I]{} we have IR calib thresholds of".format(self.name)
             print "[" + ",".join("{:.1f}".format(elem) for elem in self.calib_data['IR']) + "]"
 
+        self.ir_thresh = list(self.calib_data['IR'])
+        self.ir_baseline = None
+        if self.IR_BASELINE_TRACK and not self.MANUAL_CALIB_OVERRIDE:
+            self.ir_baseline = calibration.IRBaselineTracker(
+                self.calib_data, gain=self.calibrator.calib_gain,
+                tau=self.IR_BASELINE_TAU, settle=self.IR_BASELINE_SETTLE,
+                band=self.IR_BASELINE_BAND, max_drift=self.IR_DRIFT_MAX)
+        self._last_drift_log = self.clock.time()
+
         self.calibrator._casu.set_diagnostic_led_rgb(b=0.25, r=0, g=0)
         self.INIT_LED = True
         # see/set value of self.SHOW_CALIB_LED_MINS if default 0.5m not useful
 
-    def _init_common(self, casu_name, logpath, conf_file=None, calib_conf=None):
+    def _init_common(self, casu_name, logpath, conf_file=None, calib_conf=None,
+                     backend=None, calib_log=None, fast_restart=None):
         # basic setup - configuration, sensor calibration, loggin
+        # `backend` gives the casu device and clock; default is assisipy and
+        # the system clock (see calibration.AssisiBackend, fake_casu.FakeBackend)
+        self.backend = calibration.AssisiBackend() if backend is None else backend
+        self.clock = self.backend.clock
         self._init_casu_name(casu_name)
         self._init_config(conf_file)
+        if fast_restart is not None:
+            self.FAST_RESTART = fast_restart
         self._init_states()
-        self._init_calibration(calib_conf=calib_conf, cal_logname="temp_calib_log")
+        if calib_log is None:
+            calib_log = "temp_calib_log"
+        self._init_calibration(calib_conf=calib_conf, cal_logname=calib_log)
+        self._init_session()
         self._init_logging(logpath)
         self._init_synclog()
+        self._init_profiler()
+        self._init_msgs()
         # now attach to the casu device. (already attaced in the calib stage)
         self._casu = self.calibrator._casu
+        self._casu_lock = threading.Lock()
+        self.leds = LedSequencer(self._casu, self._casu_lock,
+                                 on_edge=self._log_sync_edge, clock=self.clock)
+        self.snap = SensorSnapshot()
+        self.take_snapshot()
         self.__stopped = False
 
+    def _init_msgs(self):
+        if self.MSG_CODEC not in ('text', 'binary'):
+            raise ValueError("unknown MSG_CODEC {}".format(self.MSG_CODEC))
+        self._tx_seq = {}
+        self.msg_stats = msgcodec.LinkStats()
+        self._tx_last = {}
+        self.rx_counts = dict.fromkeys(self.RX_LOG_FIELDS, 0)
+        self._rx_held = None   # read beyond the budget; first next cycle
+        self.n_tx_sent = 0
+        self.n_tx_suppressed = 0
+        if self.TX_HEARTBEAT >= self.MAX_MSG_AGE * self.MAIN_LOOP_INTERVAL:
+            print "[W] TX_HEARTBEAT of {}s is not within MAX_MSG_AGE ({} cycles); neighbours will see stale data".format(
+                self.TX_HEARTBEAT, self.MAX_MSG_AGE)
+
+    def _init_session(self):
+        '''
+        record when this run started (<casu>.session). With FAST_RESTART, a
+        run of this CASU that started less than RESTART_MAX_AGE ago is
+        resumed instead: the timed phases (INIT_*_PERIOD_MINS etc.) carry on
+        from its start, rather than starting over.
+        '''
+        fn = os.path.join(self._rtc_pth, self.name + ".session")
+        now = self.clock.time()
+        self.session_start = now
+        self.resumed = False
+        if self.FAST_RESTART:
+            try:
+                with open(fn) as f:
+                    start = float(yaml.safe_load(f)['start'])
+                if 0 <= now - start <= self.RESTART_MAX_AGE:
+                    self.session_start = start
+                    self.resumed = True
+                    print "[I][{}] resuming run started {:.0f}s ago".format(
+                        self.name, now - start)
+            except (IOError, OSError, KeyError, TypeError, ValueError, yaml.YAMLError):
+                pass
+        if not self.resumed:
+            try:
+                with open(fn, 'w') as f:
+                    yaml.safe_dump({'start': now, 'casu': self.name}, f,
+                                   default_flow_style=False)
+            except (IOError, OSError) as e:
+                print "[W] could not record session start ({})".format(e)
+
+    def _init_profiler(self):
+        if self.PROFILE_CYCLES:
+            self.prof = CycleProfiler(
+                window=self.PROFILE_WINDOW, trace=self.PROFILE_TRACE,
+                max_events=self.PROFILE_TRACE_MAX_EVENTS, track=self.name)
+        else:
+            self.prof = NullProfiler()
+
+    def _dump_profile(self):
+        if not self.PROFILE_CYCLES or not self.prof.n_cycles:
+            return
+        base = os.path.join(self.logpath, "{}-{}.prof".format(self.name, self._logtime))
+        lines = self.prof.report()
+        with open(base + ".txt", 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        print "[I]{} cycle profile:\n".format(self.name) + "\n".join(lines)
+        if self.PROFILE_TRACE:
+            self.prof.write_trace(base + ".trace.json")
+            print "[I] trace written to {}.trace.json".format(base)
+
     def _init_synclog(self):
         # should only be done after log is parsed - also logpath
         if self.SYNCFLASH:
             fn_synclog = '{}/{}-{}.sync.log'.format(
                 self.logpath, self.name, self._logtime)
-            self.synclog = open(fn_synclog, 'w', 0)
-            self.synclog.write("# started at {}\n".format(time.time()))
+            self.synclog = self.open_log_writer(fn_synclog, 'w')
+            self.synclog.write("# started at {}\n".format(self.clock.time()))
             self.sync_cnt = 0
-            self.last_synchflash_time = time.time()
+            self.last_synchflash_time = self.clock.time()
 
 
 
 
 
     def __init__(self, casu_name, logpath,
-                 conf_file=None, calib_conf=None):
+                 conf_file=None, calib_conf=None, backend=None, calib_log=None,
+                 fast_restart=None):
         self._init_common(casu_name, logpath, conf_file=conf_file,
-                          calib_conf=calib_conf)
+                          calib_conf=calib_conf, backend=backend,
+                          calib_log=calib_log, fast_restart=fast_restart)
 
-        self.init_upd_time = time.time()
+        self.init_upd_time = self.session_start
 
 
 
@@ -201,6 +1052,13 @@ class BaseCASUCtrl(object):
                 'AVG_HIST_LEN',
                 'HIST_LEN',
                 'MAX_MSG_AGE',
+                'MSG_CODEC',
+                'TX_DEADBAND',
+                'TX_HEARTBEAT',
+                'TX_FISH_SUPPRESS',
+                'RX_HOLD_LAST',
+                'RX_MAX_MSGS',
+                'RX_MAX_TIME',
                 'MAX_SENSORS',
                 'SELF_WEIGHT',
                 'MIN_TEMP',
@@ -210,7 +1068,18 @@ class BaseCASUCtrl(object):
                 'REF_UPDATE_INTERVAL',
                 'ENABLE_SUPPRESS_LOW',
                 'SHOW_CALIB_LED_MINS',
+                'CALIB_CACHE_MAX_AGE',
+                'FAST_RESTART',
+                'RESTART_MAX_AGE',
+                'IR_BASELINE_TRACK',
+                'IR_BASELINE_TAU',
+                'IR_BASELINE_SETTLE',
+                'IR_BASELINE_BAND',
+                'IR_DRIFT_MAX',
+                'IR_DRIFT_LOG_INTERVAL',
                 'MAIN_LOOP_INTERVAL',
+                'LOOP_OVERRUN_POLICY',
+                'SCHED_REPORT_INTERVAL',
                 'SYNCFLASH',
                 'SYNC_INTERVAL',
                 'EXP_CAMODEL_DELTATEMPS',
@@ -229,9 +1098,17 @@ class BaseCASUCtrl(object):
                 'WEIGHT_INVERT_TIME_MINS',
                 'WEIGHT_INVERT_FACTOR' ,
                 'WEIGHT_INVERT_ENABLE',
+                'PROFILE_CYCLES',
+                'PROFILE_WINDOW',
+                'PROFILE_TRACE',
+                'PROFILE_TRACE_MAX_EVENTS',
                 'FISH_INPUT_NETWORK',
                 'FISH_HIST_LEN',
                 'FISH_OUTPUT_NETWORK',
+                'EXTRA_AVG_WINDOWS',
+                'LOG_FORMAT',
+                'LOG_FLUSH_INTERVAL',
+                'LOG_QUEUE_MAX_BYTES',
 
                 ]:
 
@@ -253,15 +1130,56 @@ class BaseCASUCtrl(object):
         mode = 'a' if append else 'w'
         self._log_LINE_END = os.linesep # platform-independent line endings
         self._log_delimiter = delimiter
+        self._binlog = None
+        if self.LOG_FORMAT == 'binary':
+            self._binlog = binlog.BinaryLogEncoder()
+            mode += 'b'
+        elif self.LOG_FORMAT != 'text':
+            print "[W] unknown LOG_FORMAT {}, using text".format(self.LOG_FORMAT)
         try:
-            #self.log_fh = open(self.logfile, mode, 0) # 3rd value is buflen =wrote immediately.
-            self.log_fh = open(self.logfile, mode)
+            # lines are queued and written/flushed by a background thread,
+            # so the control loop does not wait on the SD card.
+            self.log_fh = self.open_log_writer(
+                self.logfile, mode, binary=self._binlog is not None)
         except IOError as e:
             print "[F] cannot open logfile ({})".format(e)
             raise
 
-        pass
-    def write_logline(self, ty=None, suffix=''):
+        if self._binlog is not None and not append:
+            self.log_fh.write(self._binlog.file_header(
+                self.clock.time(), self.name, self._states))
+
+    def open_log_writer(self, filename, mode='w', binary=False):
+        # a text drop marker would corrupt a binary log; the count of dropped
+        # records is reported at cleanup instead.
+        marker = None if binary else logwriter.BufferedLogWriter.DROP_MARKER
+        return logwriter.BufferedLogWriter(
+            filename, mode, flush_interval=self.LOG_FLUSH_INTERVAL,
+            max_bytes=self.LOG_QUEUE_MAX_BYTES, drop_marker=marker)
+
+    def write_comment(self, s):
+        ''' write a free-text (e.g. '# ...') line to the log '''
+        if self._binlog is not None:
+            self.log_fh.write(self._binlog.text(self.snap.when, s))
+        else:
+            self.log_fh.write(s + self._log_LINE_END)
+
+    def write_nh_data(self, names, weights, inputs, contribs):
+        '''
+        log the inputs to the activation, one group per source:
+        >>>ty, time, num_neigh, <who, weight, raw, contrib, > for each edge. <<<
+        (in binary logs the names are only written when they change)
+        '''
+        if self._binlog is not None:
+            self.log_fh.write(self._binlog.nh_data(
+                self.snap.when, names, weights, inputs, contribs))
+            return
+        _nh_fields = [len(names), ]
+        for i, neigh in enumerate(names):
+            _nh_fields += [neigh, weights[i], inputs[i], contribs[i]]
+        self.write_logline(ty="NH_DATA", values=_nh_fields)
+
+    def write_logline(self, ty=None, suffix='', values=None):
         '''
         add a line to the logfile, forom various different types -
         - temperatures (measured, next setpoint, current setpoint)
@@ -272,29 +1190,26 @@ class BaseCASUCtrl(object):
         different loglines contain differet components but they all use
         ty;timestamp;<readings...;><nl>
 
-        any reading can have a suffix appended/
+        any reading can have a suffix appended/, and `values` are appended as
+        fields of their own. Sensor values and the timestamp come from the
+        snapshot for the current cycle.
 
+        with LOG_FORMAT 'binary', IR, HEAT, MODE and HEAT_CALCS are written as
+        fixed-layout records and anything else as a text record.
         '''
-        now = time.time()
+        snap = self.snap
+        now = snap.when
 
         fields = []
         if ty == "IR":
             fields += ["ir_array", now]
-            ir_levels = np.array(self._casu.get_ir_raw_value(casu.ARRAY))[0:6]
-            #fields += ir_levels
-            # syntax change?!
-            fields.extend(ir_levels)
+            fields.extend(snap.ir_raw[0:6])
 
         elif ty == "HEAT":
             fields += ["temperatures", now]
-            for sensor in [casu.TEMP_L, casu.TEMP_R, casu.TEMP_B, casu.TEMP_F,]:
-                #casu.TEMP_WAX, casu.TEMP_CASU]:
-                _t = self._casu.get_temp(sensor)
-                fields.append(_t)
-
-            _sp, onoff = self._casu.get_peltier_setpoint()
-            fields.append(_sp)
-            fields.append(int(onoff))
+            fields.extend(snap.ring_temps())
+            fields.append(snap.setpoint)
+            fields.append(int(snap.peltier_on))
         elif ty == "MODE":
             # lets write this manualy for more flexibility
             fields += ['state', now, self.state, self._states[self.state]]
@@ -306,31 +1221,152 @@ class BaseCASUCtrl(object):
         elif ty == "NH_DATA":
             fields += ["nh_data", now]
 
+        elif ty == "AVG_WINDOWS":
+            fields += ["avg_windows", now]
+
+        elif ty == "SCHED":
+            # main-loop timing; values from CycleScheduler.summary
+            fields += ["sched", now]
+
+        elif ty == "IR_DRIFT":
+            fields += ["ir_drift", now]
+
+        elif ty == "MSG_STATS":
+            fields += ["msg_stats", now]
+
+        elif ty == "RX_STATS":
+            fields += ["rx_stats", now]
+
         # elif ...
 
+        if self._binlog is not None:
+            self.log_fh.write(self._pack_logline(ty, fields, suffix, values))
+            return
+
+        if values is not None:
+            fields.extend(values)
         s = self._log_delimiter.join([str(f) for f in fields])
         if len(suffix):
             s += self._log_delimiter + suffix
         s += self._log_LINE_END
         self.log_fh.write(s)
-        self.log_fh.flush()
 
+    def _pack_logline(self, ty, fields, suffix, values):
+        enc = self._binlog
+        now = fields[1]
+        if ty == "IR":
+            return enc.ir(now, fields[2:])
+        elif ty == "HEAT":
+            return enc.heat(now, fields[2:6], fields[6], fields[7])
+        elif ty == "MODE":
+            return enc.mode(now, self.state)
+        elif ty == "HEAT_CALCS" and values is not None and not len(suffix):
+            return enc.heat_calcs(now, values)
 
+        # no fixed layout, keep as text
+        if values is not None:
+            fields = fields + list(values)
+        s = self._log_delimiter.join([str(f) for f in fields])
+        if len(suffix):
+            s += self._log_delimiter + suffix
+        return enc.text(now, s)
+
+
+    SCHED_LOG_FIELDS = ['cycles', 'overruns', 'skipped', 'late_mean',
+                        'late_max', 'dur_mean', 'dur_max']
+
+    def log_sched_stats(self, summary):
+        '''
+        >>>ty, time, cycles, overruns, skipped, late_mean, late_max, dur_mean, dur_max<<<
+        (for the period since the previous SCHED line; times in seconds)
+        '''
+        self.write_logline(ty="SCHED",
+                           values=[summary[k] for k in self.SCHED_LOG_FIELDS])
+        self.log_rx_stats()
+        self.log_msg_stats()
+        if summary['overruns'] and self.verb > 0:
+            print "[W]{} {} of {} cycles overran (max {:.3f}s, {} deadlines skipped)".format(
+                self.name, summary['overruns'], summary['cycles'],
+                summary['dur_max'], summary['skipped'])
+
+    def log_ir_drift(self):
+        '''
+        >>>ty, time, n_updates, <drift> x6, <threshold> x6<<<
+        (drift of each channel's no-bee level since calibration, and the
+        thresholds in use)
+        '''
+        trk = self.ir_baseline
+        self._last_drift_log = self.snap.when
+        self.write_logline(ty="IR_DRIFT", values=[trk.n_updates] +
+                           trk.drift()[0:6] + self.ir_thresh[0:6])
+
+    RX_LOG_FIELDS = ['read', 'superseded', 'dropped', 'budget_hits']
+
+    def log_rx_stats(self):
+        '''
+        >>>ty, time, read, superseded, dropped, budget_hits<<<
+        (messages since the previous line: read; replaced by a newer one from
+        the same sender/fish before use; unparseable; and the number of cycles
+        that left messages queued because RX_MAX_MSGS/RX_MAX_TIME was reached)
+        '''
+        self.write_logline(ty="RX_STATS",
+                           values=[self.rx_counts[k] for k in self.RX_LOG_FIELDS])
+        self.rx_counts = dict.fromkeys(self.RX_LOG_FIELDS, 0)
+
+    def log_msg_stats(self):
+        '''
+        >>>ty, time, num_senders, <sender, rx, lost, dup, lat_mean, lat_max> for each<<<
+        (binary messages received since the previous line; nothing is written
+        if there were none)
+        '''
+        per_sender = self.msg_stats.summary()
+        if not per_sender:
+            return
+        _fields = [len(per_sender), ]
+        for sender in sorted(per_sender):
+            _fields += [sender] + per_sender[sender]
+        self.write_logline(ty="MSG_STATS", values=_fields)
 
     def _cleanup_log(self):
+        # closing drains anything the writer threads still hold
         self.log_fh.close()
+        if self.log_fh.n_dropped:
+            print "[W] {} log lines dropped (queue full)".format(self.log_fh.n_dropped)
+        if self.SYNCFLASH:
+            self.synclog.close()
         print "[I] finished logging to {}.".format(self.logfile)
 
     #}}}
 
+    #{{{ main loop
+    def make_scheduler(self):
+        ''' a scheduler that runs this controller every MAIN_LOOP_INTERVAL '''
+        return CycleScheduler(
+            self.MAIN_LOOP_INTERVAL, policy=self.LOOP_OVERRUN_POLICY,
+            on_report=self.log_sched_stats,
+            report_interval=self.SCHED_REPORT_INTERVAL,
+            clock=getattr(self.clock, 'monotonic', None), sleep=self.clock.sleep)
+
+    def run(self):
+        ''' execute one_cycle at a fixed rate until interrupted '''
+        self.scheduler = self.make_scheduler()
+        self.scheduler.run(self.one_cycle)
+    #}}}
+
     #{{{ stop
     def stop(self):
-        self._casu.set_diagnostic_led_rgb(0.2, 0.2, 0.2)
+        self.leds.wait() # let any flash finish (and be logged)
+        self.set_diag_led(0.2, 0.2, 0.2)
         if not self.__stopped:
             s = "# {} Finished at: {}".format(
-                self.name, datetime.datetime.fromtimestamp(time.time()))
-            self.log_fh.write(s + "\n")
+                self.name, datetime.datetime.fromtimestamp(self.clock.time()))
+            self.log_rx_stats()
+            self.log_msg_stats()
+            self.write_comment("# {} sent {} counts, {} unchanged ones suppressed".format(
+                self.name, self.n_tx_sent, self.n_tx_suppressed))
+            self.write_comment(s)
             self._cleanup_log()
+            self._dump_profile()
             self._casu.stop()
             self.__stopped = True
 
@@ -343,12 +1379,21 @@ class BaseCASUCtrl(object):
 
     #}}}
     #{{{ read sensors
+    def take_snapshot(self):
+        ''' read all sensors used in a cycle, once '''
+        return self.snap.read(self._casu, now=self.clock.time())
+
     def measure_ir_sensors(self):
-        ir_levels = np.array(self._casu.get_ir_raw_value(casu.ARRAY))
+        ir_levels = self.snap.ir_raw
         count = 0
+        if self.ir_baseline is not None:
+            # thresholds follow the drift of the no-bee levels
+            self.ir_thresh = self.ir_baseline.update(ir_levels, self.snap.when)
+            if self.snap.when - self._last_drift_log >= self.IR_DRIFT_LOG_INTERVAL:
+                self.log_ir_drift()
 
         # need to ignore the last one because it should not be used
-        for i, (val, t) in enumerate(zip(ir_levels, self.calib_data['IR'])):
+        for i, (val, t) in enumerate(zip(ir_levels, self.ir_thresh)):
             if i < 6: # ignore last one
                 if (val > t): count += 1
 
@@ -359,8 +1404,7 @@ class BaseCASUCtrl(object):
 
     def get_est_ring_temp(self):
         _T = []
-        for sensor in [casu.TEMP_L, casu.TEMP_R, casu.TEMP_B, casu.TEMP_F]:
-            _t = self._casu.get_temp(sensor)
+        for _t in self.snap.ring_temps():
             if _t > 2.0 and _t < 50.0: # value is probably ok
                 _T.append(_t)
         if len(_T):
@@ -383,16 +1427,16 @@ class BaseCASUCtrl(object):
             target_temp = self.INIT_FIXHEAT_TEMP
         else:
             target_temp = temp
-        _tref, _on = self._casu.get_peltier_setpoint()
+        _tref, _on = self.snap.setpoint, self.snap.peltier_on
         if _tref == target_temp and _on is True:
             # nothing to do
             pass
         else:
-            self._casu.set_temp(target_temp)
+            self.set_casu_temp(target_temp)
             self.current_Tref = target_temp
             self._active_peliter = True
             # update the info on it
-            now = time.time()
+            now = self.snap.when
             self.last_temp_update_time = now
             tstr = time.strftime("%H:%M:%S-%Z", time.gmtime())
             print "[I][{}] requested new fixed temp @{} from {:.2f} to {:.2f}".format(
@@ -400,53 +1444,139 @@ class BaseCASUCtrl(object):
             self.prev_Tref = self.current_Tref
 
     def unset_temp(self):
-        self._casu.temp_standby()
+        with self._casu_lock:
+            self._casu.temp_standby()
         self._active_peliter = False
 
     #}}}
 
     #{{{ emit flash pulse to help align videos
     def sync_flash(self):
+        '''
+        every SYNC_INTERVAL, start a R/G/B flash. The flash is played by the
+        LED sequencer in the background, so this returns immediately; each
+        LED edge is timestamped in the sync log as it happens.
+        '''
         if self.SYNCFLASH:
-            now = time.time()
+            now = self.clock.time()
             if now - self.last_synchflash_time > self.SYNC_INTERVAL:
+                if self.leds.active:
+                    return # previous flash still playing
                 # update time (sync to beginning of flash)
                 self.last_synchflash_time = now
                 # record pre
                 s = "{}; {}; {};".format(now, self.sync_cnt, "start")
                 self.synclog.write(s + "\n")
-                self.synclog.flush()
                 print "[D] synch {}".format(s)
-                # FLASH
-                self._sync_flash()
-                # RECORD post
-                now2 = time.time()
-                self.synclog.write("{}; {}; {}; \n".format(now2, self.sync_cnt, "end"))
+                # FLASH (edges, then "end", are recorded by _log_sync_edge)
+                self.leds.play(self.SYNC_PATTERN, tag=self.sync_cnt)
                 self.sync_cnt += 1
 
+    def _log_sync_edge(self, when, tag, edge):
+        if self.SYNCFLASH:
+            self.synclog.write("{}; {}; {}; \n".format(when, tag, edge))
+
     def _sync_flash(self, dur_mult=1.0, log=True):
         '''
         by default a 0.4s cycle of R/G/B (blocking).
         Increase duration by setting dur_mult >1
         '''
-        # read current state
-        rgb = self._casu.get_diagnostic_led_rgb()
-        self._casu.set_diagnostic_led_rgb(r=1.0)
-        time.sleep(0.05)
-        self._casu.set_diagnostic_led_rgb()
-        time.sleep(0.05)
-
-        self._casu.set_diagnostic_led_rgb(g=1.0)
-        time.sleep(0.10)
-        self._casu.set_diagnostic_led_rgb()
-        time.sleep(0.05)
-
-        self._casu.set_diagnostic_led_rgb(b=1.0)
-        time.sleep(0.15)
-        self._casu.set_diagnostic_led_rgb()
-        time.sleep(0.05)
-
-        # put back original state
-        self._casu.set_diagnostic_led_rgb(*rgb)
+        self.leds.play(self.SYNC_PATTERN, dur_mult=dur_mult, blocking=True)
     #}}}
 
+    #{{{ LED and actuator commands
+    def set_diag_led(self, r=0.0, g=0.0, b=0.0):
+        '''
+        set the diagnostic LED. If a flash is playing, the colour is applied
+        as soon as it finishes.
+        '''
+        self.leds.set(r, g, b)
+
+    def set_casu_temp(self, temp):
+        with self._casu_lock:
+            self._casu.set_temp(temp)
+
+    def send_msg(self, dest, data):
+        with self._casu_lock:
+            self._casu.send_message(dest, data)
+
+    def tx_due(self, dest, value):
+        '''
+        whether `value` needs sending to `dest` this cycle: it moved by more
+        than TX_DEADBAND from the last value sent there, or that was
+        TX_HEARTBEAT s ago. (Text counts are compared as sent, to 3 d.p.)
+        '''
+        if self.MSG_CODEC == 'text':
+            value = round(value, 3)
+        now = self.snap.when
+        last = self._tx_last.get(dest)
+        if (last is not None and abs(value - last[0]) <= self.TX_DEADBAND
+                and now - last[1] < self.TX_HEARTBEAT):
+            self.n_tx_suppressed += 1
+            return False
+        self._tx_last[dest] = (value, now)
+        self.n_tx_sent += 1
+        return True
+
+    def encode_count(self, dest, value):
+        ''' message payload for a bee count to `dest`, as set by MSG_CODEC '''
+        if self.MSG_CODEC == 'binary':
+            seq = self._tx_seq.get(dest, 0)
+            self._tx_seq[dest] = seq + 1
+            return msgcodec.pack(msgcodec.BEE_COUNT, seq, self.clock.time(), value)
+        return msgcodec.format_text(value, self.MSG_PREFIX_BEECASU)
+
+    def drain_messages(self, retry_cnt=0):
+        '''
+        the waiting messages, oldest first, up to RX_MAX_MSGS of them or as
+        many as can be read in RX_MAX_TIME s; the rest stay queued.  Reading
+        stops early when the queue was found empty `retry_cnt` + 1 times.
+
+        A budget hit is only counted when another message was waiting: that
+        one is read, and held over to be first in the next call.
+        '''
+        msgs = []
+        if self._rx_held is not None:
+            msgs.append(self._rx_held)
+            self._rx_held = None
+        t_end = monotonic() + self.RX_MAX_TIME
+        try_cnt = 0
+        while True:
+            msg = self._casu.read_message()
+            if not msg:
+                # buffer emptied, return
+                try_cnt += 1
+                if try_cnt > retry_cnt:
+                    break
+                continue
+            if len(msgs) >= self.RX_MAX_MSGS or monotonic() > t_end:
+                self._rx_held = msg
+                self.rx_counts['budget_hits'] += 1
+                break
+            msgs.append(msg)
+        self.rx_counts['read'] += len(msgs)
+        return msgs
+
+    def conflate(self, latest, key, msg):
+        ''' keep `msg` as the newest for `key`, counting the one it replaces '''
+        old = latest.get(key)
+        if old is not None:
+            self.rx_counts['superseded'] += 1
+            if msgcodec.is_binary(old['data']):
+                self.decode_count(old) # only for the link stats
+        latest[key] = msg
+
+    def decode_count(self, msg):
+        '''
+        the bee count in a message from a neighbour (either format), or None
+        if it is not a bee count. Binary messages are added to msg_stats.
+        '''
+        m = msgcodec.unpack(msg['data'])
+        if m is None:
+            return msgcodec.parse_text(msg['data'], self.MSG_PREFIX_BEECASU)
+        mtype, seq, sent, value = m
+        if mtype != msgcodec.BEE_COUNT:
+            return None
+        self.msg_stats.rx(msg['sender'], seq, sent, self.clock.time())
+        return value
+    #}}}
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+buffered log writing in a background thread.
+
+`write()` only appends to an in-memory queue, so a control loop never
+waits on storage; a writer thread empties the queue and flushes the file
+every `flush_interval` seconds.  The queue is bounded by `max_bytes`: if
+storage stalls for long enough to fill it, further lines are dropped and
+counted (and a marker line is written once the queue drains) rather than
+blocking the caller or growing without limit.
+
+`close()` drains everything still queued before closing the file.
+
+A failed write or flush (e.g. ENOSPC) does not stop the writer thread: the
+batch is counted as lost, the thread keeps draining the queue, and the
+error is raised (as IOError) from the caller's next `write()` or `close()`.
+
+With `rotate_bytes`, the writer thread starts a new file once the current
+one reaches that size, keeping `backups` old ones (<file>.1 is the newest).
+
+No dependencies beyond the standard library, so this can be used by the
+relay as well as the CASU controllers.
+'''
+
+import os
+import threading
+import time
+
+class BufferedLogWriter(object):
+    FLUSH_INTERVAL = 1.0     # seconds
+    MAX_BYTES      = 1 << 20 # queue budget (1MB)
+    DROP_MARKER    = "# log queue full, dropped {} lines\n"
+
+    def __init__(self, filename, mode='w', flush_interval=None,
+                 max_bytes=None, drop_marker=DROP_MARKER, rotate_bytes=None,
+                 backups=3):
+        self.filename = filename
+        self.flush_interval = float(
+            self.FLUSH_INTERVAL if flush_interval is None else flush_interval)
+        self.max_bytes = int(self.MAX_BYTES if max_bytes is None else max_bytes)
+        # a format with one field for the count, or None to not mark drops
+        self.drop_marker = drop_marker
+
+        self.rotate_bytes = rotate_bytes
+        self.backups = int(backups)
+
+        self._fh = open(filename, mode) # raises IOError in caller's thread
+        self._fh.seek(0, 2)
+        self._size = self._fh.tell()
+
+        self._lock = threading.Lock()
+        self._queue = []
+        self._queued_bytes = 0
+        self._pending_drops = 0
+        self._error = None
+        self._closing = threading.Event()
+        self.closed = False
+
+        # stats
+        self.n_written = 0
+        self.n_dropped = 0
+        self.n_rotated = 0
+        self.n_errors = 0
+        self.n_lost = 0       # lines in batches that failed to write
+
+        self._thread = threading.Thread(
+            target=self._run, name="logwriter-{}".format(filename))
+        self._thread.daemon = True
+        self._thread.start()
+
+    #{{{ caller side
+    def write(self, s):
+        '''
+        queue `s` for writing; never blocks on I/O. Returns False if the line
+        was dropped because the queue is full.
+        '''
+        if self.closed:
+            raise ValueError("write to closed log {}".format(self.filename))
+        self._raise_error()
+        with self._lock:
+            if self._queued_bytes + len(s) > self.max_bytes:
+                self._pending_drops += 1
+                self.n_dropped += 1
+                return False
+            self._queue.append(s)
+            self._queued_bytes += len(s)
+        return True
+
+    def flush(self):
+        ''' no-op: the writer thread flushes every `flush_interval` '''
+        pass
+
+    def close(self):
+        ''' write out everything queued, then close the file '''
+        if self.closed:
+            return
+        self.closed = True
+        self._closing.set()
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        ''' re-raise, once, an error the writer thread has met since the last call '''
+        with self._lock:
+            e, self._error = self._error, None
+        if e is not None:
+            raise IOError("writing log {} failed ({} lines lost so far): {}".format(
+                self.filename, self.n_lost, e))
+    #}}}
+
+    #{{{ writer thread
+    def _take(self):
+        with self._lock:
+            batch, self._queue = self._queue, []
+            self._queued_bytes = 0
+            drops, self._pending_drops = self._pending_drops, 0
+        return batch, drops
+
+    def _attempt(self, fn, *args):
+        ''' run fn(*args) and keep any I/O error for the caller; True if ok '''
+        try:
+            fn(*args)
+            return True
+        except (IOError, OSError, ValueError) as e:
+            with self._lock:
+                self.n_errors += 1
+                if self._error is None:
+                    self._error = e
+            return False
+
+    def _write(self, s):
+        if self._fh.closed:
+            # a rotation failed to reopen the file; try again
+            self._fh = open(self.filename, 'a')
+            self._fh.seek(0, 2)
+            self._size = self._fh.tell()
+        if self.rotate_bytes and self._size and self._size + len(s) > self.rotate_bytes:
+            self._rotate()
+        self._fh.write(s)
+        self._size += len(s)
+
+    def _rotate(self):
+        self._fh.close()
+        for i in xrange(self.backups - 1, 0, -1):
+            src = "{}.{}".format(self.filename, i)
+            if os.path.exists(src):
+                os.rename(src, "{}.{}".format(self.filename, i + 1))
+        if self.backups > 0:
+            os.rename(self.filename, self.filename + ".1")
+        self._fh = open(self.filename, 'w')
+        self._size = 0
+        self.n_rotated += 1
+
+    def _run(self):
+        last_flush = time.time()
+        while True:
+            closing = self._closing.wait(self.flush_interval)
+            self._write_batch()
+
+            now = time.time()
+            if closing or now - last_flush >= self.flush_interval:
+                self._attempt(self._fh.flush)
+                last_flush = now
+            if closing:
+                break
+
+        # anything queued between the last take and the close request
+        self._write_batch()
+        self._attempt(self._fh.close)
+
+    def _write_batch(self):
+        batch, drops = self._take()
+        if batch:
+            if self._attempt(self._write, ''.join(batch)):
+                self.n_written += len(batch)
+            else:
+                self.n_lost += len(batch)
+        if drops and self.drop_marker is not None:
+            self._attempt(self._write, self.drop_marker.format(drops))
+    #}}}
@@ -2,11 +2,13 @@
 # -*- coding: utf-8 -*-
 
 #{{{ imports
-from assisipy import casu
+try:
+    from assisipy import casu
+except ImportError:
+    import fake_casu as casu # constants only; see calibration.AssisiBackend
 import argparse
 import time
 import numpy as np
-import pygraphviz as pgv
 import libcas
 import interactions
 
@@ -23,14 +25,19 @@ STATE_HEAT_PROPTO = 3
 #}}}
 
 class Enhancer(libcas.BaseCASUCtrl):
+    # if True, neighbours' newest values are weighted rather than averaged
+    BEE_INPUTS_PRESMOOTHED = False
+
     #{{{ initialiser
     def __init__(self, casu_name, logpath,
                  conf_file=None, calib_conf=None,
-                 nbg_file=None,):
+                 nbg_file=None, backend=None, calib_log=None,
+                 fast_restart=None):
 
         # basic setup, including calibration, logpath, casu name,
         self._init_common(casu_name, logpath, conf_file=conf_file,
-                          calib_conf=calib_conf)
+                          calib_conf=calib_conf, backend=backend,
+                          calib_log=calib_log, fast_restart=fast_restart)
 
         self.nbg_file = nbg_file
         self.weights_inverted = False
@@ -39,10 +46,11 @@ class Enhancer(libcas.BaseCASUCtrl):
         self._init_hist_vars()
         self._init_temp_vars()
         self._init_neighbourhood()
+        self._init_views()
         # variables for state and timing
         self.state = STATE_INIT_NOHEAT
         self.old_state = 0 # set different to above so initial state is always logged
-        self.init_upd_time = time.time()
+        self.init_upd_time = self.session_start # (earlier, if resumed)
         self.__stopped = False
 
 
@@ -50,64 +58,81 @@ class Enhancer(libcas.BaseCASUCtrl):
     #{{{ init helpers
     def _init_hist_vars(self):
         '''
-        variables (arrays/dicts of arrays) for historical records of casu inputs
-        and states
+        variables for historical records of casu inputs and states. All
+        inputs share one NeighbourhoodStore; each source gets a fixed row
+        when the neighbourhood is set up.
         '''
         # data
-        self.bee_hist = {} # record the bee counts from each relevant source
-        self.bee_hist['self'] = np.zeros(self.HIST_LEN,)
-
-        self.smoothed_bee_hist = {}  # keep track of time-averaged data
-        self.smoothed_bee_hist['self'] = 0.0
-
-        self.state_contribs = {}     # keep track of contributions to temp
-        self.state_contribs['self'] = 0.0
+        self.nh = libcas.NeighbourhoodStore(
+            self.HIST_LEN, extra_windows=self.hist_windows(0))
+        self.bee_sources = ['self', ]
+        self.nh.add_source('self', self.SELF_WEIGHT, self.AVG_HIST_LEN)
+        self._self_row = self.nh.index['self']
 
     def _init_temp_vars(self):
         self._active_peliter   = False
         self.current_temp      = 28.0
         self.prev_temp         = 28.0
         self.inst_Ttgt         = 28.0
+        self.inst_Tactual      = 28.0
         self.current_Tref      = 28.0
         self.prev_Tref         = 28.0
 
         self.unclipped_activation = 0.0
 
-        self.last_tref_change       = time.time()
+        self.last_tref_change       = self.clock.time()
         self.tref_changed = False
-        self.last_temp_update_time  = time.time()
+        self.last_temp_update_time  = self.clock.time()
+
+        if self.resumed:
+            # carry on from the setpoint the CASU still has
+            snap = self.take_snapshot()
+            if snap.peltier_on:
+                self.current_Tref = self.prev_Tref = float(snap.setpoint)
+                self._active_peliter = True
 
     def _init_neighbourhood(self):
         ''' top-level wrapper for all neighbourhoods required'''
         self._init_beecasu_neighbourhood() # for bee-casu interactions
 
     def _init_beecasu_neighbourhood(self):
-        g_hier = pgv.AGraph(self.nbg_file)
-        g_flat = interactions.flatten_AGraph(g_hier)
-
-        self.in_map = interactions.get_inmap(g_flat, self.name)
-        self.out_map = interactions.get_outmap(g_flat, self.name)
+        # compiled maps if up to date, else parsed from the nbg
+        self.in_map, self.out_map = interactions.load_neighbourhood(
+            self.nbg_file, self.name, verb=self.verb > 1)
 
         self.most_recent_rx = {}
         for neigh in self.in_map:
             self.most_recent_rx[neigh] = { 'when' : self.ts, 'count': 0.0, 'tomem': False}
 
         for neigh in self.in_map :
-            self.smoothed_bee_hist[neigh] = 0.0
-            self.state_contribs[neigh] = 0.0
-            self.bee_hist[neigh] = np.zeros(self.HIST_LEN,)
+            self.nh.add_source(neigh, self.in_map[neigh].get('w'), self.AVG_HIST_LEN,
+                               use_latest=self.BEE_INPUTS_PRESMOOTHED)
+            self.bee_sources.append(neigh)
+
+    def _init_views(self):
+        ''' fix the neighbourhood rows, and name-based views onto them '''
+        self.nh.build()
+        self.smoothed_bee_hist = self.nh.view('smoothed', self.bee_sources)
+        self.state_contribs = self.nh.view('contribs')
 
     #}}}
 
 
     #{{{ >> top-level cycle wrapper here <<
     def one_cycle(self):
+        # phases are timed by self.prof if PROFILE_CYCLES is set
+        self.prof.begin()
         self.ts += 1
+        self.take_snapshot() # every sensor read once, for the whole cycle
+        self.prof.mark('snapshot')
         self.update_info() # read own sensors and msgs from other casus
         self.emit_to_neighbours() # send own data to all neighbours
+        self.prof.mark('emit')
 
         self.update_outputs() # change actuators
         self.sync_flash() # periodically flash to synch vid and casu logs
+        self.prof.mark('sync_flash')
+        self.prof.end()
     #}}}
 
     #{{{ update_info
@@ -116,17 +141,21 @@ class Enhancer(libcas.BaseCASUCtrl):
         #B. runtime
         #  1. read own local values of bees [whatever the source]
         self.measure_ir_sensors()
+        self.prof.mark('measure_ir')
         #  2. receive updates from neighbours
         self.update_interactions()
+        self.prof.mark('recv')
         #  3. compute running averages (/re-compute)
         self.update_averages()
         self.compute_state_contribs()
+        self.prof.mark('averaging')
 
         if self.DEV_VERB and ((self.ts % self.FREQ_RPT_INPUTS) == 0):
             print "[D]({}) {}. {:5.2f} ({:.0f} sensors) [{:.2f} avg]".format(
                     self.name, self.ts, self.current_count,
                     self.current_count * self.MAX_SENSORS,
                     self.smoothed_bee_hist['self'])
+        self.prof.mark('dev_print')
         # done - all up to date.
     #}}}
     #{{{ update_interactions
@@ -145,12 +174,17 @@ class Enhancer(libcas.BaseCASUCtrl):
     #{{{ update_averages
     def update_averages(self):
         self.update_bee_averages()
+        self.nh.update(self.ts)
 
     def update_bee_averages(self):
         # if we have new data for a given neighbour (upstream), then push to buffer
+        rows, vals = [self._self_row, ], [self.current_count, ]
+        # hold the last value while senders have nothing new to say (see tx_due)
+        hold = self.RX_HOLD_LAST or self.TX_HEARTBEAT > 0
         for neigh, data in self.most_recent_rx.items():
-            if data['tomem'] is False and (self.ts - data['when']) < self.MAX_MSG_AGE:
-                libcas.push_data_1d(self.bee_hist[neigh], data['count'] )
+            if (hold or data['tomem'] is False) and (self.ts - data['when']) < self.MAX_MSG_AGE:
+                rows.append(self.nh.index[neigh])
+                vals.append(data['count'])
                 data['tomem'] = True
             else:
                 if data['tomem'] is False:
@@ -159,27 +193,16 @@ class Enhancer(libcas.BaseCASUCtrl):
                         self.name, data['when'], self.ts, self.ts - data['when'],
                         self.MAX_MSG_AGE, data['tomem'])
 
-        # we always have an update for self, so put that in too.
-        libcas.push_data_1d(self.bee_hist['self'], self.current_count)
-
-        valid = min(self.ts, self.AVG_HIST_LEN)
-
-        for neigh in self.bee_hist: # including 'self' here
-            vd = np.array(self.bee_hist[neigh][0:valid])
-            self.smoothed_bee_hist[neigh] = vd.mean()
+        # we always have an update for self (in row 0), so put that in too.
+        self.nh.push(rows, vals)
 
 
     def compute_state_contribs(self):
-        self.state_contribs = {}     # keep track of contributions to temp
-
-        for neigh in self.smoothed_bee_hist: # including 'self' here
-            if neigh == 'self':
-                w = self.SELF_WEIGHT
-            else:
-                w = self.in_map[neigh].get('w')
-
-            v = self.smoothed_bee_hist[neigh]
-            self.state_contribs[neigh] = w * v
+        '''
+        weighted contributions of each input (self.nh.contribs) and their
+        sum (self.nh.activation) are computed by the store in update().
+        '''
+        pass
 
     #}}}
     #{{{ update_outputs
@@ -189,6 +212,7 @@ class Enhancer(libcas.BaseCASUCtrl):
         '''
         #  weighted sum over all input sensor data, and multiply by range
         clipped_activation_level = self.compute_activation_level()
+        self.prof.mark('activation')
         if 0: print "[I]{}|{} Computed activation summation as {:.2f}".format(
                 self.name, self.ts, clipped_activation_level)
         activation_level = clipped_activation_level
@@ -196,6 +220,7 @@ class Enhancer(libcas.BaseCASUCtrl):
         bonus = self.T_RANGE * activation_level
 
         # compute and record the internal target, internal Tref
+        self.inst_Tactual = self.get_inst_Tactual()
         dT_mag, dT_sgn = self.clipped_dT(bonus)
 
         self.inst_Tref = self.inst_Tactual + dT_mag*dT_sgn
@@ -208,17 +233,68 @@ class Enhancer(libcas.BaseCASUCtrl):
         if self.DEV_VERB and ((self.ts % self.FREQ_RPT_INPUTS) == 0):
             print "\t===={:4}====  {:.1f}% ({:.1f}oC) Tref: {:.1f}({:.0f}s) ==> {:.1f}|{:.1f}oC [{}]".format(
                 self.ts, activation_level * 100.0, bonus, self.current_Tref,
-                time.time() - self.last_tref_change, self._casu.get_temp(casu.TEMP_L),
-                self._casu.get_temp(casu.TEMP_R), self.name)
+                self.snap.when - self.last_tref_change, self.snap.temps[casu.TEMP_L],
+                self.snap.temps[casu.TEMP_R], self.name)
 
         # if initial quiescent period has passed, allow LEDs and heaters on.
         self.update_state_and_temps(Tref_update_allowed, led_frac=activation_level)
+        self.prof.mark('heat_ctrl')
 
         # write out logs for sensor values, and heat calcs
         _fields = [activation_level, bonus, ]
-        self.write_logline(ty="HEAT_CALCS", suffix=self._log_delimiter.join([str(f) for f in _fields]) )
+        self.write_logline(ty="HEAT_CALCS", values=_fields)
         self.write_logline(ty='IR')
         self.write_logline(ty='HEAT')
+        if self.EXTRA_AVG_WINDOWS:
+            self.log_avg_windows()
+        self.prof.mark('log_write')
+    #}}}
+
+    #{{{ heat step (clipped_dT)
+    # update_outputs and check_tref_change_ok use these, but they were never
+    # defined; this is the absolute-target rule only (see _init_config).
+    def get_inst_Tactual(self):
+        '''
+        mean of the plausible ring temperatures this cycle (as
+        get_est_ring_temp); if none are, the previous value is kept.
+        '''
+        T = self.get_est_ring_temp()
+        if T < 0:
+            print "[W]{} no plausible ring temperature, keeping {:.2f}".format(
+                self.name, self.inst_Tactual)
+            return self.inst_Tactual
+        return T
+
+    def clipped_dT(self, bonus):
+        '''
+        the step from the current temperature towards the target
+        MIN_TEMP + bonus, limited to DT_MAX; returns magnitude, sign.
+        (bonus is T_RANGE * the clipped activation, so the target is
+        always within [MIN_TEMP, MAX_TEMP])
+        '''
+        self.inst_Ttgt = self.MIN_TEMP + bonus
+
+        dT = self.inst_Ttgt - self.inst_Tactual
+        dT_sgn = 1.0 if dT >= 0 else -1.0
+        dT_mag = min(abs(dT), self.DT_MAX)
+        return dT_mag, dT_sgn
+    #}}}
+
+    #{{{ log_avg_windows
+    def log_avg_windows(self):
+        '''
+        write the mean over every configured window for every source, e.g.
+        to compare short- and long-term activity.
+        >>>ty, time, num_windows, <label>..., num_src, <src, mean...> for each src<<<
+        '''
+        labels = self.nh.labels[1:]
+        means = [self.nh.window_means(lbl, self.ts) for lbl in labels]
+        _fields = [len(labels), ] + labels + [len(self.nh.names), ]
+        for i, src in enumerate(self.nh.names):
+            _fields.append(src)
+            _fields += [m[i] for m in means]
+
+        self.write_logline(ty="AVG_WINDOWS", values=_fields)
     #}}}
 
     #{{{ check_tref_change_ok
@@ -238,7 +314,7 @@ class Enhancer(libcas.BaseCASUCtrl):
                 Tref_update_allowed = False
                 _d_update_checks["Tref_reached"] = False
         # 2. was the last change long enough ago?
-        now = time.time()
+        now = self.snap.when
         elap_Tref = now - self.last_tref_change
         if elap_Tref < self.REF_UPDATE_INTERVAL:
             Tref_update_allowed = False
@@ -271,13 +347,13 @@ class Enhancer(libcas.BaseCASUCtrl):
         update the current target, if allowed.
         '''
         # record to logfile on cycles when it transitions
-        now = time.time()
+        now = self.snap.when
         elap = now - self.init_upd_time
 
         # also switch off LED if it is after 30 sec (or whatever config is).
         if self.INIT_LED is True:
             if elap > self.SHOW_CALIB_LED_MINS * 60.0:
-                self._casu.set_diagnostic_led_rgb(r=0, g=0, b=0)
+                self.set_diag_led(r=0, g=0, b=0)
                 self.INIT_LED = False
 
         # ===== IF IN FIXED TEMP, -> 1/2 blue ===== #
@@ -297,7 +373,7 @@ class Enhancer(libcas.BaseCASUCtrl):
             #6. compute color to match the emission temp
             #   (just propto range of temp)
             if led_frac is not None:
-                self._casu.set_diagnostic_led_rgb(r=led_frac, g=0, b=0)
+                self.set_diag_led(r=led_frac, g=0, b=0)
             #7. set temp, set LEDs
             if self.ENABLE_TEMP:
                     # 2017 heat ctrl: => tests are above, within variable ""
@@ -309,7 +385,7 @@ class Enhancer(libcas.BaseCASUCtrl):
         # ===== if in DEBUG NO HEAT MODE, SET TO DK GREY. ===== #
         else:
             self.state = STATE_INIT_NOHEAT
-            self._casu.set_diagnostic_led_rgb(r=0.2, g=0.2, b=0.2)
+            self.set_diag_led(r=0.2, g=0.2, b=0.2)
             if self.DEV_VERB:
                 print "[DD2] temp no heat, free bee movement. ({:.1f}s remain)".format(
                          (self.INIT_NOHEAT_PERIOD_MINS * 60.0) - elap)
@@ -324,14 +400,14 @@ class Enhancer(libcas.BaseCASUCtrl):
         '''
         this wrapper assumes update was already "authorised"
         '''
-        now = time.time()
-        # 1. get current Tref
+        now = self.snap.when
+        # 1. get current Tref (as read at the start of this cycle)
         # 2. compare with new tref
-        tref_casu, state = self._casu.get_peltier_setpoint()
+        tref_casu, state = self.snap.setpoint, self.snap.peltier_on
         # if not >0.05 apart, don't set.
         if state is False or abs(tref_casu - self.current_Tref) > 0.05:
             # allow
-            self._casu.set_temp(self.current_Tref)
+            self.set_casu_temp(self.current_Tref)
             self.tref_changed = True
 
         self._active_peliter = True
@@ -344,26 +420,10 @@ class Enhancer(libcas.BaseCASUCtrl):
     #}}}
     #{{{ compute_activation_level
     def compute_activation_level(self):
-        activation_level = 0.0
-        _nh_fields = [ len(self.smoothed_bee_hist.keys()), ]
-        for neigh in self.smoothed_bee_hist.keys():
-            if neigh == 'self':
-                w = self.SELF_WEIGHT
-            else:
-                w = self.in_map[neigh].get('w')
-
-            activation_level += self.state_contribs[neigh]
-            #if self.DEV_VERB and ((self.ts % self.FREQ_RPT_INPUTS) == 0):
-            #    print "\t{:14}: {:.2f} {:+.2f} | w={:+.2f}".format(
-            #        neigh, self.smoothed_bee_hist[neigh],
-            #        self.state_contribs[neigh], w)
-            # each casu has different length data due to variable #edges
-            #>>>ty, time, num_neigh, <who, weight, raw, contrib, > for each edge. <<<
-            _nh_fields += [neigh, w, self.smoothed_bee_hist[neigh],
-                    self.state_contribs[neigh]]
-
-        self.write_logline(ty="NH_DATA", suffix=
-                self._log_delimiter.join([str(f) for f in _nh_fields]))
+        activation_level = self.nh.activation
+        nh = self.nh
+        # each casu has different length data due to variable #edges
+        self.write_nh_data(nh.names, nh.weights, nh.inputs, nh.contribs)
 
         self.unclipped_activation = float(activation_level)
         # clip in [0, 1]
@@ -374,25 +434,28 @@ class Enhancer(libcas.BaseCASUCtrl):
     #{{{ comms
     #{{{ recv_all_incoming
     def recv_all_incoming(self, retry_cnt=0):
+        '''
+        the newest count from each neighbour among the waiting messages (at
+        most RX_MAX_MSGS / RX_MAX_TIME worth, see drain_messages)
+        '''
+        latest = {}
+        for msg in self.drain_messages(retry_cnt):
+            self.conflate(latest, msg['sender'], msg)
+
         msgs = {}
-        try_cnt = 0
-        while True:
-            msg = self._casu.read_message()
-
-            if msg:
-                txt = msg['data'].strip()
-                src = msg['sender']
-                nb =  float(txt.split()[0])
-                msgs[src] = nb
-
-                if self.verb > 1:
-                    print "\t[i]<== {3} recv msg ({2} by): '{1}' bees, {4} from {0} {5}".format(
-                        msg['sender'], nb, len(msg['data']), self.name, BLU, ENDC)
-            else:
-                # buffer emptied, return
-                try_cnt += 1
-                if try_cnt > retry_cnt:
-                    break
+        for src, msg in latest.iteritems():
+            try:
+                nb = self.decode_count(msg)
+            except (ValueError, IndexError):
+                self.rx_counts['dropped'] += 1
+                continue
+            if nb is None:
+                continue
+            msgs[src] = nb
+
+            if self.verb > 1:
+                print "\t[i]<== {3} recv msg ({2} by): '{1}' bees, {4} from {0} {5}".format(
+                    msg['sender'], nb, len(msg['data']), self.name, BLU, ENDC)
 
         return msgs
     #}}}
@@ -417,13 +480,15 @@ class Enhancer(libcas.BaseCASUCtrl):
     def tx_count(self, dest, suppression=False):
         x_tx =  float(self.smoothed_bee_hist['self']) # default - send signal
         if suppression: x_tx = 0.0 # if this node is currently suppr, send zero.
-        s = "{:.3f}".format(x_tx)
+        if not self.tx_due(dest, x_tx):
+            return
+        s = self.encode_count(dest, x_tx)
         if self.verb > 2 or (suppression is True and self.verb > 1):
-            print "\t[i]==> {} send msg ({} by): '{}' bees, to {} (s {:.2f}| i{:.2f} |tx {:.2f})".format(
-                self.name, len(s), s, dest,
+            print "\t[i]==> {} send msg ({} by): '{:.3f}' bees, to {} (s {:.2f}| i{:.2f} |tx {:.2f})".format(
+                self.name, len(s), x_tx, dest,
                 self.smoothed_bee_hist['self'], self.unclipped_activation, x_tx)
 
-        self._casu.send_message(dest, s)
+        self.send_msg(dest, s)
     #}}}
     #}}}
 
@@ -435,18 +500,18 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--conf', type=str, default=None)
     parser.add_argument('-o', '--output', type=str, default=None)
     parser.add_argument('--nbg', type=str, default=None)
+    parser.add_argument('--fast-restart', action='store_true',
+                        help="resume a recent run of this CASU (see FAST_RESTART)")
     args = parser.parse_args()
 
     # instantiate object with config file
     c = Enhancer(args.name, logpath=args.output, conf_file=args.conf,
-                 nbg_file=args.nbg)
+                 nbg_file=args.nbg, fast_restart=args.fast_restart or None)
     if c.verb > 0: print "nuevo bifurcation enhancer - connected to {}".format(c.name)
 
     # execute main loop that handles the hang-up interrupt ok
     try:
-        while True:
-            time.sleep(c.MAIN_LOOP_INTERVAL)
-            c.one_cycle()
+        c.run() # one_cycle every MAIN_LOOP_INTERVAL, on fixed deadlines
     except KeyboardInterrupt:
         print "shutting down casu {}".format(c.name)
         c.stop()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+compact binary format for messages between CASU controllers, next to the
+legacy text format ("0.123", or "bee-casu-avg| 0.123").
+
+A binary message is a single fixed-layout record:
+
+    magic     2 bytes   '\xca\xb5' (never the start of a text message)
+    version   uint8
+    type      uint8     BEE_COUNT, ...
+    seq       uint32    per sender and destination, wraps around
+    sent      float64   sender's clock when sent (s since epoch)
+    value     float64
+
+Later versions may append fields, but not change these; a receiver reads the
+fields it knows and ignores the rest.  Receivers accept both formats, so
+CASUs that still send text can be mixed with ones sending binary.
+
+LinkStats uses the sequence numbers and send times to count lost and
+repeated/out-of-order messages, and the latency, per sender.  Latencies are
+only as good as the clock synchronisation between the CASUs.
+
+'''
+
+import struct
+
+MAGIC   = '\xca\xb5'
+VERSION = 1
+
+#{{{ message types and layout
+BEE_COUNT = 1
+
+_MSG = struct.Struct('<2sBBIdd')   # magic, version, type, seq, sent, value
+SIZE = _MSG.size
+SEQ_MOD = 1 << 32
+#}}}
+
+#{{{ encode / decode
+def pack(mtype, seq, sent, value):
+    return _MSG.pack(MAGIC, VERSION, mtype, seq % SEQ_MOD, sent, value)
+
+def is_binary(buf):
+    return buf[:2] == MAGIC
+
+def unpack(buf):
+    '''
+    (type, seq, sent, value) of a binary message, or None if `buf` is not
+    one (e.g. a legacy text message).
+    '''
+    if len(buf) < SIZE or buf[:2] != MAGIC:
+        return None
+    magic, version, mtype, seq, sent, value = _MSG.unpack_from(buf)
+    return mtype, seq, sent, value
+
+def format_text(value, prefix=''):
+    ''' legacy text form of a bee count '''
+    if prefix:
+        return "{} {:.3f}".format(prefix, value)
+    return "{:.3f}".format(value)
+
+def parse_text(txt, prefix=''):
+    '''
+    the bee count in a legacy text message, or None if it does not start
+    with `prefix` (e.g. a fish-side message)
+    '''
+    txt = txt.strip()
+    if prefix:
+        if not txt.startswith(prefix):
+            return None
+        txt = txt[len(prefix):]
+    # should just have a number now; discard anything trailing
+    return float(txt.split()[0])
+#}}}
+
+#{{{ LinkStats
+class LinkStats(object):
+    '''
+    per-sender counts of received, lost and repeated/out-of-order binary
+    messages, and latency; summary() covers the time since the last one.
+    '''
+    FIELDS = ['rx', 'lost', 'dup', 'lat_mean', 'lat_max']
+
+    def __init__(self):
+        self._last_seq = {}
+        self._acc = {}
+
+    def rx(self, sender, seq, sent, now):
+        acc = self._acc.get(sender)
+        if acc is None:
+            acc = self._acc[sender] = [0, 0, 0, 0.0, float('-inf')]
+        last = self._last_seq.get(sender)
+        if last is not None:
+            gap = (seq - last) % SEQ_MOD
+            if gap == 0 or gap >= SEQ_MOD // 2:
+                acc[2] += 1   # repeated, or older than one already seen
+                return
+            acc[1] += gap - 1
+        self._last_seq[sender] = seq
+        lat = now - sent
+        acc[0] += 1
+        acc[3] += lat
+        if lat > acc[4]:
+            acc[4] = lat
+
+    def summary(self, reset=True):
+        ''' {sender: [rx, lost, dup, lat_mean, lat_max]} '''
+        out = {}
+        for sender, (n, lost, dup, lat_sum, lat_max) in self._acc.items():
+            out[sender] = [n, lost, dup, lat_sum / n if n else float('nan'),
+                           lat_max if n else float('nan')]
+        if reset:
+            self._acc = {}
+        return out
+#}}}
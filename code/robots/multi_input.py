@@ -8,6 +8,7 @@ import numpy as np
 #from assisipy import casu ## lib is used directly only in mini_enh
 
 import libcas
+import msgcodec
 from mini_enh import Enhancer
 
 #{{{ definitions for color output and states
@@ -46,6 +47,7 @@ class EnhancerDualInput(Enhancer):
     '''
     # inherit everything from bee-only 'enhancer' class
     MSG_PREFIX_BEECASU = "bee-casu-avg|"
+    BEE_INPUTS_PRESMOOTHED = True
 
     # methods that need to be updated are
     # 1. receiving and filtering messages
@@ -78,26 +80,22 @@ class EnhancerDualInput(Enhancer):
     #{{{ memory initialiser -- reimplemented
     def _init_hist_vars(self):
         '''
-        variables (arrays/dicts of arrays) for historical records
+        variables for historical records, all held in one NeighbourhoodStore
         - of bee casu inputs, and states
         - of fish casu inputs and anything else from CATS
+        (fish sources are averaged over FISH_HIST_LEN, so rows are sized
+        for the longer of the two)
         '''
+        hist_len = max(self.HIST_LEN, self.FISH_HIST_LEN)
+        self.nh = libcas.NeighbourhoodStore(
+            hist_len, extra_windows=self.hist_windows(0))
         # bee data
-        self.bee_hist = {} # record the bee counts from each relevant source
-        self.bee_hist['self'] = np.zeros(self.HIST_LEN,)
-
-        self.smoothed_bee_hist = {}  # keep track of time-averaged data
-        self.smoothed_bee_hist['self'] = 0.0
-
-        self.state_contribs = {}     # keep track of contributions to temp
-        self.state_contribs['self'] = 0.0
-        self.contrib_parts = {}
-        self.contrib_parts['self'] = (self.SELF_WEIGHT, 0.0)
+        self.bee_sources = ['self', ]
+        self.nh.add_source('self', self.SELF_WEIGHT, self.AVG_HIST_LEN)
+        self._self_row = self.nh.index['self']
 
         # fish-side data
-        self.fish_hist = {} # record the fish directions
-        self.smoothed_fish_hist = {}  # keep track of time-averaged data
-        self.state_contribs_from_fish = {} # different comp in fsh/bee data
+        self.fish_sources = []
     #}}}
     #{{{ neighbourhood setup -- bee inherited, fish added here.
     def _init_neighbourhood(self):
@@ -122,9 +120,14 @@ class EnhancerDualInput(Enhancer):
                     'tomem' : False,
                     'drn'   : 'Undef', # CW/CCW/ Undef
                     }
-            self.fish_hist[neigh] = np.zeros(self.FISH_HIST_LEN,)
-            self.smoothed_fish_hist[neigh] = 0.0
-            self.state_contribs_from_fish[neigh] = 0.0
+            # weights are contained in the conf file. A fish source with
+            # the same name as a bee-casu neighbour is rejected by the store
+            self.nh.add_source(neigh, self.fish_inmap[neigh], self.FISH_HIST_LEN)
+            self.fish_sources.append(neigh)
+
+    def _init_views(self):
+        Enhancer._init_views(self)
+        self.smoothed_fish_hist = self.nh.view('smoothed', self.fish_sources)
 
     #}}}
 
@@ -175,33 +178,15 @@ class EnhancerDualInput(Enhancer):
     def update_averages(self):
         self.update_bee_averages()
         self.update_fish_averages()
+        self.nh.update(self.ts)
 
     def update_fish_averages(self):
         # put newest data into buffers
+        rows, vals = [], []
         for neigh, data in self.fish_most_recent_rx.items():
             if data['tomem'] is False and (self.ts - data['when']) < self.MAX_MSG_AGE:
-                libcas.push_data_1d(self.fish_hist[neigh], data['count'])
-                data['tomem'] = True
-            else:
-                if data['tomem'] is False:
-                    # we must be with out of date info. Emit a message
-                    print "[W]{} old info (data from {}; now:{} => age={}, thr {} [already transferred? {}])".format(
-                        self.name, data['when'], self.ts, self.ts - data['when'],
-                        self.MAX_MSG_AGE, data['tomem'])
-
-        # now compute average over last samples.
-        valid = min(self.ts, self.FISH_HIST_LEN)
-
-        for neigh in self.fish_hist:
-            vd = np.array(self.fish_hist[neigh][0:valid])
-            self.smoothed_fish_hist[neigh] = vd.mean()
-
-
-    def update_bee_averages(self):
-        # buffer neighbour data
-        for neigh, data in self.most_recent_rx.items():
-            if data['tomem'] is False and (self.ts - data['when']) < self.MAX_MSG_AGE:
-                libcas.push_data_1d(self.bee_hist[neigh], data['count'] )
+                rows.append(self.nh.index[neigh])
+                vals.append(data['count'])
                 data['tomem'] = True
             else:
                 if data['tomem'] is False:
@@ -210,39 +195,24 @@ class EnhancerDualInput(Enhancer):
                         self.name, data['when'], self.ts, self.ts - data['when'],
                         self.MAX_MSG_AGE, data['tomem'])
 
-        # we always have an update for self, so put that in too.
-        libcas.push_data_1d(self.bee_hist['self'], self.current_count)
-
-        self.state_contribs = {}     # keep track of contributions to temp
-
-        for neigh in self.smoothed_bee_hist: # including 'self' here
-            if neigh == 'self':
-                w = self.SELF_WEIGHT
-            else:
-                w = self.in_map[neigh].get('w')
-
-            v = self.smoothed_bee_hist[neigh]
-            self.state_contribs[neigh] = w * v
-
-
-        valid = min(self.ts, self.AVG_HIST_LEN)
+        self.nh.push(rows, vals)
 
-        for neigh in self.bee_hist: # including 'self' here
-            vd = np.array(self.bee_hist[neigh][0:valid])
-            self.smoothed_bee_hist[neigh] = vd.mean()
+    # update_bee_averages is as per the bee-only sys
     #}}}
 
     #{{{ tx_count
     def tx_count(self, dest, suppression=False):
         x_tx =  float(self.smoothed_bee_hist['self']) # default - send signal
         if suppression: x_tx = 0.0 # if this node is currently suppr, send zero.
-        s = "{} {:.3f}".format(self.MSG_PREFIX_BEECASU, x_tx)
+        if not self.tx_due(dest, x_tx):
+            return
+        s = self.encode_count(dest, x_tx)
         if self.verb > 2 or (suppression is True and self.verb > 1):
-            print "\t[i]==> {} send msg ({} by): '{}' bees, to {} (s {:.2f}| i{:.2f} |tx {:.2f})".format(
-                self.name, len(s), s, dest, self.smoothed_bee_hist['self'],
+            print "\t[i]==> {} send msg ({} by): '{:.3f}' bees, to {} (s {:.2f}| i{:.2f} |tx {:.2f})".format(
+                self.name, len(s), x_tx, dest, self.smoothed_bee_hist['self'],
                 self.unclipped_activation, x_tx)
 
-        self._casu.send_message(dest, s)
+        self.send_msg(dest, s)
     #}}}
     #{{{ emit_to_neighbours
     def emit_to_neighbours(self):
@@ -260,47 +230,53 @@ class EnhancerDualInput(Enhancer):
         for neigh, enable  in self.fish_outmap.items():
             if enable:
                 #print "[D4ftx] sending {} to {}.".format(self.name, str(self.smoothed_bee_hist['self']), neigh)
-                self._casu.send_message(neigh, str(self.smoothed_bee_hist['self']))
+                x_tx = float(self.smoothed_bee_hist['self'])
+                if self.TX_FISH_SUPPRESS and not self.tx_due(neigh, x_tx):
+                    continue
+                self.send_msg(neigh, str(self.smoothed_bee_hist['self']))
 
     #}}}
 
     #{{{ recv_all_incoming
     def recv_all_incoming(self, retry_cnt=0):
         '''
-        this returns two maps, one fish and one bee.
+        this returns two maps, one fish and one bee: the newest count from
+        each bee neighbour, and the newest direction of each fish, among the
+        waiting messages (at most RX_MAX_MSGS / RX_MAX_TIME worth).
         '''
         bee_msgs = {}
         fish_msgs = {}
-        try_cnt = 0
-        while True:
-            msg = self._casu.read_message()
-
-            if msg:
-                txt = msg['data'].strip()
-                src = msg['sender']
-                # work out the type, and add to relevant map.
-                if txt.startswith(self.MSG_PREFIX_BEECASU):
-                    txt = txt.lstrip(self.MSG_PREFIX_BEECASU) # remove pre
-                    # should just have a number now; discard anything trailing
-                    nb = float(txt.split()[0])
-                    bee_msgs[src] = nb
-
-                    if self.verb > 1:
-                        print "\t[i]<== {3} recv msg ({2} by): '{1}' bees, {4} from {0} {5}".format(
-                            msg['sender'], nb, len(msg['data']), self.name, BLU, ENDC)
-                else:
-                    # all other messages fish related
-                    #print('[Dmsg] Rx-fish: {} from {}'.format(msg['data'], msg['sender']) )
-                    data = msg['data'].split(',')
-                    for item in data:
-                        (fish,direction) = item.split(':')
-                        fish_msgs[fish] = direction.strip()
-
+        latest = {}
+        for msg in self.drain_messages(retry_cnt):
+            data = msg['data']
+            # work out the type, and add to relevant map.
+            if msgcodec.is_binary(data) or data.lstrip().startswith(self.MSG_PREFIX_BEECASU):
+                self.conflate(latest, msg['sender'], msg)
             else:
-                # buffer emptied, return
-                try_cnt += 1
-                if try_cnt > retry_cnt:
-                    break
+                # all other messages fish related
+                #print('[Dmsg] Rx-fish: {} from {}'.format(msg['data'], msg['sender']) )
+                try:
+                    items = [item.split(':') for item in data.split(',')]
+                    for (fish, direction) in items:
+                        if fish in fish_msgs:
+                            self.rx_counts['superseded'] += 1
+                        fish_msgs[fish] = direction.strip()
+                except ValueError:
+                    self.rx_counts['dropped'] += 1
+
+        for src, msg in latest.iteritems():
+            try:
+                nb = self.decode_count(msg)
+            except (ValueError, IndexError):
+                self.rx_counts['dropped'] += 1
+                continue
+            if nb is None:
+                continue # a message type this controller has no use for
+            bee_msgs[src] = nb
+
+            if self.verb > 1:
+                print "\t[i]<== {3} recv msg ({2} by): '{1}' bees, {4} from {0} {5}".format(
+                    msg['sender'], nb, len(msg['data']), self.name, BLU, ENDC)
 
         return bee_msgs, fish_msgs
     #}}}
@@ -308,54 +284,24 @@ class EnhancerDualInput(Enhancer):
     #}}}
 
     #{{{ compute_state_contribs
-    def compute_state_contribs(self):
-        self.state_contribs = {}     # keep track of contributions to temp
-        self.contrib_parts = {} # for logging it turns out I want v, w too
-        # bee side
-        for neigh in self.smoothed_bee_hist: # including 'self' here
-            if neigh == 'self':
-                w = self.SELF_WEIGHT
-                v = self.smoothed_bee_hist[neigh]
-            else: # incoming data is already smoothed
-                w = self.in_map[neigh].get('w')
-                v = self.bee_hist[neigh][0] # newest at front.
-
-            self.state_contribs[neigh] = w * v
-            self.contrib_parts[neigh] = (w,v)
-
-        # --- fish side ---
-        # there is no "self" here - but the weights are contained in the
-        # conf file.
-        for neigh in self.smoothed_fish_hist:
-            v = self.smoothed_fish_hist[neigh]
-            w = self.fish_inmap.get(neigh, 0.0) # TODO: warn if not presnt?
-            self.state_contribs[neigh] = w * v
-            self.contrib_parts[neigh] = (w,v)
-
-        #TODO: should check whether any keys are common to the 2 dicts
-        #    : since this would mask one set of signals
-
-
+    # bee-casu neighbours send data that is already smoothed, so the store
+    # weights their newest value (see BEE_INPUTS_PRESMOOTHED); self and fish
+    # sources use the time-averaged value. Contributions are then computed
+    # by the store in update(), as per the bee-only sys.
     #}}}
     #{{{ compute_activation_level
     def compute_activation_level(self):
-        activation_level = 0.0
+        activation_level = self.nh.activation
         if self.EXOG_BIAS != 0:
             activation_level += self.EXOG_BIAS
-        _nh_fields = [ len(self.state_contribs), ]
-        for neigh, contrib in self.state_contribs.items():
-            activation_level += contrib
-            w, v = self.contrib_parts[neigh] # short handles
-            if self.DEV_VERB and ((self.ts % self.FREQ_RPT_INPUTS) == 0):
+        nh = self.nh
+        if self.DEV_VERB and ((self.ts % self.FREQ_RPT_INPUTS) == 0):
+            for i, neigh in enumerate(nh.names):
+                w, v, contrib = nh.weights[i], nh.inputs[i], nh.contribs[i] # short handles
                 print "\t{:14}: {:+.2f} {:+.2f} | w={:+.2f}".format(
                         neigh, v, contrib, w)
-            # log line. data length varies due to #edges
-            #>>>ty, time, num_neigh,
-            #  <who, weight, raw, contrib, > for each edge. <<<
-            _nh_fields += [neigh,  w, v, contrib]
-
-        self.write_logline(ty="NH_DATA", suffix=
-                self._log_delimiter.join([str(f) for f in _nh_fields]))
+        # log line. data length varies due to #edges
+        self.write_nh_data(nh.names, nh.weights, nh.inputs, nh.contribs)
 
         self.unclipped_activation = float(activation_level)
         # clip in [0, 1]
@@ -379,19 +325,20 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--conf', type=str, default=None)
     parser.add_argument('-o', '--output', type=str, default=None)
     parser.add_argument('--nbg', type=str, default=None)
+    parser.add_argument('--fast-restart', action='store_true',
+                        help="resume a recent run of this CASU (see FAST_RESTART)")
     args = parser.parse_args()
     #}}}
 
     # instantiate object with config file
     c = EnhancerDualInput( args.name, logpath=args.output,
-            conf_file=args.conf, nbg_file=args.nbg)
+            conf_file=args.conf, nbg_file=args.nbg,
+            fast_restart=args.fast_restart or None)
 
     if c.verb > 0: print "bee bifurcation enhancer - bee and fish inputs. Connected to {}".format(c.name)
     # execute main loop that handles the hang-up interrupt ok
     try:
-        while True:
-            time.sleep(c.MAIN_LOOP_INTERVAL)
-            c.one_cycle()
+        c.run() # one_cycle every MAIN_LOOP_INTERVAL, on fixed deadlines
     except KeyboardInterrupt:
         print "shutting down casu {}".format(c.name)
         c.stop()
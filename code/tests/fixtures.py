@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+shared setup for tests that need a whole controller on the in-memory
+backend (see fake_casu).
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import yaml
+
+import fake_casu
+import mini_enh
+
+PAIR_NBG = '''digraph "pair" {
+    subgraph "bee-arena" {
+        "bee-arena/casu-031" -> "bee-arena/casu-032" [label = "casu-032"; weight=-1.5]
+        "bee-arena/casu-032" -> "bee-arena/casu-031" [label = "casu-031"; weight=-1.5]
+    }
+}
+'''
+
+class ControllerCase(unittest.TestCase):
+    ''' Enhancers for casu-031 (neighbour casu-032) in a temporary directory '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)   # calibration caches are written to the cwd
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        self.nbg = os.path.join(self.tmp, 'pair.nbg')
+        with open(self.nbg, 'w') as f:
+            f.write(PAIR_NBG)
+        os.mkdir(os.path.join(self.tmp, 'logs'))
+        self.ctrls = []
+
+    def tearDown(self):
+        for c in self.ctrls:
+            c.stop()
+        sys.stdout = self.stdout
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def make(self, ir=100.0, **conf):
+        '''
+        an Enhancer with `conf` as its controller conf, its IR sensors
+        reading `ir` (a level, or a trace: a function of the time)
+        '''
+        conf_file = os.path.join(self.tmp, 'c.conf')
+        with open(conf_file, 'w') as f:
+            yaml.safe_dump(conf, f)
+        self.backend = fake_casu.FakeBackend(
+            clock=fake_casu.VirtualClock(), nbg_file=self.nbg,
+            default_ir=ir if callable(ir) else fake_casu.constant_ir(ir))
+        c = mini_enh.Enhancer(os.path.join(self.tmp, 'casu-031'),
+                              logpath=os.path.join(self.tmp, 'logs'),
+                              conf_file=conf_file, nbg_file=self.nbg, backend=self.backend,
+                              calib_log=os.path.join(self.tmp, 'calib_log'))
+        self.ctrls.append(c)
+        return c
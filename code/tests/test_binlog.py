@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+binary log records convert back to the lines the text logger writes.
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import unittest
+import numpy as np
+
+import binlog
+
+def text_line(fields):
+    ''' as libcas.BaseCASUCtrl.write_logline joins fields '''
+    return ';'.join([str(f) for f in fields])
+
+class TestBinlogConversion(unittest.TestCase):
+
+    def test_lines_match_text_logger(self):
+        enc = binlog.BinaryLogEncoder()
+        now = 1700000066.8
+        names = ['self', 'casu-032']
+        w = np.array([1.0, -1.5])
+        inp = np.array([1 / 360.0, 5e-05])
+        con = w * inp
+        ir = [100.0, 101.25, 1 / 3.0, 99.0, 100.0, 2e-7]
+        temps = [26.033057092412345, 26.1, 25.9, 26.0]
+        calcs = [0.1 + 0.2, 8.0 * (0.1 + 0.2)]
+
+        buf = enc.file_header(now, 'casu-031', {1: 'STATE_FIXED_TEMP'})
+        buf += enc.ir(now, ir)
+        buf += enc.heat(now, temps, 28.0, True)
+        buf += enc.heat_calcs(now, calcs)
+        buf += enc.mode(now, 1)
+        buf += enc.nh_data(now, names, w, inp, con)
+        buf += enc.text(now, "# a comment\n")
+
+        nh_fields = ['nh_data', now, 2]
+        for i, n in enumerate(names):
+            nh_fields += [n, w[i], inp[i], con[i]]
+        expected = [
+            text_line(['ir_array', now] + ir),
+            text_line(['temperatures', now] + temps + [28.0, 1]),
+            text_line(['heat_calcs', now] + calcs),
+            text_line(['state', now, 1, 'STATE_FIXED_TEMP']),
+            text_line(nh_fields),
+            "# a comment",
+        ]
+        self.assertEqual(list(binlog.to_text_lines(buf)), expected)
+
+    def test_truncated_record_ignored(self):
+        enc = binlog.BinaryLogEncoder()
+        buf = enc.file_header(1.0, 'casu-031', {}) + enc.ir(1.0, [1.0] * 6)
+        lines = list(binlog.to_text_lines(buf + enc.ir(2.0, [2.0] * 6)[:-3]))
+        self.assertEqual(len(lines), 1)
+
+    def test_not_a_binary_log(self):
+        self.assertRaises(ValueError, list, binlog.to_text_lines("ir_array;1.0;2.0\n"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+IR calibration on the in-memory backend: the calibration cache, and the
+streaming quantile estimator.
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import numpy as np
+import yaml
+
+import calibration
+import fake_casu
+from fixtures import ControllerCase
+
+class TestCalibrationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conf = os.path.join(self.tmp, 'calib.yaml')
+        with open(self.conf, 'w') as f:
+            yaml.safe_dump({'cache_max_age': 3600, 'use_diag_led': False}, f)
+        self.clock = fake_casu.VirtualClock()
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmp)
+
+    def _calibrate(self, ir):
+        be = fake_casu.FakeBackend(clock=self.clock, default_ir=fake_casu.constant_ir(ir))
+        cal = calibration.CalibrateSensors(os.path.join(self.tmp, 'casu-031'),
+                                           os.path.join(self.tmp, 'calib_log'),
+                                           conf_file=self.conf, backend=be)
+        cal.calibrate()
+        self.clock.sleep(60.0)
+        return cal.calib_data['source']
+
+    def test_reused_when_sensors_agree(self):
+        self.assertEqual(self._calibrate(100.0), 'measured')
+        self.assertEqual(self._calibrate(100.0), 'cache')
+        self.assertEqual(self._calibrate(104.0), 'cache')   # within the noise band
+
+    def test_swapped_board_recalibrates(self):
+        self.assertEqual(self._calibrate(100.0), 'measured')
+        self.assertEqual(self._calibrate(300.0), 'measured')   # reads far higher
+        self.assertEqual(self._calibrate(300.0), 'cache')      # the new calibration
+        self.assertEqual(self._calibrate(0.0), 'measured')     # a dead sensor
+
+    def test_cache_without_baseline_recalibrates(self):
+        self.assertEqual(self._calibrate(100.0), 'measured')
+        fn = os.path.join(self.tmp, 'casu-031' + calibration.CalibrateSensors.CACHE_EXT)
+        with open(fn) as f:
+            data = yaml.safe_load(f)
+        del data['casu-031']['IR_mean']
+        with open(fn, 'w') as f:
+            yaml.safe_dump(data, f)
+        self.assertEqual(self._calibrate(100.0), 'measured')
+
+class TestP2Quantile(unittest.TestCase):
+
+    def _check(self, x, p, n_exact, tol):
+        est = calibration.P2Quantile(p, n_exact)
+        for v in x:
+            est.add(v)
+        spread = np.percentile(x, 97.5) - np.percentile(x, 2.5)
+        self.assertLess(abs(est.value() - np.percentile(x, 100 * p)), tol * spread)
+
+    def test_matches_percentile(self):
+        rng = np.random.RandomState(1)
+        samples = {
+            'normal'   : rng.normal(100.0, 5.0, 4000),
+            'uniform'  : rng.uniform(0.0, 1.0, 4000),
+            'lognormal': rng.lognormal(3.0, 0.5, 4000),
+            'spiky'    : np.where(rng.uniform(size=4000) < 0.02, 1000.0,
+                                  rng.normal(80.0, 3.0, 4000)),
+        }
+        for name, x in sorted(samples.items()):
+            for p in (0.5, 0.9):
+                for n_exact in (5, 10, 32):
+                    self._check(x, p, n_exact, 0.02)
+
+    def test_exact_up_to_n_exact(self):
+        x = np.random.RandomState(2).normal(0.0, 1.0, 10)
+        est = calibration.P2Quantile(0.9, 10)
+        for v in x[:9]:
+            est.add(v)
+        self.assertAlmostEqual(est.value(), np.percentile(x[:9], 90))
+        est.add(x[9])
+        self.assertIsNotNone(est.q)       # P-square from here on
+
+    def test_calibration_runs_p2(self):
+        # with the default 30 steps, the markers are placed after min_steps
+        clock = fake_casu.VirtualClock()
+        be = fake_casu.FakeBackend(clock=clock, default_ir=fake_casu.constant_ir(100.0))
+        tmp = tempfile.mkdtemp()
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            cal = calibration.CalibrateSensors(os.path.join(tmp, 'casu-031'),
+                                               os.path.join(tmp, 'calib_log'), backend=be)
+            seen = []
+            orig = calibration.P2Quantile.add
+            def add(est, x):
+                orig(est, x)
+                seen.append(est.q is not None)
+            calibration.P2Quantile.add = add
+            try:
+                cal.calibrate()
+            finally:
+                calibration.P2Quantile.add = orig
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(tmp)
+        self.assertLessEqual(cal.min_steps, cal.calib_steps)
+        self.assertTrue(any(seen))
+
+class TestIRBaselineTracker(unittest.TestCase):
+    CALIB = {'IR': [120.0] * 7, 'IR_mean': [100.0] * 7}
+
+    def feed(self, tr, levels, t0, secs, dt=1.0):
+        ''' levels(t) every dt s over [t0, t0 + secs); returns the end time '''
+        t = t0
+        while t < t0 + secs:
+            tr.update([levels(t)] * 7, t)
+            t += dt
+        return t
+
+    def test_follows_slow_drift(self):
+        tr = calibration.IRBaselineTracker(self.CALIB, tau=600.0)
+        # the no-bee level creeps up by 5 over two hours
+        self.feed(tr, lambda t: 100.0 + 5.0 * t / 7200.0, 0.0, 7200.0)
+        d = tr.drift()[0]
+        self.assertTrue(4.0 < d < 5.0, d)           # lags by about tau * rate
+        self.assertAlmostEqual(tr.thresh[0], 120.0 + d)
+        self.assertEqual(tr.drift(), [d] * 7)
+
+    def test_ignores_a_bee(self):
+        tr = calibration.IRBaselineTracker(self.CALIB, tau=600.0)
+        t = self.feed(tr, lambda t: 100.0, 0.0, 60.0)
+        n = tr.n_updates
+        # a bee on the sensors for 2 minutes: above the threshold, not tracked
+        t = self.feed(tr, lambda t: 400.0, t, 120.0)
+        self.assertEqual(tr.n_updates, n)
+        self.assertEqual(tr.thresh, [120.0] * 7)
+        # and the first readings after it are not used either
+        tr.update([100.0] * 7, t)
+        self.assertEqual(tr.n_updates, n)
+
+    def test_short_step_barely_moves(self):
+        tr = calibration.IRBaselineTracker(self.CALIB, tau=600.0)
+        # a step within the unoccupied band, for 10 s, then back
+        t = self.feed(tr, lambda t: 100.0, 0.0, 60.0)
+        t = self.feed(tr, lambda t: 109.0, t, 10.0)
+        self.feed(tr, lambda t: 100.0, t, 10.0)
+        self.assertLess(abs(tr.drift()[0]), 0.2)
+
+    def test_drift_bounded(self):
+        tr = calibration.IRBaselineTracker(self.CALIB, tau=60.0, max_drift=0.05)
+        self.feed(tr, lambda t: 109.0, 0.0, 3600.0)
+        self.assertAlmostEqual(tr.drift()[0], 6.0)   # 0.05 * 120
+        self.assertAlmostEqual(tr.thresh[0], 126.0)
+
+def drifting_ir(rate, after=60.0):
+    ''' 100, rising by `rate` per s from `after` s on (calibration is flat) '''
+    start = []
+    def trace(t):
+        if not start:
+            start.append(t)
+        return [100.0 + rate * max(0.0, t - start[0] - after)] * fake_casu.N_IR
+    return trace
+
+class TestBaselineTrackingInController(ControllerCase):
+
+    def run_cycles(self, c, n):
+        for i in xrange(n):
+            c.one_cycle()
+            c.clock.sleep(c.MAIN_LOOP_INTERVAL)
+
+    def test_off_by_default(self):
+        c = self.make(ir=drifting_ir(0.02))
+        self.assertIsNone(c.ir_baseline)
+        thresh = list(c.ir_thresh)
+        self.run_cycles(c, 2000)
+        self.assertEqual(c.ir_thresh, thresh)
+        self.assertEqual(c.ir_thresh, c.calib_data['IR'])
+
+    def test_on_follows(self):
+        c = self.make(ir=drifting_ir(0.02), IR_BASELINE_TRACK=True, IR_BASELINE_TAU=60.0)
+        thresh = list(c.ir_thresh)
+        self.run_cycles(c, 2000)
+        self.assertTrue(all(t > t0 + 1.0 for t, t0 in zip(c.ir_thresh, thresh)))
+        self.assertEqual(c.current_count, 0.0)   # the drift is not counted as bees
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+the heater step of the Enhancer: the temperature it starts from
+(get_inst_Tactual) and the step towards the target (clipped_dT).
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import unittest
+
+from fixtures import ControllerCase
+import libcas
+
+class TestHeatStep(ControllerCase):
+
+    def test_step_towards_target(self):
+        c = self.make(DT_MAX=0.25, MIN_TEMP=28.0, MAX_TEMP=36.0)
+        c.inst_Tactual = 28.0
+        self.assertEqual(c.clipped_dT(5.0), (0.25, 1.0))
+        self.assertEqual(c.inst_Ttgt, 33.0)
+        c.inst_Tactual = 32.9
+        mag, sgn = c.clipped_dT(5.0)
+        self.assertAlmostEqual(mag, 0.1)
+        self.assertEqual(sgn, 1.0)
+        c.inst_Tactual = 30.0
+        self.assertEqual(c.clipped_dT(0.0), (0.25, -1.0))
+        c.inst_Tactual = 28.0
+        self.assertEqual(c.clipped_dT(0.0), (0.0, 1.0))
+
+    def test_tactual_from_ring(self):
+        c = self.make()
+        ring = libcas.SensorSnapshot.RING_TEMPS
+        c.snap.temps = dict(zip(ring, [27.0, 29.0, 28.5, 27.5]))
+        self.assertEqual(c.get_inst_Tactual(), 28.0)
+        # implausible readings are left out; if none are left, keep the last
+        c.snap.temps = dict(zip(ring, [27.0, 29.0, 60.0, -5.0]))
+        self.assertEqual(c.get_inst_Tactual(), 28.0)
+        c.inst_Tactual = 30.5
+        c.snap.temps = dict(zip(ring, [60.0, 0.0, 99.0, -1.0]))
+        self.assertEqual(c.get_inst_Tactual(), 30.5)
+
+    def test_relative_targets_refused_at_start(self):
+        self.assertRaises(ValueError, self.make, EXP_CAMODEL_DELTATEMPS=True)
+
+    def test_cycles_step_at_most_dt_max(self):
+        c = self.make(INIT_NOHEAT_PERIOD_MINS=0.0, INIT_FIXHEAT_PERIOD_MINS=0.0)
+        for i in xrange(50):
+            c.one_cycle()
+            self.assertLessEqual(abs(c.inst_Tref - c.inst_Tactual), c.DT_MAX + 1e-9)
+            c.clock.sleep(c.MAIN_LOOP_INTERVAL)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+HistBuffer against the shifted-array history it replaced (push_data_1d).
+
+    $ python -m unittest discover -s code/tests
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import unittest
+import numpy as np
+
+import libcas
+
+class TestHistBuffer(unittest.TestCase):
+    HIST_LEN = 15
+    AVG_LEN = 10
+
+    def setUp(self):
+        self.rng = np.random.RandomState(1)
+
+    def test_matches_shifted_array(self):
+        ''' every index, slice and the mean of the valid part, over several wraps '''
+        h = libcas.HistBuffer(self.HIST_LEN)
+        ref = np.zeros(self.HIST_LEN,)
+        for ts in xrange(1, 5 * self.HIST_LEN + 3):
+            x = self.rng.uniform(0, 1)
+            h.push(x)
+            libcas.push_data_1d(ref, x)
+
+            self.assertEqual(h.tolist(), ref.tolist())
+            for i in xrange(self.HIST_LEN):
+                self.assertEqual(h[i], ref[i])
+            self.assertEqual(h[-1], ref[-1])
+            valid = min(ts, self.AVG_LEN)
+            self.assertEqual(list(h[0:valid]), list(ref[0:valid]))
+            self.assertEqual(np.mean(h[0:valid]), np.mean(ref[0:valid]))
+        self.assertEqual(h.n_pushed, 5 * self.HIST_LEN + 2)
+
+    def test_fill_and_bounds(self):
+        h = libcas.HistBuffer(4, fill=-1.0)
+        self.assertEqual(h.tolist(), [-1.0] * 4)
+        self.assertEqual(len(h), 4)
+        self.assertRaises(IndexError, h.__getitem__, 4)
+        self.assertRaises(IndexError, h.__getitem__, -5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+CasuHost on the in-memory backend: two CASUs of the 2way setup in one
+process, one of them failing, at start-up or in its cycle.
+'''
+
+import os, sys
+ROBOTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots')
+sys.path.insert(0, ROBOTS)
+
+import glob
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import fake_casu
+import host_casus
+
+CONF_DIR = os.path.join(ROBOTS, '..', '..', 'configs', '2way')
+CASUS = ['casu-031', 'casu-032']
+
+class Boom(Exception):
+    pass
+
+class TestCasuHost(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()   # controllers are chatty
+        os.chdir(self.tmp)   # calibration logs are written to the cwd
+        os.mkdir('logs')
+        # a copy of the setup, as the controllers write compiled .nh files next to the .nbg
+        for fn in glob.glob(os.path.join(CONF_DIR, '*.dep')) + \
+                  glob.glob(os.path.join(CONF_DIR, '*.conf')) + \
+                  glob.glob(os.path.join(CONF_DIR, '*.nbg')):
+            shutil.copy(fn, self.tmp)
+        self.entries = host_casus.read_dep('graz_setup.dep', casus=CASUS)
+        self.backend = fake_casu.FakeBackend(
+            nbg_file='graz_setup.nbg',
+            default_ir=fake_casu.constant_ir(100.0))
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def _host(self, entries=None):
+        return host_casus.CasuHost(entries or self.entries, self.tmp, rtc_dir=self.tmp,
+                                   logpath='logs', backend=self.backend, verb=0)
+
+    def test_both_run(self):
+        h = self._host()
+        h.start()
+        self.assertEqual([c.name for c in h.ctrls], CASUS)
+        h.run(n_cycles=20)
+        h.stop()
+        self.assertEqual(h.failed, {})
+        self.assertEqual([c.ts for c in h.ctrls], [20, 20])
+        # one calibration log each, not a shared one
+        self.assertEqual(sorted(glob.glob('*_calib_log')),
+                         ['{}_calib_log'.format(n) for n in CASUS])
+
+    def test_cycle_error_stops_only_that_casu(self):
+        h = self._host()
+        h.start()
+        bad, good = h.ctrls
+        def fail():
+            if bad.ts >= 5:
+                raise Boom("sensor gone")
+            bad.__class__.one_cycle(bad)
+        bad.one_cycle = fail
+        h.run(n_cycles=20)
+        h.stop()
+        self.assertEqual(good.ts, 20)
+        self.assertEqual(bad.ts, 5)
+        self.assertEqual(h.failed.keys(), [bad.name])
+        self.assertTrue(isinstance(h.failed[bad.name], Boom))
+        self.assertIn("1 of 2 CASUs stopped after errors: casu-031", sys.stdout.getvalue())
+
+    def test_start_error_stops_all(self):
+        entries = []
+        for layer, name, spec in self.entries:
+            spec = dict(spec)
+            if name == 'casu-032':
+                spec['args'] = ['-c no_such.conf', '--nbg graz_setup.nbg']
+            entries.append((layer, name, spec))
+        h = self._host(entries)
+        self.assertRaises(IOError, h.start)
+        self.assertEqual(h.failed.keys(), ['casu-032'])
+        self.assertEqual([c.name for c in h.ctrls], ['casu-031'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+the built-in .nbg (DOT subset) parser: the shipped graphs give the in/out
+maps that pygraphviz gave (and are compared with it directly where it is
+installed), and the syntax the .nbg files may use is handled.
+'''
+
+import os, sys
+ROBOTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots')
+sys.path.insert(0, ROBOTS)
+
+import glob
+import unittest
+
+import interactions
+
+CONFIGS = os.path.normpath(os.path.join(ROBOTS, '..', '..', 'configs'))
+
+try:
+    import pygraphviz
+    HAVE_PGV = True
+except ImportError:
+    HAVE_PGV = False
+
+def maps(g):
+    ''' {node: (in_map, out_map)} as the controllers read them '''
+    return dict((str(n), (interactions.get_inmap(g, n), interactions.get_outmap(g, n)))
+                for n in g.nodes())
+
+def cats_out(*casus):
+    return dict((c, c) for c in casus)
+
+# the in/out maps of every node of the shipped graphs
+TO_CATS = ({}, {'cats': 'cats'})
+EXPECTED = {
+    '2way/graz_setup.nbg': {
+        'casu-031': TO_CATS,
+        'casu-032': TO_CATS,
+        'cats': ({}, cats_out('casu-031', 'casu-032')),
+    },
+    '2way_virt/graz_setup.nbg': {
+        'casu-031': TO_CATS,
+        'casu-032': TO_CATS,
+        'cats': ({}, cats_out('casu-031', 'casu-032')),
+    },
+    'b2f/graz_setup.nbg': {
+        'casu-022': ({'casu-023': {'w': -1.5, 'label': 'casu'}},
+                     {'casu-023': 'casu', 'cats': 'cats'}),
+        'casu-023': ({'casu-022': {'w': -1.5, 'label': 'casu'}},
+                     {'casu-022': 'casu', 'cats': 'cats'}),
+        'cats': ({}, cats_out('casu-022', 'casu-023')),
+    },
+    'f2b/graz_setup_2ba.nbg': {
+        'casu-006': TO_CATS,
+        'casu-007': TO_CATS,
+        'casu-008': TO_CATS,
+        'casu-009': TO_CATS,
+        'cats': ({}, cats_out('casu-006', 'casu-007', 'casu-008', 'casu-009')),
+    },
+}
+
+class TestShippedGraphs(unittest.TestCase):
+
+    def _files(self):
+        return sorted(os.path.relpath(fn, CONFIGS)
+                      for fn in glob.glob(os.path.join(CONFIGS, '*', '*.nbg')))
+
+    def test_every_nbg_is_covered(self):
+        self.assertEqual(self._files(), sorted(EXPECTED))
+
+    def test_maps(self):
+        for rel in self._files():
+            g = interactions.read_nbg(os.path.join(CONFIGS, rel), flat=True)
+            self.assertEqual(maps(g), EXPECTED[rel], rel)
+            # flattening the layered graph afterwards gives the same
+            g2 = interactions.flatten(interactions.read_nbg(os.path.join(CONFIGS, rel)))
+            self.assertEqual(maps(g2), EXPECTED[rel], rel)
+
+    @unittest.skipUnless(HAVE_PGV, "pygraphviz not installed")
+    def test_same_as_pygraphviz(self):
+        for rel in self._files():
+            fn = os.path.join(CONFIGS, rel)
+            self.assertEqual(maps(interactions.load_flat_nbg(fn)),
+                             maps(interactions.load_flat_nbg(fn, parser='pgv')), rel)
+
+class TestSyntax(unittest.TestCase):
+
+    def test_quoted_labels(self):
+        g = interactions.parse_nbg(r'''digraph "g" {
+            "layer a/casu-001" -> "layer a/casu-002" [label = "say \"hi\"", "weight" = "-0.5"]
+            casu_3 -> "layer a/casu-001" [label=plain]
+        }''', flat=True)
+        self.assertEqual(g.get_edge('casu-001', 'casu-002').attr,
+                         {'label': 'say "hi"', 'weight': '-0.5'})
+        self.assertEqual(interactions.get_inmap(g, 'casu-001'), {})
+        self.assertEqual(interactions.get_inmap(g, 'casu-002'),
+                         {'casu-001': {'w': -0.5, 'label': 'say "hi"'}})
+        self.assertEqual(interactions.get_outmap(g, 'casu_3'), {'casu-001': 'plain'})
+
+    def test_attribute_separators(self):
+        for attrs in ('label = "casu"; weight=-1.5', 'label="casu", weight=-1.5',
+                      'label=casu weight=-1.5', 'label="casu";weight=-1.5;',
+                      'label="casu"] [weight=-1.5'):
+            g = interactions.parse_nbg('digraph { a -> b [%s] }' % attrs)
+            self.assertEqual(g.get_edge('a', 'b').attr,
+                             {'label': 'casu', 'weight': '-1.5'}, attrs)
+
+    def test_comments(self):
+        g = interactions.parse_nbg('''
+        # a comment with "a" -> "b" [label = x] in it
+        digraph "c" { // trailing -> comment
+            a -> b /* inline [weight=9] */ [weight=1]
+            /* multi
+               line -> comment */
+            #"b" -> "a" [label = "casu"; weight=-1.5]
+            b -> c;
+        }''')
+        self.assertEqual(g.edges(), [('a', 'b'), ('b', 'c')])
+        self.assertEqual(g.get_edge('a', 'b').attr, {'weight': '1'})
+
+    def test_chains_and_defaults(self):
+        g = interactions.parse_nbg('''digraph {
+            edge [label=outer]
+            subgraph s { edge [weight=2]; a -> b -> c }
+            c -> a
+        }''')
+        self.assertEqual(g.edges(), [('a', 'b'), ('b', 'c'), ('c', 'a')])
+        self.assertEqual(g.get_edge('b', 'c').attr, {'label': 'outer', 'weight': '2'})
+        # defaults set inside a subgraph do not leak out of it
+        self.assertEqual(g.get_edge('c', 'a').attr, {'label': 'outer'})
+
+    def test_errors_give_line(self):
+        for src, line in (('digraph {\n a -> b [label="x"\n}', 2),
+                          ('digraph {\n a -> \n -> b }', 3),
+                          ('graph_ish {}', 1)):
+            try:
+                interactions.parse_nbg(src)
+            except interactions.NbgSyntaxError as e:
+                self.assertIn("line {}".format(line), str(e), src)
+            else:
+                self.fail("no error for {!r}".format(src))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+BufferedLogWriter: lines come out in order, and a failing disk is reported
+to the caller without stopping the writer thread.
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import errno
+import shutil
+import tempfile
+import time
+import unittest
+
+import logwriter
+
+class FlakyFile(object):
+    ''' a file whose writes fail with ENOSPC while `fail` is set '''
+    def __init__(self, fh):
+        self.fh = fh
+        self.fail = True
+
+    def write(self, s):
+        if self.fail:
+            raise IOError(errno.ENOSPC, "No space left on device")
+        self.fh.write(s)
+
+    def flush(self):
+        self.fh.flush()
+
+    def close(self):
+        self.fh.close()
+
+    @property
+    def closed(self):
+        return self.fh.closed
+
+class TestBufferedLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmp, 'test.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _wait_drained(self, w):
+        t0 = time.time()
+        while time.time() - t0 < 2.0:
+            with w._lock:
+                if not w._queue:
+                    break
+            time.sleep(0.01)
+        time.sleep(0.05)
+
+    def test_lines_in_order(self):
+        w = logwriter.BufferedLogWriter(self.fn, flush_interval=0.01)
+        for i in xrange(1000):
+            w.write("{}\n".format(i))
+        w.close()
+        with open(self.fn) as f:
+            self.assertEqual(f.read().split(), [str(i) for i in xrange(1000)])
+        self.assertRaises(ValueError, w.write, "late\n")
+
+    def test_write_error_reported_and_thread_survives(self):
+        w = logwriter.BufferedLogWriter(self.fn, flush_interval=0.01)
+        flaky = w._fh = FlakyFile(w._fh)
+        w.write("lost\n")
+        self._wait_drained(w)
+        self.assertTrue(w._thread.is_alive())
+        self.assertEqual(w.n_lost, 1)
+
+        # reported once, on the next write
+        self.assertRaises(IOError, w.write, "also lost\n")
+        flaky.fail = False
+        self.assertTrue(w.write("kept\n"))
+        w.close()
+        with open(self.fn) as f:
+            self.assertEqual(f.read(), "kept\n")
+        self.assertGreaterEqual(w.n_errors, 1)
+
+    def test_error_raised_on_close(self):
+        w = logwriter.BufferedLogWriter(self.fn, flush_interval=10.0)
+        w._fh = FlakyFile(w._fh)
+        w.write("lost\n")
+        self.assertRaises(IOError, w.close)
+        self.assertEqual(w.n_lost, 1)
+
+    def test_rotation(self):
+        w = logwriter.BufferedLogWriter(self.fn, flush_interval=0.01, rotate_bytes=100,
+                                        backups=2)
+        for i in xrange(30):
+            w.write("{:09d}\n".format(i))
+            self._wait_drained(w)
+        w.close()
+        self.assertTrue(os.path.exists(self.fn + '.1'))
+        self.assertTrue(os.path.exists(self.fn + '.2'))
+        self.assertFalse(os.path.exists(self.fn + '.3'))
+        for fn in (self.fn, self.fn + '.1'):
+            self.assertLessEqual(os.path.getsize(fn), 100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+counts between bee CASUs on the in-memory backend: when a count is sent
+(tx_due), and how a receiver uses the last one it got.
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import unittest
+
+from fixtures import ControllerCase
+
+class TestTxDue(ControllerCase):
+
+    def _sends(self, c, values, dt=0.5):
+        out = []
+        for i, v in enumerate(values):
+            c.snap.when = 1000.0 + i * dt
+            out.append(c.tx_due('casu-032', v))
+        return out
+
+    def test_no_heartbeat_sends_every_cycle(self):
+        c = self.make()
+        self.assertEqual(c.TX_HEARTBEAT, 0.0)
+        self.assertEqual(self._sends(c, [0.5] * 6), [True] * 6)
+        self.assertEqual((c.n_tx_sent, c.n_tx_suppressed), (6, 0))
+
+    def test_deadband_waits_for_heartbeat(self):
+        c = self.make(TX_HEARTBEAT=2.0, TX_DEADBAND=0.05)
+        # one every 2 s (4 cycles) while within the dead band
+        vals = [0.5, 0.52, 0.48, 0.5, 0.51, 0.5, 0.5, 0.5, 0.5]
+        self.assertEqual(self._sends(c, vals),
+                         [True, False, False, False, True, False, False, False, True])
+        self.assertEqual((c.n_tx_sent, c.n_tx_suppressed), (3, 6))
+
+    def test_change_sends_at_once(self):
+        c = self.make(TX_HEARTBEAT=2.0, TX_DEADBAND=0.05)
+        self.assertEqual(self._sends(c, [0.5, 0.5, 0.6, 0.6, 0.57]),
+                         [True, False, True, False, False])
+        self.assertEqual(self._sends(c, [0.7]), [True])
+
+    def test_per_destination(self):
+        c = self.make(TX_HEARTBEAT=2.0)
+        c.snap.when = 1000.0
+        self.assertTrue(c.tx_due('casu-032', 0.5))
+        self.assertTrue(c.tx_due('cats', 0.5))
+        self.assertFalse(c.tx_due('casu-032', 0.5))
+
+class TestHoldLast(ControllerCase):
+
+    def _pushes(self, c, arrivals):
+        ''' for each cycle, whether casu-032's count went into the store '''
+        c.current_count = 0.0
+        row = c.nh.index['casu-032']
+        pushed = []
+        push = c.nh.push
+        def record(rows, vals):
+            pushed.append(row in rows)
+            push(rows, vals)
+        c.nh.push = record
+        for arrived in arrivals:
+            c.ts += 1
+            if arrived:
+                c.most_recent_rx['casu-032'].update(when=c.ts, count=0.5, tomem=False)
+            c.update_bee_averages()
+        return pushed
+
+    def test_default_only_new_messages(self):
+        # a lost message is a gap, not the last value counted again
+        c = self.make()
+        self.assertEqual(self._pushes(c, [True, False, True, True, False]),
+                         [True, False, True, True, False])
+
+    def test_hold_with_heartbeat(self):
+        c = self.make(TX_HEARTBEAT=2.0)
+        self.assertEqual(self._pushes(c, [True, False, False, True, False]), [True] * 5)
+
+    def test_hold_on_request(self):
+        c = self.make(RX_HOLD_LAST=True, MAX_MSG_AGE=3)
+        self.assertEqual(self._pushes(c, [True, False, False, False, False]),
+                         [True, True, True, False, False])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+binary messages between controllers, and the legacy text format that
+CASUs on the baseline code still send.
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import struct
+import unittest
+
+import libcas
+import msgcodec
+
+class Clock(object):
+    def __init__(self, t):
+        self.t = t
+    def time(self):
+        return self.t
+
+class Receiver(object):
+    ''' what BaseCASUCtrl.decode_count uses of the controller '''
+    MSG_PREFIX_BEECASU = ''
+    decode_count = libcas.BaseCASUCtrl.decode_count.__func__
+
+    def __init__(self, now=1700000000.5):
+        self.clock = Clock(now)
+        self.msg_stats = msgcodec.LinkStats()
+
+class TestPackUnpack(unittest.TestCase):
+
+    def test_round_trip(self):
+        for seq, sent, value in [(0, 0.0, 0.0), (7, 1700000000.25, 0.123),
+                                 (msgcodec.SEQ_MOD - 1, 1.5, -2.75), (12, 3.0, 1e-9)]:
+            buf = msgcodec.pack(msgcodec.BEE_COUNT, seq, sent, value)
+            self.assertEqual(len(buf), msgcodec.SIZE)
+            self.assertTrue(msgcodec.is_binary(buf))
+            self.assertEqual(msgcodec.unpack(buf), (msgcodec.BEE_COUNT, seq, sent, value))
+
+    def test_seq_wraps(self):
+        buf = msgcodec.pack(msgcodec.BEE_COUNT, msgcodec.SEQ_MOD + 3, 0.0, 1.0)
+        self.assertEqual(msgcodec.unpack(buf)[1], 3)
+
+    def test_bad_length(self):
+        buf = msgcodec.pack(msgcodec.BEE_COUNT, 1, 2.0, 3.0)
+        for n in (0, 1, 2, msgcodec.SIZE - 1):
+            self.assertIsNone(msgcodec.unpack(buf[:n]))
+
+    def test_not_binary(self):
+        buf = msgcodec.pack(msgcodec.BEE_COUNT, 1, 2.0, 3.0)
+        self.assertIsNone(msgcodec.unpack('xx' + buf[2:]))
+        self.assertIsNone(msgcodec.unpack('0.123'))
+        self.assertIsNone(msgcodec.unpack('0.123'.ljust(msgcodec.SIZE)))
+        self.assertFalse(msgcodec.is_binary('bee-casu-avg| 0.123'))
+
+    def test_later_version(self):
+        # a later version may append fields; the known ones are still read
+        head = struct.pack('<2sBBIdd', msgcodec.MAGIC, msgcodec.VERSION + 1,
+                           msgcodec.BEE_COUNT, 5, 10.0, 0.5)
+        self.assertEqual(msgcodec.unpack(head + '\x00' * 8),
+                         (msgcodec.BEE_COUNT, 5, 10.0, 0.5))
+        self.assertEqual(msgcodec.unpack(head), (msgcodec.BEE_COUNT, 5, 10.0, 0.5))
+
+class TestText(unittest.TestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(msgcodec.parse_text(msgcodec.format_text(0.1234)), 0.123)
+        txt = msgcodec.format_text(0.5, 'bee-casu-avg|')
+        self.assertEqual(txt, 'bee-casu-avg| 0.500')
+        self.assertEqual(msgcodec.parse_text(txt, 'bee-casu-avg|'), 0.5)
+
+    def test_prefix(self):
+        self.assertIsNone(msgcodec.parse_text('fish 0.5', 'bee-casu-avg|'))
+        self.assertEqual(msgcodec.parse_text(' 0.25 trailing\n'), 0.25)
+
+class TestDecodeCount(unittest.TestCase):
+
+    def test_baseline_text(self):
+        # as the baseline controllers send it: "{:.3f}", no prefix
+        r = Receiver()
+        self.assertEqual(r.decode_count({'sender': 'casu-032', 'data': "{:.3f}".format(0.123)}), 0.123)
+        self.assertEqual(r.msg_stats.summary(), {})   # text has no link stats
+
+    def test_binary(self):
+        r = Receiver(now=10.25)
+        data = msgcodec.pack(msgcodec.BEE_COUNT, 1, 10.0, 0.75)
+        self.assertEqual(r.decode_count({'sender': 'casu-032', 'data': data}), 0.75)
+        self.assertEqual(r.msg_stats.summary(), {'casu-032': [1, 0, 0, 0.25, 0.25]})
+
+    def test_other_type(self):
+        r = Receiver()
+        data = msgcodec.pack(msgcodec.BEE_COUNT + 1, 1, 10.0, 0.75)
+        self.assertIsNone(r.decode_count({'sender': 'casu-032', 'data': data}))
+
+class TestLinkStats(unittest.TestCase):
+
+    def test_loss_and_duplicates(self):
+        s = msgcodec.LinkStats()
+        for seq in (1, 2, 5, 5, 4, 6):
+            s.rx('a', seq, 0.0, 0.5)
+        n, lost, dup, lat_mean, lat_max = s.summary()['a']
+        self.assertEqual((n, lost, dup), (4, 2, 2))
+        self.assertEqual((lat_mean, lat_max), (0.5, 0.5))
+        self.assertEqual(s.summary(), {})
+
+    def test_wrap(self):
+        s = msgcodec.LinkStats()
+        for seq in (msgcodec.SEQ_MOD - 2, msgcodec.SEQ_MOD - 1, 0, 2):
+            s.rx('a', seq, 0.0, 0.0)
+        self.assertEqual(s.summary()['a'][:3], [4, 1, 0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+compiled neighbourhoods (<nbg stem>.<casu>.nh): used only while they match
+the .nbg they were compiled from; stale, missing or unreadable ones fall
+back to parsing the .nbg.
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+import interactions
+
+GRAPH = '''digraph "pair" {
+    subgraph "bee-arena" {
+        "bee-arena/casu-031" -> "bee-arena/casu-032" [label = "casu-032"; weight=%s]
+        "bee-arena/casu-032" -> "bee-arena/casu-031" [label = "casu-031"; weight=-1.5]
+    }
+}
+'''
+
+class TestNeighbourhoodCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.nbg = os.path.join(self.tmp, 'pair.nbg')
+        self.write_nbg(-1.5)
+        self.nh = interactions.nh_filename(self.nbg, 'casu-032')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_nbg(self, w):
+        with open(self.nbg, 'w') as f:
+            f.write(GRAPH % w)
+
+    def load(self):
+        return interactions.load_neighbourhood(self.nbg, 'casu-032')
+
+    def weight(self):
+        in_map, out_map = self.load()
+        self.assertEqual(out_map, {'casu-031': 'casu-031'})
+        return in_map['casu-031']['w']
+
+    def tamper(self, **changes):
+        ''' edit the compiled file, keeping its digest '''
+        with open(self.nh) as f:
+            nh = yaml.safe_load(f)
+        nh.update(changes)
+        interactions.write_neighbourhood(nh, self.nh)
+
+    def test_written_and_used(self):
+        self.assertFalse(os.path.exists(self.nh))
+        self.assertEqual(self.weight(), -1.5)
+        self.assertTrue(os.path.exists(self.nh))
+        # a matching digest is trusted as is: the file, not the .nbg, is read
+        self.tamper(in_map={'casu-031': {'w': 7.0, 'label': 'casu-031'}})
+        self.assertEqual(self.weight(), 7.0)
+
+    def test_stale_rebuilt(self):
+        self.assertEqual(self.weight(), -1.5)
+        self.write_nbg(-0.25)
+        self.assertEqual(self.weight(), -0.25)
+        with open(self.nh) as f:
+            nh = yaml.safe_load(f)
+        self.assertEqual(nh['nbg_sha1'], interactions.nbg_digest(self.nbg))
+        self.assertEqual(nh['in_map']['casu-031']['w'], -0.25)
+
+    def test_stale_even_if_same_size_and_time(self):
+        self.assertEqual(self.weight(), -1.5)
+        st = os.stat(self.nbg)
+        self.write_nbg(-2.5)
+        os.utime(self.nbg, (st.st_atime, st.st_mtime))
+        self.assertEqual(self.weight(), -2.5)
+
+    def test_other_casu_rejected(self):
+        interactions.compile_nbg(self.nbg, casus=['casu-031'])
+        shutil.copy(interactions.nh_filename(self.nbg, 'casu-031'), self.nh)
+        self.assertEqual(self.weight(), -1.5)
+
+    def test_missing_or_corrupt(self):
+        for content in [None, '', 'not: [valid', '- a list\n', '\x00\xff\x10binary',
+                        'casu: casu-032\n']:
+            if os.path.exists(self.nh):
+                os.remove(self.nh)
+            if content is not None:
+                with open(self.nh, 'w') as f:
+                    f.write(content)
+            self.assertEqual(self.weight(), -1.5, repr(content))
+
+    def test_digest_without_maps(self):
+        self.load()
+        with open(self.nh) as f:
+            nh = yaml.safe_load(f)
+        del nh['out_map']
+        interactions.write_neighbourhood(nh, self.nh)
+        self.assertEqual(self.weight(), -1.5)
+
+    def test_compiled_matches_parsed(self):
+        written = interactions.compile_nbg(self.nbg)
+        self.assertEqual(len(written), 2)
+        g = interactions.load_flat_nbg(self.nbg)
+        for casu in ('casu-031', 'casu-032'):
+            in_map, out_map = interactions.load_neighbourhood(self.nbg, casu)
+            self.assertEqual(out_map, interactions.get_outmap(g, casu))
+            parsed = interactions.get_inmap(g, casu)
+            self.assertEqual(sorted(in_map), sorted(parsed))
+            for k in parsed:
+                self.assertEqual(in_map[k]['w'], float(parsed[k]['w']))
+
+if __name__ == '__main__':
+    unittest.main()
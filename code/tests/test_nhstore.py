@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+NeighbourhoodStore and StoreView against the per-source dicts of arrays
+the controllers used before (push_data_1d, np.mean over the valid part,
+weight * smoothed summed over sources).
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import unittest
+import numpy as np
+
+import libcas
+
+HIST_LEN = 15
+# name: (weight, avg_len, use_latest)
+SOURCES = [
+    ('self',     1.0, 10, False),
+    ('casu-002', -1.5, 10, False),
+    ('casu-003', 0.5, 4, False),
+    ('fish-a',   2.0, 15, False),
+    ('casu-004', 0.75, 10, True),
+]
+
+class TestNeighbourhoodStore(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(3)
+        self.nh = libcas.NeighbourhoodStore(HIST_LEN, extra_windows={'long': 15, 'short': 2},
+                                            resync=50)
+        for name, w, avg, latest in SOURCES:
+            self.nh.add_source(name, w, avg, use_latest=latest)
+        self.nh.build()
+        self.ref = dict((name, np.zeros(HIST_LEN,)) for name, _w, _a, _l in SOURCES)
+        self.weights = dict((name, w) for name, w, _a, _l in SOURCES)
+
+    def _baseline(self, ts):
+        smoothed, inputs, contribs = {}, {}, {}
+        for name, w, avg, latest in SOURCES:
+            valid = min(ts, avg)
+            smoothed[name] = np.mean(self.ref[name][0:valid])
+            inputs[name] = self.ref[name][0] if latest else smoothed[name]
+            contribs[name] = self.weights[name] * inputs[name]
+        return smoothed, inputs, contribs, sum(contribs.values())
+
+    def test_matches_baseline(self):
+        ''' sources pushed on different cycles, over several wrap-arounds '''
+        smoothed = self.nh.view('smoothed')
+        contribs = self.nh.view('contribs')
+        for ts in xrange(1, 6 * HIST_LEN):
+            names = [name for name, _w, _a, _l in SOURCES
+                     if name == 'self' or self.rng.uniform() < 0.6]
+            values = self.rng.uniform(0, 1, len(names))
+            self.nh.push(self.nh.rows(names), values)
+            for name, x in zip(names, values):
+                libcas.push_data_1d(self.ref[name], x)
+            if ts == 40:
+                self.nh.set_weight('casu-002', -0.5)
+                self.weights['casu-002'] = -0.5
+
+            act = self.nh.update(ts)
+            b_smoothed, b_inputs, b_contribs, b_act = self._baseline(ts)
+            self.assertAlmostEqual(act, b_act, places=10)
+            for name, _w, _a, _l in SOURCES:
+                self.assertAlmostEqual(smoothed[name], b_smoothed[name], places=10)
+                self.assertAlmostEqual(contribs[name], b_contribs[name], places=10)
+                i = self.nh.index[name]
+                self.assertAlmostEqual(self.nh.inputs[i], b_inputs[name], places=10)
+                self.assertEqual(self.nh.latest[i], self.ref[name][0])
+            for lbl, w in (('long', 15), ('short', 2)):
+                means = self.nh.window_means(lbl, ts)
+                for name, _w, _a, _l in SOURCES:
+                    self.assertAlmostEqual(means[self.nh.index[name]],
+                                           np.mean(self.ref[name][0:min(ts, w)]), places=10)
+
+    def test_view_subset(self):
+        fish = self.nh.view('smoothed', ['fish-a'])
+        self.assertEqual(len(fish), 1)
+        self.assertEqual(fish.keys(), ['fish-a'])
+        self.assertTrue('fish-a' in fish)
+        self.assertFalse('self' in fish)
+        self.assertRaises(KeyError, fish.__getitem__, 'self')
+        self.assertEqual(fish.get('self', -51), -51)
+        self.nh.push(self.nh.rows(['fish-a']), [0.8])
+        self.nh.update(1)
+        self.assertEqual(fish.items(), [('fish-a', 0.8)])
+
+    def test_build_checks(self):
+        self.assertRaises(RuntimeError, self.nh.add_source, 'late', 1.0, 10)
+        nh = libcas.NeighbourhoodStore(HIST_LEN)
+        nh.add_source('a', 1.0, 10)
+        self.assertRaises(ValueError, nh.add_source, 'a', 1.0, 10)
+        nh.add_source('b', 1.0, HIST_LEN + 1)
+        self.assertRaises(ValueError, nh.build)
+
+if __name__ == '__main__':
+    unittest.main()
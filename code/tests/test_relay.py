@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+the relay's WAN batches (pack_batch / unpack_batch), and reading, batching
+and ageing messages in Relay, with stub sockets in place of zmq's.  Needs
+pyzmq for zmq.Frame / zmq.Again, as relay.py does.
+'''
+
+import os, sys
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'robots'))
+sys.path.insert(0, os.path.join(HERE, '..', 'relay'))
+
+import collections
+import time
+import unittest
+
+import msgcodec
+
+try:
+    import zmq
+    import relay
+    HAVE_ZMQ = True
+except ImportError:
+    HAVE_ZMQ = False
+
+#{{{ stubs
+class StubSub(object):
+    ''' a SUB socket with messages (lists of strings) waiting on it '''
+    def __init__(self, msgs=()):
+        self.queue = [list(m) for m in msgs]
+
+    def recv_multipart(self, flags=0, copy=True):
+        if not self.queue:
+            raise zmq.Again()
+        return [zmq.Frame(p) for p in self.queue.pop(0)]
+
+class StubPub(object):
+    ''' a PUB socket that keeps what is sent, as lists of strings '''
+    def __init__(self):
+        self.sent = []
+
+    def send_multipart(self, parts, copy=True):
+        self.sent.append([getattr(p, 'bytes', p) for p in parts])
+
+class StubLog(object):
+    def __init__(self):
+        self.lines = []
+    def received(self, origin, name, msg, sender, data, now=None):
+        self.lines.append((origin, name, msg, sender, data))
+    def comment(self, text):
+        pass
+
+def make_relay(**conf):
+    '''
+    a Relay on stub sockets, set up as Relay.__init__ would, without opening
+    any zmq socket or log
+    '''
+    c = dict(relay.DEFAULTS)
+    c.update(sub_internet={'connect': 'stub'}, pub_internet={'bind': 'stub'},
+             sub_local={'connect': 'stub'}, pub_local={'bind': 'stub'},
+             routes={'casu-001': ['casu-031'], 'casu-002': ['casu-032']})
+    c.update(conf)
+    r = relay.Relay.__new__(relay.Relay)
+    r.conf = c
+    r.routes, r.renames = relay.build_tables(c['routes'], c['renames'])
+    r.drops = dict((k, 0) for k in relay.DROP_REASONS)
+    r.ages = None
+    if c['max_age'] is not None:
+        r.ages = relay.SendAge(c['max_age'], c['age_window'])
+    r._unrouted_seen = set()
+    r.sub_internet, r.sub_local = StubSub(), StubSub()
+    r.pub_internet, r.pub_local = StubPub(), StubPub()
+    r.topics = {
+        r.sub_internet : tuple(str(t) for t in c['subscribe_internet']),
+        r.sub_local    : tuple(str(t) for t in c['subscribe_local']),
+    }
+    r.wan_batch = c['wan_batch']
+    r._out = collections.OrderedDict()
+    r._out_since = None
+    r.n_batches = 0
+    r.n_batch_bytes = 0
+    r.log = StubLog()
+    return r
+
+def count(name, sender, value, sent=None):
+    ''' a binary bee count as the CASUs send it '''
+    if sent is None:
+        sent = time.time()
+    return [name, 'bees', sender, msgcodec.pack(msgcodec.BEE_COUNT, 0, sent, value)]
+
+def read(r, sock):
+    ''' read_latest, as lists of strings '''
+    return [[f.bytes for f in frames] for frames, now in r.read_latest(sock)]
+#}}}
+
+MSGS = [['casu-001', 'fish', 'cats', 'f1:0.5'],
+        ['casu-002', 'fish', 'cats', ''],
+        ['cats', 'bees', 'casu-001', msgcodec.pack(msgcodec.BEE_COUNT, 7, 1700000000.25, 3.0)]]
+
+@unittest.skipUnless(HAVE_ZMQ, "pyzmq not installed")
+class TestBatchFormat(unittest.TestCase):
+
+    def test_round_trip(self):
+        for zlevel in (0, 1, 9):
+            sent, msgs = relay.unpack_batch(relay.pack_batch(MSGS, 1700000001.5, zlevel))
+            self.assertEqual(sent, 1700000001.5)
+            self.assertEqual(msgs, MSGS)
+
+    def test_compressed_only_if_shorter(self):
+        many = [['casu-00%d' % (i % 8), 'fish', 'cats', 'f1:0.5'] for i in range(50)]
+        z = relay.pack_batch(many, 0.0, 1)
+        self.assertTrue(len(z) < len(relay.pack_batch(many, 0.0, 0)))
+        self.assertEqual(relay.unpack_batch(z)[1], many)
+        one = relay.pack_batch([['a', 'b', 'c', 'd']], 0.0, 1)
+        self.assertEqual(one, relay.pack_batch([['a', 'b', 'c', 'd']], 0.0, 0))
+
+    def test_empty(self):
+        self.assertEqual(relay.unpack_batch(relay.pack_batch([], 2.0)), (2.0, []))
+
+    def test_malformed(self):
+        plain = relay.pack_batch(MSGS, 0.0, 0)
+        hdr = relay._BATCH_HDR
+        bad = [
+            plain[:hdr.size - 1],                                  # short
+            'XX' + plain[2:],                                      # not a batch
+            plain[:-1],                                            # truncated part
+            plain[:hdr.size + 2],                                  # truncated length
+            hdr.pack(relay.BATCH_MAGIC, relay.BATCH_VERSION, 0, 0.0, 4) + plain[hdr.size:],
+            hdr.pack(relay.BATCH_MAGIC, relay.BATCH_VERSION, relay.BATCH_ZLIB, 0.0, 3)
+                + 'not zlib',
+        ]
+        for buf in bad:
+            self.assertRaises(ValueError, relay.unpack_batch, buf)
+
+@unittest.skipUnless(HAVE_ZMQ, "pyzmq not installed")
+class TestReadLatest(unittest.TestCase):
+
+    def test_malformed_counted(self):
+        r = make_relay()
+        good = ['casu-001', 'fish', 'cats', 'f1:0.5']
+        r.sub_internet.queue = [
+            [relay.BATCH_TOPIC, 'RB garbage'],
+            [relay.BATCH_TOPIC, relay.pack_batch(MSGS, 0.0)[:-3]],
+            ['casu-001', 'fish', 'cats'],
+            good,
+        ]
+        self.assertEqual(read(r, r.sub_internet), [good])
+        self.assertEqual(r.drops['malformed'], 3)
+
+    def test_batch_topic_filter(self):
+        ''' messages in a batch are filtered as the SUB socket would them '''
+        r = make_relay(subscribe_internet=['casu-001'])
+        r.sub_internet.queue = [[relay.BATCH_TOPIC, relay.pack_batch(MSGS, 0.0)]]
+        self.assertEqual(read(r, r.sub_internet), [MSGS[0]])
+        self.assertEqual(r.drops['malformed'], 0)
+
+    def test_conflated_across_batches(self):
+        r = make_relay()
+        old = ['casu-001', 'fish', 'cats', 'f1:0.1']
+        new = ['casu-001', 'fish', 'cats', 'f1:0.9']
+        r.sub_internet.queue = [old, [relay.BATCH_TOPIC, relay.pack_batch([MSGS[1], new], 0.0)]]
+        self.assertEqual(read(r, r.sub_internet), [MSGS[1], new])
+        self.assertEqual(r.drops['superseded'], 1)
+
+    def test_max_batch(self):
+        r = make_relay(max_batch=2)
+        r.sub_internet.queue = [MSGS[0], MSGS[1], MSGS[2]]
+        self.assertEqual(read(r, r.sub_internet), MSGS[:2])
+        self.assertEqual(read(r, r.sub_internet), MSGS[2:])
+
+    def test_too_old(self):
+        r = make_relay(max_age=1.0)
+        now = time.time()
+        fresh = count('cats', 'casu-031', 1.0, now)
+        stale = count('cats', 'casu-031', 2.0, now - 10.0)
+        r.sub_local.queue = [fresh, stale]
+        self.assertEqual(read(r, r.sub_local), [fresh])
+        self.assertEqual(r.drops['too_old'], 1)
+        # text messages carry no send time and are never aged
+        text = ['cats', 'bees', 'casu-031', '0.123']
+        r.sub_local.queue = [text]
+        self.assertEqual(read(r, r.sub_local), [text])
+
+    def test_batch_too_old(self):
+        r = make_relay(max_age=1.0)
+        now = time.time()
+        r.sub_internet.queue = [[relay.BATCH_TOPIC, relay.pack_batch(MSGS[:1], now)],
+                                [relay.BATCH_TOPIC, relay.pack_batch(MSGS[1:], now - 10.0)]]
+        self.assertEqual(read(r, r.sub_internet), MSGS[:1])
+        self.assertEqual(r.drops['too_old'], 2)
+
+@unittest.skipUnless(HAVE_ZMQ, "pyzmq not installed")
+class TestSendBatch(unittest.TestCase):
+
+    def arena(self, r, msgs):
+        r.sub_local.queue = msgs
+        for frames, now in r.read_latest(r.sub_local):
+            r.from_local(frames, now)
+
+    def test_batched(self):
+        r = make_relay(wan_batch=True)
+        self.arena(r, [count('cats', 'casu-031', 1.0, 5.0), count('cats', 'casu-032', 2.0, 5.0)])
+        self.arena(r, [count('cats', 'casu-031', 3.0, 6.0)])
+        self.assertEqual(r.pub_internet.sent, [])
+        self.assertEqual(r.drops['superseded'], 1)
+        r.send_batch()
+        self.assertEqual(len(r.pub_internet.sent), 1)
+        topic, batch = r.pub_internet.sent[0]
+        self.assertEqual(topic, relay.BATCH_TOPIC)
+        sent, msgs = relay.unpack_batch(batch)
+        # renamed to the fish-side names, newest only, in order of the updates
+        self.assertEqual([(m[2], msgcodec.unpack(m[3])[3]) for m in msgs],
+                         [('casu-002', 2.0), ('casu-001', 3.0)])
+        self.assertEqual((r.n_batches, r.n_batch_bytes), (1, len(batch)))
+        self.assertEqual(len(r._out), 0)
+        self.assertTrue(r._out_since is None)
+        r.send_batch()
+        self.assertEqual(r.n_batches, 1)
+
+    def test_not_batched(self):
+        r = make_relay()
+        self.arena(r, [['cats', 'bees', 'casu-031', '0.500']])
+        self.assertEqual(r.pub_internet.sent, [['cats', 'bees', 'casu-001', '0.500']])
+        self.assertEqual(len(r._out), 0)
+
+    def test_to_other_site(self):
+        ''' a batch from one relay is routed by the relay at the other site '''
+        a = make_relay(wan_batch=True)
+        self.arena(a, [['casu-001', 'fish', 'casu-031', 'f1:0.5']])
+        a.send_batch()
+        b = make_relay()
+        b.sub_internet.queue = a.pub_internet.sent
+        for frames, now in b.read_latest(b.sub_internet):
+            b.from_internet(frames, now)
+        self.assertEqual(b.pub_local.sent, [['casu-031', 'fish', 'casu-001', 'f1:0.5']])
+
+@unittest.skipUnless(HAVE_ZMQ, "pyzmq not installed")
+class TestSendAge(unittest.TestCase):
+
+    def test_clock_offset(self):
+        ''' a sender an hour behind, with 10ms delay: not old; a 2s wait is '''
+        a = relay.SendAge(1.0)
+        for t in range(10):
+            self.assertFalse(a.too_old('x', t - 3600.0, t + 0.01))
+        self.assertTrue(a.too_old('x', 10.0 - 3600.0, 12.0))
+        self.assertFalse(a.too_old('x', 12.0 - 3600.0, 12.01))
+
+    def test_per_sender(self):
+        a = relay.SendAge(1.0)
+        a.too_old('x', 0.0, 0.0)
+        self.assertFalse(a.too_old('y', -50.0, 0.0))
+        self.assertTrue(a.too_old('x', -2.0, 0.0))
+
+    def test_drift(self):
+        ''' a slow drift of the sender's clock (10 s/day here) is followed '''
+        a = relay.SendAge(0.5, window=300.0)
+        for t in xrange(0, 86400, 10):
+            self.assertFalse(a.too_old('x', t * (1 - 10.0 / 86400), t + 0.01))
+
+    def test_clock_step(self):
+        ''' a sender's clock set back by 10 s: dropped for max_age only '''
+        a = relay.SendAge(1.0)
+        for t in range(5):
+            a.too_old('x', float(t), t + 0.01)
+        dropped = [t for t in range(5, 10) if a.too_old('x', t - 10.0, t + 0.01)]
+        self.assertEqual(dropped, [5, 6])
+
+if __name__ == '__main__':
+    unittest.main()
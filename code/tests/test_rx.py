@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+reading messages from neighbours: the per-cycle budgets of drain_messages,
+and conflation to the newest count per sender.
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import unittest
+
+from fixtures import ControllerCase
+import libcas
+import msgcodec
+
+class StubCasu(object):
+    ''' a message queue only; read_message as the CASU's (None when empty) '''
+    def __init__(self, msgs=()):
+        self.queue = list(msgs)
+        self.n_reads = 0
+
+    def read_message(self):
+        self.n_reads += 1
+        if self.queue:
+            return self.queue.pop(0)
+        return None
+
+def count(sender, value):
+    return {'sender': sender, 'data': msgcodec.format_text(value)}
+
+class RxCase(ControllerCase):
+    ''' a controller reading from a StubCasu '''
+    CONF = {}
+
+    def setUp(self):
+        ControllerCase.setUp(self)
+        self.c = self.make(**self.CONF)
+        self.c.rx_counts = dict.fromkeys(self.c.RX_LOG_FIELDS, 0)
+        self.casu, self.stub = self.c._casu, StubCasu()
+        self.c._casu = self.stub
+
+    def tearDown(self):
+        self.c._casu = self.casu
+        ControllerCase.tearDown(self)
+
+class TestDrain(RxCase):
+    CONF = {'RX_MAX_MSGS': 5, 'RX_MAX_TIME': 10.0}
+
+    def test_reads_until_empty(self):
+        self.stub.queue = [count('casu-032', i) for i in xrange(3)]
+        self.assertEqual([m['data'] for m in self.c.drain_messages()],
+                         ['0.000', '1.000', '2.000'])
+        self.assertEqual(self.c.rx_counts['read'], 3)
+        self.assertEqual(self.c.rx_counts['budget_hits'], 0)
+
+    def test_exactly_the_budget_is_no_hit(self):
+        self.stub.queue = [count('casu-032', i) for i in xrange(5)]
+        self.assertEqual(len(self.c.drain_messages()), 5)
+        self.assertEqual(self.c.rx_counts['budget_hits'], 0)
+        self.assertEqual(self.c.drain_messages(), [])
+        self.assertEqual(self.c.rx_counts['budget_hits'], 0)
+
+    def test_message_budget(self):
+        self.stub.queue = [count('casu-032', i) for i in xrange(12)]
+        got = [self.c.drain_messages() for i in xrange(4)]
+        self.assertEqual([len(g) for g in got], [5, 5, 2, 0])
+        self.assertEqual(self.c.rx_counts['budget_hits'], 2)
+        self.assertEqual(self.c.rx_counts['read'], 12)
+        # nothing lost or reordered by holding one over
+        self.assertEqual([m['data'] for g in got for m in g],
+                         [msgcodec.format_text(i) for i in xrange(12)])
+
+    def test_time_budget(self):
+        t = [0.0]
+        def fake_monotonic():
+            t[0] += 1.0
+            return t[0]
+        orig, libcas.monotonic = libcas.monotonic, fake_monotonic
+        try:
+            self.c.RX_MAX_TIME = 2.5
+            self.stub.queue = [count('casu-032', i) for i in xrange(8)]
+            first = self.c.drain_messages()
+        finally:
+            libcas.monotonic = orig
+        self.assertEqual(len(first), 2)
+        self.assertEqual(self.c.rx_counts['budget_hits'], 1)
+        self.c.RX_MAX_TIME = 10.0
+        self.assertEqual([len(self.c.drain_messages()) for i in xrange(2)], [5, 1])
+
+    def test_retries(self):
+        self.assertEqual(self.c.drain_messages(retry_cnt=2), [])
+        self.assertEqual(self.stub.n_reads, 3)
+
+class TestConflate(RxCase):
+
+    def test_last_value_wins(self):
+        self.stub.queue = [count('casu-032', 0.1), count('casu-033', 0.7),
+                           count('casu-032', 0.2), count('casu-032', 0.3)]
+        self.assertEqual(self.c.recv_all_incoming(), {'casu-032': 0.3, 'casu-033': 0.7})
+        self.assertEqual(self.c.rx_counts['superseded'], 2)
+        self.assertEqual(self.c.rx_counts['dropped'], 0)
+
+    def test_unparseable_dropped(self):
+        # only the newest per sender is decoded, so only its failure counts
+        self.stub.queue = [count('casu-032', 0.1), {'sender': 'casu-032', 'data': 'garbage'},
+                           {'sender': 'casu-033', 'data': ''}]
+        self.assertEqual(self.c.recv_all_incoming(), {})
+        self.assertEqual(self.c.rx_counts['superseded'], 1)
+        self.assertEqual(self.c.rx_counts['dropped'], 2)
+
+    def test_superseded_binary_in_link_stats(self):
+        self.c.clock.sleep(0.5)
+        now = self.c.clock.time()
+        self.stub.queue = [{'sender': 'casu-032', 'data': msgcodec.pack(msgcodec.BEE_COUNT, s, now, v)}
+                           for s, v in [(1, 0.1), (2, 0.2), (4, 0.4)]]
+        self.assertEqual(self.c.recv_all_incoming(), {'casu-032': 0.4})
+        rx, lost, dup = self.c.msg_stats.summary()['casu-032'][:3]
+        self.assertEqual((rx, lost, dup), (3, 1, 0))
+
+    def test_conflate(self):
+        latest = {}
+        self.c.conflate(latest, 'a', count('a', 1.0))
+        self.c.conflate(latest, 'b', count('b', 2.0))
+        self.c.conflate(latest, 'a', count('a', 3.0))
+        self.assertEqual(latest['a']['data'], '3.000')
+        self.assertEqual(self.c.rx_counts['superseded'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+CycleScheduler deadlines and overrun policies, and SharedScheduler, on a
+virtual clock (cycles "take time" by sleeping on it).
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import unittest
+
+import fake_casu
+import libcas
+
+T0 = 100.0
+
+class Task(object):
+    ''' a cycle function taking durations[i] s on its i-th call '''
+    def __init__(self, clock, durations, name=None):
+        self.clock = clock
+        self.durations = list(durations)
+        self.name = name
+        self.starts = []
+
+    def __call__(self):
+        self.starts.append(self.clock.now - T0)
+        i = len(self.starts) - 1
+        self.clock.sleep(self.durations[i] if i < len(self.durations) else self.durations[-1])
+
+def scheduler(clock, interval=1.0, **kw):
+    return libcas.CycleScheduler(interval, clock=clock.monotonic, sleep=clock.sleep, **kw)
+
+class TestCycleScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_casu.VirtualClock(start=T0)
+
+    def run_task(self, durations, n, **kw):
+        task = Task(self.clock, durations)
+        sched = scheduler(self.clock, **kw)
+        sched.run(task, n_cycles=n)
+        return task, sched
+
+    def test_on_time(self):
+        task, sched = self.run_task([0.2], 5)
+        self.assertEqual(task.starts, [1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual((sched.n_overruns, sched.n_skipped), (0, 0))
+        st = sched.summary()
+        self.assertEqual(st['late_max'], 0.0)
+        self.assertAlmostEqual(st['dur_mean'], 0.2)
+
+    def test_no_drift(self):
+        # uneven cycle times do not shift the grid
+        task, sched = self.run_task([0.1, 0.9, 0.5, 0.0, 0.7], 5)
+        self.assertEqual(task.starts, [1.0, 2.0, 3.0, 4.0, 5.0])
+
+    def test_overrun_skip(self):
+        # the 2nd cycle runs to 4.5: the deadlines at 3 and 4 are dropped
+        task, sched = self.run_task([0.2, 2.5, 0.2], 4, policy='skip')
+        self.assertEqual(task.starts, [1.0, 2.0, 5.0, 6.0])
+        self.assertEqual((sched.n_overruns, sched.n_skipped), (1, 2))
+
+    def test_overrun_catchup(self):
+        # the cycles due at 3 and 4 run back-to-back, then back on the grid
+        task, sched = self.run_task([0.2, 2.5, 0.2], 5, policy='catchup')
+        for got, want in zip(task.starts, [1.0, 2.0, 4.5, 4.7, 5.0]):
+            self.assertAlmostEqual(got, want)
+        self.assertEqual(sched.n_skipped, 0)
+        self.assertEqual(sched.n_overruns, 2)   # the first catch-up cycle ends late too
+
+    def test_catchup_limit(self):
+        # 9 slots behind, at most max_catchup=2 of them are made up
+        task, sched = self.run_task([0.2, 10.0, 0.2], 6, policy='catchup', max_catchup=2)
+        for got, want in zip(task.starts, [1.0, 2.0, 12.0, 12.2, 12.4, 13.0]):
+            self.assertAlmostEqual(got, want)
+        self.assertEqual(sched.n_skipped, 7)
+
+    def test_reports(self):
+        reports = []
+        task, sched = self.run_task([0.2, 1.5, 0.2], 10, on_report=reports.append,
+                                    report_interval=4.0)
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(sum(r['cycles'] for r in reports), 7)
+        self.assertEqual(reports[0]['overruns'], 1)
+        self.assertEqual(reports[1]['overruns'], 0)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, scheduler, self.clock, policy='sometimes')
+
+class Boom(Exception):
+    pass
+
+class TestSharedScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = fake_casu.VirtualClock(start=T0)
+        self.order = []
+
+    def task(self, name, durations):
+        t = Task(self.clock, durations, name)
+        def fn():
+            self.order.append(name)
+            t()
+        fn.task = t
+        return fn
+
+    def test_interleaved(self):
+        a, b = self.task('a', [0.1]), self.task('b', [0.1])
+        shared = libcas.SharedScheduler([scheduler(self.clock, 1.0), scheduler(self.clock, 1.5)])
+        shared.run([a, b], n_cycles=4)
+        self.assertEqual(a.task.starts, [1.0, 2.0, 3.0, 4.0])
+        # both due at 3.0: the first scheduler goes first, b 0.1 s late
+        for got, want in zip(b.task.starts, [1.5, 3.1, 4.5, 6.0]):
+            self.assertAlmostEqual(got, want)
+        self.assertEqual(self.order, ['a', 'b', 'a', 'a', 'b', 'a', 'b', 'b'])
+
+    def test_own_policies(self):
+        # an overrun in one task delays the other only by its own length
+        a, b = self.task('a', [0.2, 2.5, 0.2]), self.task('b', [0.1])
+        sa, sb = scheduler(self.clock, policy='skip'), scheduler(self.clock, policy='catchup')
+        libcas.SharedScheduler([sa, sb]).run([a, b], n_cycles=5)
+        self.assertEqual(a.task.starts[:4], [1.0, 2.0, 5.0, 6.0])
+        self.assertEqual(sa.n_skipped, 2)
+        self.assertEqual(sb.n_skipped, 0)
+        self.assertEqual(len(b.task.starts), 5)
+
+    def test_failed_task_dropped(self):
+        a, b = self.task('a', [0.1]), self.task('b', [0.1])
+        def bad():
+            b()
+            if len(b.task.starts) == 2:
+                raise Boom()
+        failed = []
+        sa, sb = scheduler(self.clock), scheduler(self.clock)
+        libcas.SharedScheduler([sa, sb], on_error=lambda s, e: failed.append((s, e))).run(
+            [a, bad], n_cycles=5)
+        self.assertEqual(len(a.task.starts), 5)
+        self.assertEqual(len(b.task.starts), 2)
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0][0] is sb and isinstance(failed[0][1], Boom))
+
+    def test_error_propagates_without_handler(self):
+        def bad():
+            raise Boom()
+        shared = libcas.SharedScheduler([scheduler(self.clock)])
+        self.assertRaises(Boom, shared.run, [bad], n_cycles=3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+WindowedHist running sums against np.mean over the shifted-array history.
+'''
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'robots'))
+
+import unittest
+import numpy as np
+
+import libcas
+
+class TestWindowedHist(unittest.TestCase):
+    HIST_LEN = 15
+    WINDOWS = {'avg': 10, 'short': 3, 'all': 15}
+
+    def setUp(self):
+        self.rng = np.random.RandomState(2)
+
+    def _compare(self, n_push, resync=None, places=10, values=None):
+        h = libcas.WindowedHist(self.HIST_LEN, self.WINDOWS, resync=resync)
+        ref = np.zeros(self.HIST_LEN,)
+        for ts in xrange(1, n_push + 1):
+            x = self.rng.uniform(0, 1) if values is None else values(ts)
+            h.push(x)
+            libcas.push_data_1d(ref, x)
+            for lbl, w in self.WINDOWS.items():
+                valid = min(ts, w)
+                self.assertAlmostEqual(h.mean(lbl), np.mean(ref[0:valid]), places=places)
+                self.assertAlmostEqual(h.window_sum(lbl), ref[0:w].sum(), places=places)
+                # a shorter span than the window is computed directly
+                self.assertAlmostEqual(h.mean(lbl, valid=2), np.mean(ref[0:min(2, w)]),
+                                       places=places)
+        return h
+
+    def test_wraparound(self):
+        self._compare(4 * self.HIST_LEN + 1)
+
+    def test_sums_do_not_drift(self):
+        ''' long run of large values: running sums stay within rounding of exact '''
+        h = libcas.WindowedHist(self.HIST_LEN, self.WINDOWS, resync=100)
+        ref = np.zeros(self.HIST_LEN,)
+        for ts in xrange(1, 5001):
+            x = 1e6 * self.rng.uniform(0, 1)
+            h.push(x)
+            libcas.push_data_1d(ref, x)
+            for lbl, w in self.WINDOWS.items():
+                exact = ref[0:w].sum()
+                self.assertLess(abs(h.window_sum(lbl) - exact), 1e-9 * exact)
+
+    def test_resync_matches(self):
+        h = self._compare(2 * self.HIST_LEN, resync=7)
+        sums = dict((lbl, h.window_sum(lbl)) for lbl in self.WINDOWS)
+        h.resync_sums()
+        for lbl in self.WINDOWS:
+            self.assertAlmostEqual(h.window_sum(lbl), sums[lbl], places=12)
+
+    def test_window_too_long(self):
+        self.assertRaises(ValueError, libcas.WindowedHist, 5, {'avg': 6})
+        self.assertRaises(ValueError, libcas.WindowedHist, 5, {'avg': 0})
+
+if __name__ == '__main__':
+    unittest.main()